@@ -0,0 +1,70 @@
+import sys
+sys.path.append("..")
+
+import argparse
+import os
+import tempfile
+from glob import glob
+from pathlib import Path
+from time import perf_counter
+
+from src.helpers.repositories import AbstractIO, CompressIO, PickleIO, ZstdIO, LZ4IO, OutOfBandIO, get_io
+
+EXTRACTED_DIR = '../data/extracted'
+
+
+def parse_args() -> tuple[str, int]:
+    parser = argparse.ArgumentParser(description='Compare write time, read time and size of the IO backends.')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    return args.extracted_dir, args.repeat
+
+
+def get_backends() -> dict[str, AbstractIO]:
+    return {
+        'bz2': CompressIO(),
+        'pickle': PickleIO(),
+        'zstd-3': ZstdIO(3),
+        'zstd-9': ZstdIO(9),
+        'lz4': LZ4IO(),
+        'pickle-5-oob': OutOfBandIO()
+    }
+
+
+def load_datasets(extracted_directory: str) -> dict[str, object]:
+    datasets = {}
+    for path in sorted(glob(extracted_directory + '/*/*.pkl*')):
+        datasets[Path(path).name] = get_io(path).load(path)
+    return datasets
+
+
+# Best of several runs, so that page cache and allocator warm-up do not skew the first backend
+def time_best(function, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+    return min(timings)
+
+
+def main(extracted_directory: str, repeat: int = 3):
+    print(f'Loading datasets...')
+    datasets = load_datasets(extracted_directory)
+    print(f'Datasets: {len(datasets)}')
+
+    print(f'{"Backend":<14}{"Write":>10}{"Read":>10}{"Size":>12}')
+    with tempfile.TemporaryDirectory() as temp_directory:
+        for backend_name, io in get_backends().items():
+            write_total, read_total, size_total = 0.0, 0.0, 0
+            for name, dataset in datasets.items():
+                path = str(Path(temp_directory, f'{backend_name}-{name}'))
+                write_total += time_best(lambda: io.save(path, dataset), repeat)
+                read_total += time_best(lambda: io.load(path + io.file_ext()), repeat)
+                size_total += os.path.getsize(path + io.file_ext())
+            print(f'{backend_name:<14}{write_total:>9.3f}s{read_total:>9.3f}s{size_total / 2 ** 20:>9.2f} MiB')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
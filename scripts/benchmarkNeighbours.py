@@ -0,0 +1,78 @@
+import sys
+sys.path.append("..")
+
+import argparse
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+
+from src.helpers.query import AbstractNeighbourIndex, ExactIndex, IVFIndex
+from src.helpers.repositories import PandasAudioRepository
+
+EXTRACTED_DIR = '../data/extracted'
+
+
+def parse_args() -> tuple[str, int, int, int, int]:
+    parser = argparse.ArgumentParser(description='Compare recall and latency of the approximate nearest neighbour '
+                                                 'index against exact search, in the PCA space of the notebooks.')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--components', type=int, default=10, help='PCA components, all scalar features if 0')
+    parser.add_argument('--songs', type=int, default=0,
+                        help='grow the library to this many songs with jittered copies to simulate a larger one')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--neighbours', type=int, default=6)
+    args = parser.parse_args()
+    return args.extracted_dir, args.components, args.songs, args.queries, args.neighbours
+
+
+def load_points(extracted_directory: str, n_components: int, n_songs: int) -> np.ndarray:
+    features = PandasAudioRepository.load_feature_matrix(extracted_directory)
+    points = StandardScaler().fit_transform(features.scalars)
+    if n_components:
+        points = PCA(n_components=n_components).fit_transform(points)
+    if n_songs > len(points):
+        rng = np.random.default_rng(0)
+        copies = points[rng.integers(0, len(points), n_songs - len(points))]
+        points = np.concatenate([points, copies + rng.normal(scale=0.1, size=copies.shape)])
+    return points
+
+
+def time_queries(index: AbstractNeighbourIndex, queries: np.ndarray, k: int, **kwargs):
+    start = perf_counter()
+    result = index.query(queries, k, **kwargs)
+    return result, perf_counter() - start
+
+
+def main(extracted_directory: str, n_components: int = 10, n_songs: int = 0, n_queries: int = 1000,
+         neighbours: int = 6):
+    points = load_points(extracted_directory, n_components, n_songs)
+    queries = points[np.random.default_rng(1).integers(0, len(points), n_queries)]
+    print(f'Songs: {len(points)}, dimensions: {points.shape[1]}, queries: {n_queries}')
+
+    start = perf_counter()
+    exact = ExactIndex().build(points)
+    (_, exact_indices), exact_time = time_queries(exact, queries, neighbours)
+    print(f'exact     built in {perf_counter() - start:.2f}s, {exact_time / n_queries * 1e3:.3f} ms per query')
+
+    start = perf_counter()
+    index = IVFIndex().build(points)
+    print(f'ivf       built in {perf_counter() - start:.2f}s, {len(index.centroids)} partitions')
+    with tempfile.TemporaryDirectory() as directory:
+        path = index.save(str(Path(directory, 'index')))
+        start = perf_counter()
+        index = AbstractNeighbourIndex.load(path)
+        print(f'ivf       loaded in {perf_counter() - start:.3f}s')
+
+    n_probes = sorted({1, 2, 4, 8, 16, 32, len(index.centroids)} & set(range(1, len(index.centroids) + 1)))
+    for n_probe in n_probes:
+        (_, indices), query_time = time_queries(index, queries, neighbours, n_probe=n_probe)
+        recall = np.mean([len(set(a) & set(b)) for a, b in zip(indices, exact_indices)]) / neighbours
+        print(f'n_probe {n_probe:4d}  recall {recall:.3f}, {query_time / n_queries * 1e3:.3f} ms per query')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
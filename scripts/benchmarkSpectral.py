@@ -0,0 +1,64 @@
+import sys
+sys.path.append("..")
+
+import argparse
+from time import perf_counter
+
+import librosa
+import librosa.feature
+import librosa.onset
+
+from src.helpers.processors import AudioDataProcessor, FeatureVectorProcessor
+from src.models import AudioData
+
+
+def parse_args() -> tuple[str, int]:
+    parser = argparse.ArgumentParser(description='Compare spectral extraction with and without a shared STFT.')
+    parser.add_argument('raw_dir')
+    parser.add_argument('--limit', type=int, default=0)
+    args = parser.parse_args()
+    return args.raw_dir, args.limit
+
+
+# Reference implementation: every feature recomputes its own STFT or mel spectrogram from the waveform
+def per_feature_spectral(audio: AudioData, n_mels: int = 256, n_mfcc: int = 13):
+    y, sr = audio.waveform, audio.sample_rate
+    librosa.amplitude_to_db(abs(librosa.stft(y)))
+    librosa.amplitude_to_db(librosa.feature.melspectrogram(y=y, sr=sr, n_mels=n_mels))
+    librosa.feature.spectral_centroid(y=y, sr=sr)
+    librosa.feature.spectral_rolloff(y=y, sr=sr)
+    librosa.onset.onset_strength(y=y, sr=sr)
+    librosa.feature.spectral_flatness(y=y)
+    librosa.feature.mfcc(y=y, sr=sr, n_mfcc=n_mfcc)
+
+
+def shared_spectral(audio: AudioData):
+    FeatureVectorProcessor(audio, save_repr=True).process_spectral()
+
+
+def time_one(function, audio: AudioData) -> float:
+    start = perf_counter()
+    function(audio)
+    return perf_counter() - start
+
+
+def main(raw_directory: str, limit: int = 0):
+    print(f'Loading audio...')
+    raw_audio = AudioDataProcessor(raw_directory, limit=limit).load()
+
+    per_feature_total, shared_total = 0.0, 0.0
+    for audio in raw_audio:
+        per_feature = time_one(per_feature_spectral, audio)
+        shared = time_one(shared_spectral, audio)
+        per_feature_total += per_feature
+        shared_total += shared
+        print(f'{per_feature:8.3f}s {shared:8.3f}s {per_feature / shared:6.2f}x  {audio.name}')
+
+    print(f'Tracks: {len(raw_audio)}')
+    print(f'Per-feature STFT: {per_feature_total:.3f}s')
+    print(f'Shared STFT:      {shared_total:.3f}s')
+    print(f'Speedup:          {per_feature_total / shared_total:.2f}x')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
@@ -0,0 +1,49 @@
+import sys
+sys.path.append("..")
+
+import argparse
+from pathlib import Path
+from time import perf_counter
+
+from src.helpers.distances import blocked_pdist, minmax_scale_rows
+from src.helpers.repositories import PandasAudioRepository
+
+EXTRACTED_DIR = '../data/extracted'
+
+
+def parse_args() -> tuple[str, str, str, bool, bool, int, int]:
+    parser = argparse.ArgumentParser(description='Compute pairwise distances of one feature column of the extracted '
+                                                 'library into a memory-mapped .npy file.')
+    parser.add_argument('column', help='array column, e.g. note_trajectory, chord_trajectory or tonnetz')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--metric', choices=['euclidean', 'cosine'], default='euclidean')
+    parser.add_argument('--scale-rows', action=argparse.BooleanOptionalAction, default=None,
+                        help='scale each song to [0, 1] first, on by default for trajectories')
+    parser.add_argument('--square', action=argparse.BooleanOptionalAction, default=False,
+                        help='write a songs x songs matrix instead of a condensed one')
+    parser.add_argument('--block-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    scale_rows = args.scale_rows if args.scale_rows is not None else args.column.endswith('_trajectory')
+    return args.column, args.extracted_dir, args.metric, scale_rows, args.square, args.block_size, args.workers
+
+
+# Written next to the extracted playlists, e.g. note_trajectory.euclidean.distances.npy
+def get_output_path(extracted_directory: str, column: str, metric: str, square: bool) -> Path:
+    return Path(extracted_directory, f'{column}.{metric}{".square" if square else ""}.distances.npy')
+
+
+def main(column: str, extracted_directory: str = EXTRACTED_DIR, metric: str = 'euclidean', scale_rows: bool = False,
+         square: bool = False, block_size: int = 256, max_workers: int = None):
+    features = PandasAudioRepository.load_feature_matrix(extracted_directory, columns=[column])
+    matrix = minmax_scale_rows(features.arrays[column]) if scale_rows else features.arrays[column]
+    path = get_output_path(extracted_directory, column, metric, square)
+
+    start = perf_counter()
+    distances = blocked_pdist(matrix, str(path), metric, square, block_size, max_workers)
+    print(f'{len(features)} songs, {distances.shape} {distances.dtype} distances in {perf_counter() - start:.2f}s')
+    print(f'Saved {path}, open it with load_distances()')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
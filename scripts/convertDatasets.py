@@ -0,0 +1,42 @@
+import sys
+sys.path.append("..")
+
+import argparse
+from glob import glob
+from pathlib import Path
+
+import pandas as pd
+
+from src.helpers.encodings import TRAJECTORY_ENCODINGS
+from src.helpers.precision import PRECISION_POLICIES
+from src.helpers.repositories import ColumnarFeatureStore, PandasAudioRepository
+
+EXTRACTED_DIR = '../data/extracted'
+
+
+def parse_args() -> tuple[str, str, str]:
+    parser = argparse.ArgumentParser(description='Convert pickled feature datasets into columnar feature stores.')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--precision', choices=PRECISION_POLICIES, default='full')
+    parser.add_argument('--encoding', choices=TRAJECTORY_ENCODINGS, default='raw',
+                        help='add compact trajectory encodings (encoded), or store only them (compact)')
+    args = parser.parse_args()
+    return args.extracted_dir, args.precision, args.encoding
+
+
+def main(extracted_directory: str, precision: str = 'full', encoding: str = 'raw'):
+    for folder in sorted(glob(extracted_directory + '/*/')):
+        name = Path(folder).name
+        pickle_path = Path(folder, name + '.features.pkl.pbz2')
+        if not pickle_path.exists():
+            continue
+        dataset = TRAJECTORY_ENCODINGS[encoding].apply_dataset(pd.read_pickle(str(pickle_path), compression='bz2'))
+        store = ColumnarFeatureStore.write(folder, name, dataset, PRECISION_POLICIES[precision])
+        print(f'Converted {name}: {len(store)} songs, {len(store.columns)} columns')
+
+    manifest = PandasAudioRepository.index_extracted(extracted_directory)
+    print(f'Indexed {len(manifest)} tracks in {manifest.path}')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
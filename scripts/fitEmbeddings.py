@@ -0,0 +1,35 @@
+import sys
+sys.path.append("..")
+
+import argparse
+from time import perf_counter
+
+from src.helpers.embedding import EMBEDDING_SPACES, LANDMARK_METHODS, LandmarkMDS
+from src.helpers.repositories import PandasAudioRepository
+
+EXTRACTED_DIR = '../data/extracted'
+
+
+def parse_args() -> tuple[str, int, str]:
+    parser = argparse.ArgumentParser(description='Fit landmark MDS embeddings of the note, chord and tonnetz spaces '
+                                                 'and save them next to the extracted playlists.')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--landmarks', type=int, default=200)
+    parser.add_argument('--method', choices=LANDMARK_METHODS, default='smacof')
+    args = parser.parse_args()
+    return args.extracted_dir, args.landmarks, args.method
+
+
+def main(extracted_directory: str, n_landmarks: int = 200, method: str = 'smacof'):
+    features = PandasAudioRepository.load_feature_matrix(extracted_directory,
+                                                         columns=[column for column, _ in EMBEDDING_SPACES.values()])
+    print(f'Songs: {len(features)}')
+    for name, (column, scale_rows) in EMBEDDING_SPACES.items():
+        start = perf_counter()
+        model = LandmarkMDS(n_landmarks=n_landmarks, method=method, scale_rows=scale_rows).fit(features.arrays[column])
+        path = model.save(extracted_directory, name)
+        print(f'{name:<8} {len(model.landmark_indices)} landmarks in {perf_counter() - start:.2f}s, saved {path}')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
@@ -0,0 +1,82 @@
+import sys
+sys.path.append("..")
+
+import argparse
+from time import perf_counter
+
+from src.helpers.encodings import TRAJECTORY_ENCODINGS
+from src.helpers.pipeline import PlacementPipeline
+from src.helpers.precision import PRECISION_POLICIES
+from src.helpers.processors import FeatureVectorProcessor
+from src.helpers.query import ExactIndex, IVFIndex
+from src.helpers.repositories import PandasAudioRepository
+
+EXTRACTED_DIR = '../data/extracted'
+MODELS_DIR = '../data/models'
+
+
+def parse_args() -> tuple[str, str, str, int, int, int, str, str, str]:
+    parser = argparse.ArgumentParser(description='Fit every transform of the clustering pipeline on the extracted '
+                                                 'library and save it as one artifact for placeSong.py.')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--output', default=MODELS_DIR)
+    parser.add_argument('--name', default='placement')
+    parser.add_argument('--components', type=int, default=10, help='PCA components, n_pca_components in config.py')
+    parser.add_argument('--clusters', type=int, default=8, help='GMM components')
+    parser.add_argument('--landmarks', type=int, default=200)
+    parser.add_argument('--index', choices=['exact', 'ivf'], default='exact')
+    parser.add_argument('--encoding', choices=list(TRAJECTORY_ENCODINGS), default=None,
+                        help='trajectory encoding the library was extracted with, if its manifest does not record it')
+    parser.add_argument('--precision', choices=list(PRECISION_POLICIES), default=None,
+                        help='precision the library was extracted with, if its manifest does not record it')
+    args = parser.parse_args()
+    return (args.extracted_dir, args.output, args.name, args.components, args.clusters, args.landmarks,
+            args.index, args.encoding, args.precision)
+
+
+# New songs are extracted with every parameter the library was extracted with, as recorded in its manifest
+def get_extraction_params(extracted_directory: str, encoding: str = None, precision: str = None) -> dict:
+    given = {}
+    if encoding is not None:
+        given['encoding'] = TRAJECTORY_ENCODINGS[encoding]
+    if precision is not None:
+        given['precision'] = PRECISION_POLICIES[precision]
+
+    library_params = PlacementPipeline.get_library_params(extracted_directory)
+    if library_params is None:
+        print('No extraction parameters recorded for the library, assuming the defaults')
+        return FeatureVectorProcessor.get_extraction_params(**given)
+    different = [p for p in given if given[p] != library_params[p]]
+    if different:
+        raise ValueError(f'The library was extracted with other {different} than given')
+    return library_params
+
+
+def main(extracted_directory: str, output_directory: str = MODELS_DIR, name: str = 'placement',
+         n_pca_components: int = 10, n_clusters: int = 8, n_landmarks: int = 200, index_type: str = 'exact',
+         encoding: str = None, precision: str = None):
+    extraction_params = get_extraction_params(extracted_directory, encoding, precision)
+    print(f'Extraction parameters: {extraction_params}')
+
+    start = perf_counter()
+    features = PandasAudioRepository.load_feature_matrix(extracted_directory)
+    print(f'Loaded {len(features)} songs in {perf_counter() - start:.2f}s')
+
+    start = perf_counter()
+    pipeline = PlacementPipeline(
+        n_pca_components=n_pca_components,
+        n_clusters=n_clusters,
+        n_landmarks=n_landmarks,
+        index=IVFIndex() if index_type == 'ivf' else ExactIndex(),
+        extraction_params=extraction_params
+    ).fit(features)
+    print(f'Fitted in {perf_counter() - start:.2f}s, '
+          f'{pipeline.pca.explained_variance_ratio_.sum():.1%} variance in {n_pca_components} components')
+    print(pipeline.metadata['cluster'].value_counts().sort_index().to_string())
+
+    path = pipeline.save(output_directory, name)
+    print(f'Saved {path}')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
@@ -0,0 +1,86 @@
+import sys
+sys.path.append("..")
+
+import argparse
+import asyncio
+import json
+from time import perf_counter
+from urllib.parse import urlencode
+
+import numpy as np
+
+
+def parse_args() -> tuple[str, int, int, int, str]:
+    parser = argparse.ArgumentParser(description='Send concurrent requests to serveRecommendations.py and report '
+                                                 'latency percentiles and throughput.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--clients', type=int, default=32, help='concurrent keep-alive connections')
+    parser.add_argument('--requests', type=int, default=5000, help='total requests over all clients')
+    parser.add_argument('--by', choices=['song_name', 'artist'], default='song_name')
+    args = parser.parse_args()
+    return args.host, args.port, args.clients, args.requests, args.by
+
+
+async def get(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: str) -> tuple[int, object]:
+    writer.write(f'GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+        key, _, value = line.decode().partition(':')
+        headers[key.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+
+
+async def fetch(host: str, port: int, target: str):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return (await get(reader, writer, target))[1]
+    finally:
+        writer.close()
+
+
+# Each client sends its next request as soon as the previous one is answered, until all requests are sent
+async def run_client(host: str, port: int, targets: list[str], latencies: list[float]):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while targets:
+            target = targets.pop()
+            start = perf_counter()
+            status, _ = await get(reader, writer, target)
+            if status == 200:
+                latencies.append(perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run(host: str, port: int, n_clients: int, n_requests: int, column: str):
+    terms = await fetch(host, port, f'/terms?{urlencode({"by": column})}')
+    rng = np.random.default_rng(0)
+    targets = [f'/recommend?{urlencode({"q": terms[i], "by": column})}'
+               for i in rng.integers(0, len(terms), n_requests)]
+    before = await fetch(host, port, '/stats')
+
+    latencies = []
+    start = perf_counter()
+    await asyncio.gather(*(run_client(host, port, targets, latencies) for _ in range(n_clients)))
+    elapsed = perf_counter() - start
+    after = await fetch(host, port, '/stats')
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3
+    batch_size = (after['requests'] - before['requests']) / max(after['batches'] - before['batches'], 1)
+    print(f'{len(latencies)}/{n_requests} requests from {n_clients} clients in {elapsed:.2f}s, '
+          f'{len(latencies) / elapsed:.0f} requests/s')
+    print(f'Client latency  p50 {p50:.2f} ms, p90 {p90:.2f} ms, p99 {p99:.2f} ms')
+    print(f'Server latency  p50 {after["latency_p50_ms"]:.2f} ms, p99 {after["latency_p99_ms"]:.2f} ms, '
+          f'{batch_size:.1f} requests per batch')
+
+
+def main(host: str = '127.0.0.1', port: int = 8080, n_clients: int = 32, n_requests: int = 5000,
+         column: str = 'song_name'):
+    asyncio.run(run(host, port, n_clients, n_requests, column))
+
+
+if __name__ == '__main__':
+    main(*parse_args())
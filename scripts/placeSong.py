@@ -0,0 +1,50 @@
+import sys
+sys.path.append("..")
+
+import argparse
+import os
+from pathlib import Path
+from time import perf_counter
+
+from src.helpers.pipeline import PlacementPipeline
+
+EXTRACTED_DIR = '../data/extracted'
+MODELS_DIR = '../data/models'
+# Same file as user_cluster_dataset in src/notebooks/config.py
+USER_CLUSTER_DATASET = '../data/temp/user/cluster.pkl.bz2'
+
+
+def parse_args() -> tuple[str, str, str, str, str]:
+    parser = argparse.ArgumentParser(description='Place a new song among the clusters and songs of the library with '
+                                                 'a pipeline saved by fitPipeline.py.')
+    parser.add_argument('song_path')
+    parser.add_argument('--models-dir', default=MODELS_DIR)
+    parser.add_argument('--name', default='placement')
+    parser.add_argument('--output', default=USER_CLUSTER_DATASET)
+    parser.add_argument('--extracted-dir', default=EXTRACTED_DIR,
+                        help='library whose manifest the extraction parameters of the pipeline are checked against')
+    args = parser.parse_args()
+    return args.song_path, args.models_dir, args.name, args.output, args.extracted_dir
+
+
+def main(song_path: str, models_directory: str = MODELS_DIR, name: str = 'placement',
+         output_path: str = USER_CLUSTER_DATASET, extracted_directory: str = EXTRACTED_DIR):
+    start = perf_counter()
+    # Only the manifest of the library is read, not its features
+    pipeline = PlacementPipeline.load(models_directory, name,
+                                      extraction_params=PlacementPipeline.get_library_params(extracted_directory))
+    print(f'Loaded pipeline in {perf_counter() - start:.3f}s')
+
+    start = perf_counter()
+    placement = pipeline.place(song_path)
+    print(f'Placed {placement.name} in {perf_counter() - start:.2f}s')
+    print(f'Cluster {placement.cluster} with probability {placement.probabilities[placement.cluster]:.2f}')
+    print(placement.neighbours.to_string())
+
+    os.makedirs(Path(output_path).parent, exist_ok=True)
+    placement.to_dataframe().to_pickle(output_path, compression='bz2')
+    print(f'Saved placement to {output_path}')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
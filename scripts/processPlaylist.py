@@ -3,31 +3,63 @@ sys.path.append("..")
 
 import argparse
 import os
-from concurrent.futures import ProcessPoolExecutor, wait
+from time import perf_counter
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, Executor, Future, ProcessPoolExecutor, wait
 from pathlib import Path
 
 import pandas as pd
 
-from src.helpers.processors import AudioDataProcessor, FeatureVectorProcessor
-from src.helpers.repositories import AudioRepository, CompressIO, PandasAudioRepository
+from src.helpers.cache import AudioCache, FeatureCache, hash_file
+from src.helpers.encodings import TRAJECTORY_ENCODINGS, TrajectoryEncoding
+from src.helpers.manifest import TrackManifest
+from src.helpers.precision import PRECISION_POLICIES, PrecisionPolicy
+from src.helpers.processors import AudioDataProcessor, FeatureVectorProcessor, ModelRegistry, \
+    StreamingFeatureVectorProcessor
+from src.helpers.repositories import AudioRepository, ColumnarFeatureStore, CompressIO, PandasAudioRepository, \
+    ShardedDatasetWriter
 from src.models import AudioData, FeatureVector, FeatureRepresentation
 
+# Extracted features are cached here by audio content, so re-runs only extract new or changed tracks
+CACHE_DIR = '../data/cache/features'
+# Decoded waveforms are cached here when --audio-cache is passed, so parameter sweeps skip mp3 decoding
+AUDIO_CACHE_DIR = '../data/cache/audio'
 
-def parse_args() -> tuple[str, str, bool]:
+
+def parse_args() -> tuple[str, str, bool, bool, bool, bool, str, float, str]:
     parser = argparse.ArgumentParser()
     parser.add_argument('raw_dir')
     parser.add_argument('extracted_dir')
-    parser.add_argument('--store-repr', action=argparse.BooleanOptionalAction)
+    parser.add_argument('--store-repr', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=False,
+                        help='constant-memory extraction for long tracks, cannot store representations')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='reuse features of tracks extracted before with the same parameters')
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction, default=False,
+                        help='continue an interrupted run, skipping tracks that were already saved')
+    parser.add_argument('--precision', choices=PRECISION_POLICIES, default='full',
+                        help='store features in float32 and representations in float16 (compact) or 8 bits (quantized)')
+    parser.add_argument('--audio-cache', type=float, default=0, metavar='GIB',
+                        help='keep up to this many GiB of decoded audio for later runs, off by default')
+    parser.add_argument('--encoding', choices=TRAJECTORY_ENCODINGS, default='raw',
+                        help='also store compact trajectory encodings (encoded), or store only them (compact)')
     args = parser.parse_args()
-    return args['raw_dir'], args['extracted_dir'], args['--store-repr']
+    return args.raw_dir, args.extracted_dir, args.store_repr, args.stream, args.cache, args.resume, args.precision, \
+        args.audio_cache, args.encoding
 
 
 # Use environment variable DISABLE_CLI=1 to enable CLI input
-def prompt_args() -> tuple[str, str, bool]:
+def prompt_args() -> tuple[str, str, bool, bool, bool, bool, str, float, str]:
     raw = input('Raw playlist directory: ')
     extracted = input('Extracted playlist directory: ')
     store_repr = input('Store representations? y/n: ')
-    return raw, extracted, store_repr.lower() == 'y'
+    stream = input('Stream long tracks in constant memory? y/n: ')
+    cache = input('Reuse cached features? y/n: ')
+    resume = input('Resume an interrupted run? y/n: ')
+    precision = input(f'Precision {"/".join(PRECISION_POLICIES)}: ')
+    audio_cache = input('GiB of decoded audio to cache, 0 to disable: ')
+    encoding = input(f'Trajectory encoding {"/".join(TRAJECTORY_ENCODINGS)}: ')
+    return raw, extracted, store_repr.lower() == 'y', stream.lower() == 'y', cache.lower() == 'y', \
+        resume.lower() == 'y', precision.lower() or 'full', float(audio_cache or 0), encoding.lower() or 'raw'
 
 
 def get_args():
@@ -42,6 +74,13 @@ def create_directory(directory):
         os.makedirs(directory)
 
 
+# Runs once per worker, so each process loads the madmom networks once instead of once per track
+def warm_up_worker():
+    start = perf_counter()
+    ModelRegistry.warm_up()
+    print(f'Loaded models in process {os.getpid()} in {perf_counter() - start:.2f}s')
+
+
 def process(directory: str, audio_data: AudioData):
     print(f'Processing {audio_data.name}')
     processed = FeatureVectorProcessor(audio_data).process()
@@ -57,6 +96,61 @@ def process_without_saving(audio_data: AudioData, save_repr: bool):
     return processed_audio
 
 
+# Decodes and extracts inside the worker, only the small FeatureVector is sent back to the parent
+def extract_one(audio_file: str, save_repr: bool, precision: PrecisionPolicy, encoding: TrajectoryEncoding,
+                audio_cache: AudioCache = None):
+    audio_data = AudioDataProcessor.load_one(audio_file, audio_cache=audio_cache)
+    print(f'Processing {audio_data.name}')
+    vector, feature_repr = FeatureVectorProcessor(audio_data, save_repr, precision=precision,
+                                                  encoding=encoding).process()
+    vector.audio.waveform = None
+    print(f'Done Processing {audio_data.name}')
+    return vector, feature_repr if save_repr else None
+
+
+def extract_one_streaming(audio_file: str, save_repr: bool, precision: PrecisionPolicy,
+                          encoding: TrajectoryEncoding, audio_cache: AudioCache = None):
+    name = Path(audio_file).stem
+    print(f'Processing {name}')
+    vector = StreamingFeatureVectorProcessor(audio_file, precision=precision, encoding=encoding).process()
+    print(f'Done Processing {name}')
+    return vector, None
+
+
+# Like Executor.map, but never submits more than max_in_flight items at once, and an item that fails does not
+# stop the others. Yields (item, result, error) in completion order, error is None unless the item failed.
+def map_bounded(ec: Executor, function, items: list, max_in_flight: int, *args):
+    in_flight = {}
+    for item in items:
+        if len(in_flight) >= max_in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            yield from (get_outcome(in_flight.pop(future), future) for future in done)
+        in_flight[ec.submit(function, item, *args)] = item
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        yield from (get_outcome(in_flight.pop(future), future) for future in done)
+
+
+def get_outcome(item, future: Future):
+    error = future.exception()
+    return item, (future.result() if error is None else None), error
+
+
+def load_cached(cache: FeatureCache, audio_files: list[str], save_repr: bool):
+    if cache is None or save_repr:
+        return [], audio_files
+
+    cached, uncached = [], []
+    for audio_file in audio_files:
+        vector = cache.load(audio_file)
+        if vector is None:
+            uncached.append(audio_file)
+        else:
+            cached.append((audio_file, vector))
+    print(f'Found {len(cached)} cached tracks, extracting {len(uncached)}')
+    return cached, uncached
+
+
 def load_raw_audio(raw_directory: str, limit: int = 0):
     print(f'Loading audio...')
     raw_audio_handler = AudioDataProcessor(raw_directory, limit=limit)
@@ -83,35 +177,95 @@ def save_repr_as_pickle(feature_repr: FeatureRepresentation, directory: str):
     print(f'Saved repr as pickle for {Path(directory).name}')
 
 
-def main(raw_directory: str, extracted_directory: str, save_repr: bool = False):
-    print(raw_directory, extracted_directory, save_repr)
-    raw_audio = load_raw_audio(raw_directory)
+def main(raw_directory: str, extracted_directory: str, save_repr: bool = False, stream: bool = False,
+         use_cache: bool = True, resume: bool = False, precision: str = 'full', audio_cache_gib: float = 0,
+         encoding: str = 'raw', batch_size: int = 10):
+    print(raw_directory, extracted_directory, save_repr, stream, use_cache, resume, precision, audio_cache_gib,
+          encoding)
+    if stream and save_repr:
+        raise ValueError('Representations cannot be stored in streaming mode')
+    precision_policy = PRECISION_POLICIES[precision]
+    trajectory_encoding = TRAJECTORY_ENCODINGS[encoding]
+
+    audio_files = AudioDataProcessor(raw_directory).audio_files
     create_directory(extracted_directory)
-    with ProcessPoolExecutor() as ec:
-        processed_audio = list(ec.map(
-            process_without_saving,
-            raw_audio,
-            [save_repr for _ in range(len(raw_audio))]
-        ))
+
+    # Results are flushed to disk in batches instead of being held until the end
+    writer = ShardedDatasetWriter(extracted_directory, batch_size=batch_size, resume=resume)
+    pending_files = [audio_file for audio_file in audio_files
+                     if not writer.is_completed(audio_file) and not writer.is_failed(audio_file)]
+    if resume:
+        print(f'Resuming, {len(writer.completed)} tracks already done, skipping {len(writer.failed)} failed tracks')
+
+    # Streaming results differ slightly, so they are cached separately
+    extraction_params = FeatureVectorProcessor.get_extraction_params(precision=precision_policy,
+                                                                     encoding=trajectory_encoding) | {'stream': stream}
+    cache = FeatureCache(CACHE_DIR, extraction_params) if use_cache else None
+    cached, uncached_files = load_cached(cache, pending_files, save_repr)
+    # Streaming reads the mp3 block by block, so there is no decoded waveform to cache
+    audio_cache = AudioCache(AUDIO_CACHE_DIR, max_bytes=int(audio_cache_gib * 2 ** 30)) \
+        if audio_cache_gib > 0 and not stream else None
+    if audio_cache is not None:
+        audio_cache.index(uncached_files)
+    for audio_file, vector in cached:
+        writer.append(audio_file, vector)
+
+    # Each worker holds one track, plus a couple queued so that no worker sits idle
+    max_workers = os.cpu_count() or 1
+    failed_files = []
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=warm_up_worker) as ec:
+            for audio_file, result, error in map_bounded(
+                    ec,
+                    extract_one_streaming if stream else extract_one,
+                    uncached_files,
+                    max_workers + 2,
+                    save_repr,
+                    precision_policy,
+                    trajectory_encoding,
+                    audio_cache
+            ):
+                if error is not None:
+                    print(f'Failed {Path(audio_file).stem}: {error!r}')
+                    failed_files.append(audio_file)
+                    # A broken pool fails every track still queued, those are left for --resume to redo
+                    if not isinstance(error, BrokenExecutor):
+                        writer.record_failure(audio_file, error)
+                    continue
+                vector, feature_repr = result
+                if cache is not None:
+                    cache.store(audio_file, vector)
+                writer.append(audio_file, vector, feature_repr)
+    finally:
+        # Keep whatever finished before a failure, so --resume only redoes the rest
+        writer.flush()
+        if cache is not None:
+            cache.save()
+    if failed_files:
+        print(f'Failed to extract {len(failed_files)} tracks, they are left out of the dataset:')
+        print('\n'.join(f'- {Path(audio_file).stem}' for audio_file in failed_files))
     print(f'Saving datasets...')
-    if save_repr:
-        PandasAudioRepository.store_datasets(
-            extracted_directory,
-            processed_audio
-        )
-    else:
-        PandasAudioRepository.store_feature_dataset(
-            extracted_directory,
-            Path(extracted_directory).name,
-            [v for v, _ in processed_audio]
-        )
+    name = Path(extracted_directory).name
+    saved_files = writer.compact(name, save_repr)
     print(f'Saved datasets')
 
+    # The manifest sits next to the playlist folders and indexes the whole extracted library
+    manifest = TrackManifest(str(TrackManifest.get_path(str(Path(extracted_directory).parent))))
+    manifest.register_playlist(
+        name,
+        str(ColumnarFeatureStore.get_path(extracted_directory, name)),
+        [Path(audio_file).stem for audio_file in saved_files],
+        [cache.hash_index.get_hash(f) if cache is not None else hash_file(f) for f in saved_files],
+        extraction_params
+    )
+    manifest.close()
+    print(f'Indexed {len(saved_files)} tracks in {manifest.path}')
+
 
 def main_old(raw_directory: str, extracted_directory: str, save_repr: bool):
     raw_audio = load_raw_audio(raw_directory)
     create_directory(extracted_directory)
-    with ProcessPoolExecutor() as ec:
+    with ProcessPoolExecutor(initializer=warm_up_worker) as ec:
         futures = [ec.submit(process, extracted_directory, audio_data) for audio_data in raw_audio]
         wait(futures)
 
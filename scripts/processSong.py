@@ -0,0 +1,51 @@
+import sys
+sys.path.append("..")
+
+import argparse
+import os
+from pathlib import Path
+from time import perf_counter
+
+import pandas as pd
+
+from src.helpers.processors import AudioDataProcessor, FeatureVectorProcessor, ModelRegistry
+
+# Same file as user_feature in src/notebooks/config.py
+USER_FEATURE = '../data/temp/user/feature.pkl.bz2'
+
+
+def parse_args() -> tuple[str, str]:
+    parser = argparse.ArgumentParser(description='Extract features of a single song as fast as possible.')
+    parser.add_argument('song_path')
+    parser.add_argument('--output', default=USER_FEATURE)
+    args = parser.parse_args()
+    return args.song_path, args.output
+
+
+def print_timings(step_timings: dict[str, float]):
+    for name, seconds in sorted(step_timings.items(), key=lambda item: -item[1]):
+        print(f'{seconds:8.3f}s  {name}')
+
+
+def main(song_path: str, output_path: str = USER_FEATURE):
+    start = perf_counter()
+    ModelRegistry.warm_up()
+    print(f'Loaded models in {perf_counter() - start:.2f}s')
+
+    start = perf_counter()
+    audio_data = AudioDataProcessor.load_one(song_path, playlist='user')
+    print(f'Loaded {audio_data.name} in {perf_counter() - start:.2f}s')
+
+    start = perf_counter()
+    processor = FeatureVectorProcessor(audio_data)
+    vector, _ = processor.process_concurrently()
+    print(f'Extracted features in {perf_counter() - start:.2f}s')
+    print_timings(processor.step_timings)
+
+    os.makedirs(Path(output_path).parent, exist_ok=True)
+    pd.DataFrame([vector.as_dict()]).to_pickle(output_path, compression='bz2')
+    print(f'Saved features to {output_path}')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
@@ -0,0 +1,122 @@
+import sys
+sys.path.append("..")
+
+import argparse
+import ast
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+
+import pandas as pd
+
+from src.helpers.constants import METADATA_COLUMNS
+from src.helpers.encodings import TRAJECTORY_ENCODINGS
+from src.helpers.manifest import TrackManifest
+from src.helpers.processors import AudioDataProcessor, FeatureVectorProcessor
+from src.helpers.repositories import ColumnarFeatureStore, PandasAudioRepository
+from src.models import AudioData
+
+
+def parse_args() -> tuple[str, str, list[str], dict]:
+    parser = argparse.ArgumentParser(description='Recompute some feature columns of an extracted playlist in place.')
+    parser.add_argument('raw_dir')
+    parser.add_argument('extracted_dir')
+    parser.add_argument('features', nargs='+', help='columns or extraction steps, e.g. mfcc tonnetz bpm')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='FeatureVectorProcessor parameter to change from the ones the playlist was extracted '
+                             'with, e.g. --param n_mfcc=20')
+    parser.add_argument('--encoding', choices=TRAJECTORY_ENCODINGS, default=None,
+                        help='trajectory encoding to re-extract note_trajectory and chord_trajectory with')
+    args = parser.parse_args()
+    params = {name: ast.literal_eval(value) for name, _, value in (p.partition('=') for p in args.param)}
+    if args.encoding is not None:
+        params['encoding'] = TRAJECTORY_ENCODINGS[args.encoding]
+    return args.raw_dir, args.extracted_dir, args.features, params
+
+
+def load_dataset(extracted_directory: str) -> pd.DataFrame:
+    name = Path(extracted_directory).name
+    paths = PandasAudioRepository.get_feature_paths(str(Path(extracted_directory).parent), [name])
+    if not paths:
+        raise FileNotFoundError(f'No extracted dataset for {name}')
+    if Path(paths[0]).is_dir():
+        return ColumnarFeatureStore(paths[0]).load()
+    return PandasAudioRepository.load_pickled_dataset(paths[0])
+
+
+# Dataset rows only keep the first artist and the song name, which is matched against the names of the raw files
+def match_audio_files(raw_directory: str, dataset: pd.DataFrame) -> list[str]:
+    audio_files = {}
+    for audio_file in AudioDataProcessor(raw_directory).audio_files:
+        metadata = AudioData(name=Path(audio_file).stem).as_dict()
+        audio_files.setdefault((metadata['artist'], metadata['song_name']), audio_file)
+
+    keys = list(zip(dataset['artist'], dataset['song_name']))
+    missing = [f'{artist} - {song_name}' for artist, song_name in keys if (artist, song_name) not in audio_files]
+    if missing:
+        raise FileNotFoundError(f'No raw audio for: {missing}')
+    return [audio_files[key] for key in keys]
+
+
+# Every column the steps produced, which includes trajectory encodings when the encoding parameter asks for them
+def reextract_one(audio_file: str, steps: list[str], params: dict) -> dict:
+    audio_data = AudioDataProcessor.load_one(audio_file)
+    print(f'Processing {audio_data.name}')
+    vector, _ = FeatureVectorProcessor(audio_data, **params).process(steps)
+    print(f'Done Processing {audio_data.name}')
+    return {column: value for column, value in vector.as_dict().items()
+            if column not in METADATA_COLUMNS and FeatureVectorProcessor.get_column_step(column) in steps}
+
+
+# Parameters the playlist was extracted with according to the manifest, e.g. its precision and encoding
+def load_playlist_params(extracted_directory: str, name: str) -> dict:
+    manifest_path = TrackManifest.get_path(str(Path(extracted_directory).parent))
+    stored_params = None
+    if manifest_path.exists():
+        manifest = TrackManifest(str(manifest_path))
+        stored_params = manifest.get_playlist_params(name)
+        manifest.close()
+    if stored_params is None:
+        print(f'No extraction parameters recorded for {name}, assuming the defaults')
+        return FeatureVectorProcessor.get_extraction_params()
+    return FeatureVectorProcessor.decode_extraction_params(stored_params)
+
+
+# params only override the parameters the playlist was extracted with, everything else is extracted the same way
+def main(raw_directory: str, extracted_directory: str, features: list[str], params: dict = None):
+    name = Path(extracted_directory).name
+    overrides = params if params is not None else {}
+    params = load_playlist_params(extracted_directory, name) | overrides
+
+    # Every column of the requested steps is replaced, the steps they depend on are recomputed but not stored
+    steps = sorted({FeatureVectorProcessor.get_column_step(feature) for feature in features})
+    print(f'Re-extracting {", ".join(steps)} with {overrides or "the parameters the playlist was extracted with"}')
+
+    dataset = load_dataset(extracted_directory)
+    audio_files = match_audio_files(raw_directory, dataset)
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ec:
+        results = list(ec.map(reextract_one, audio_files, repeat(steps), repeat(params)))
+
+    # Columns of these steps that were not produced again, e.g. encodings of an earlier run, would be stale
+    columns = list(dict.fromkeys(column for result in results for column in result))
+    stale = [c for c in dataset.columns if c not in METADATA_COLUMNS and c not in columns
+             and FeatureVectorProcessor.get_column_step(c) in steps]
+    if stale:
+        raise ValueError(f'Re-extracting did not produce {stale} of the playlist, '
+                         f'use --encoding or --param to extract them again, nothing was saved')
+    for column in columns:
+        dataset[column] = [result[column] for result in results]
+    ColumnarFeatureStore.write(extracted_directory, name, dataset)
+    print(f'Saved {len(columns)} columns of {len(dataset)} songs')
+
+    manifest_path = TrackManifest.get_path(str(Path(extracted_directory).parent))
+    if manifest_path.exists():
+        manifest = TrackManifest(str(manifest_path))
+        manifest.update_extraction_params(name, params)
+        manifest.close()
+
+
+if __name__ == '__main__':
+    main(*parse_args())
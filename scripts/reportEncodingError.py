@@ -0,0 +1,71 @@
+import sys
+sys.path.append("..")
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+from scipy.spatial.distance import pdist
+from sklearn.decomposition import PCA
+
+from src.helpers.distances import minmax_scale_rows, sparse_pdist, stack_trajectories
+from src.helpers.encodings import ENCODED_TRAJECTORIES, TrajectoryEncoding, get_distortion_bound
+from src.helpers.repositories import PandasAudioRepository
+
+EXTRACTED_DIR = '../data/extracted'
+
+
+def parse_args() -> tuple[str, list[int], int]:
+    parser = argparse.ArgumentParser(description='Report the size of compact trajectory encodings, how long distances '
+                                                 'and PCA take on them, and how well the projection keeps distances.')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--components', type=int, nargs='+', default=[128, 256, 512, 1024, 2048])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    return args.extracted_dir, args.components, args.seed
+
+
+def time_one(function, *args) -> float:
+    start = perf_counter()
+    function(*args)
+    return perf_counter() - start
+
+
+def report_sizes(dataset):
+    encoded = ENCODED_TRAJECTORIES.apply_dataset(dataset)
+    note_trajectories = minmax_scale_rows(stack_trajectories(dataset['note_trajectory']))
+    print(f'Songs: {len(dataset)}')
+    print(f'  {"column":<32} {"values":>7} {"pdist":>9} {"pca":>9}')
+    dense = note_trajectories.toarray()
+    print(f'  {"note_trajectory (dense)":<32} {dense.shape[1]:7d} {time_one(pdist, dense):8.4f}s '
+          f'{time_one(PCA(n_components=2).fit_transform, dense):8.4f}s')
+    print(f'  {"note_trajectory (sparse)":<32} {dense.shape[1]:7d} {time_one(sparse_pdist, note_trajectories):8.4f}s')
+    for column in [c for c in encoded.columns if c not in dataset.columns]:
+        matrix = np.stack(encoded[column].tolist()).astype(np.float64)
+        print(f'  {column:<32} {matrix.shape[1]:7d} {time_one(pdist, matrix):8.4f}s '
+              f'{time_one(PCA(n_components=2).fit_transform, matrix):8.4f}s')
+
+
+# Ratios of projected to original squared distances between distinct songs, against the Johnson-Lindenstrauss bound
+def report_distortion(dataset, components: list[int], seed: int):
+    distances = sparse_pdist(minmax_scale_rows(stack_trajectories(dataset['note_trajectory'])))
+    distinct = distances > 0
+    print(f'\nProjection of {len(dataset)} songs, squared distance ratios')
+    for n_components in components:
+        encoding = TrajectoryEncoding(encodings=('projection',), n_components=n_components, seed=seed)
+        projections = np.stack(encoding.apply_dataset(dataset)['note_trajectory_projection'].tolist())
+        ratios = pdist(projections)[distinct] ** 2 / distances[distinct] ** 2
+        bound = get_distortion_bound(n_components, len(dataset))
+        print(f'  {n_components:5d} components: {ratios.min():.3f} to {ratios.max():.3f}, '
+              f'99th percentile error {np.percentile(np.abs(ratios - 1), 99):.3f}, bound 1 +- {bound:.3f}')
+
+
+def main(extracted_directory: str, components: list[int] = None, seed: int = 0):
+    dataset = PandasAudioRepository.load_all_feature_datasets(extracted_directory,
+                                                              columns=['note_trajectory', 'chord_trajectory'])
+    report_sizes(dataset)
+    report_distortion(dataset, components or [128, 256, 512, 1024, 2048], seed)
+
+
+if __name__ == '__main__':
+    main(*parse_args())
@@ -0,0 +1,170 @@
+import sys
+sys.path.append("..")
+
+import argparse
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import procrustes
+from scipy.spatial.distance import pdist, squareform
+from sklearn.decomposition import PCA
+from sklearn.manifold import MDS
+from sklearn.preprocessing import StandardScaler
+
+from src.helpers.constants import METADATA_COLUMNS, TRAJECTORY_FEATURES
+from src.helpers.distances import minmax_scale_rows, sparse_pdist, stack_trajectories
+from src.helpers.precision import PRECISION_POLICIES, PrecisionPolicy, QuantizedArray, decode
+from src.helpers.processors import AudioDataProcessor, FeatureVectorProcessor
+from src.helpers.repositories import ColumnarFeatureStore, PandasAudioRepository, RepresentationStore, \
+    stack_array_column
+
+EXTRACTED_DIR = '../data/extracted'
+
+
+def parse_args() -> tuple[str, str, int]:
+    parser = argparse.ArgumentParser(description='Report how much precision policies change stored sizes and the '
+                                                 'MDS and PCA results computed from the features.')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--raw', default=None,
+                        help='playlist to extract a few songs of in float64, as the reference for the feature errors '
+                             'and for the size report of representations')
+    parser.add_argument('--limit', type=int, default=3)
+    args = parser.parse_args()
+    return args.extracted_dir, args.raw, args.limit
+
+
+def get_directory_size(directory: str) -> int:
+    return sum(path.stat().st_size for path in Path(directory).rglob('*') if path.is_file())
+
+
+def get_nbytes(value) -> int:
+    if value is None:
+        return 0
+    return value.nbytes if hasattr(value, 'nbytes') else np.asarray(value).nbytes
+
+
+# Float columns that are still stored in float64. Columns already stored in float32, e.g. by an earlier
+# --precision compact run, have nothing to compare against, and trajectories are integer counts.
+def get_float64_columns(dataset: pd.DataFrame) -> list[str]:
+    return [column for column in dataset.columns
+            if column not in METADATA_COLUMNS and column not in TRAJECTORY_FEATURES
+            and (dataset[column].dtype == np.float64 if dataset[column].dtype != object
+                 else all(np.asarray(value).dtype == np.float64 for value in dataset[column]))]
+
+
+# The same steps as the notebooks over the given float columns, every embedding is returned so policies can be
+# compared
+def embed(dataset: pd.DataFrame, columns: list[str]) -> dict[str, np.ndarray]:
+    note_trajectories = stack_trajectories(dataset['note_trajectory'])
+    chord_trajectories = stack_trajectories(dataset['chord_trajectory'])
+    scalars = dataset[[c for c in columns if c != 'tonnetz']].astype(np.float64)
+
+    distances = {
+        'note': sparse_pdist(minmax_scale_rows(note_trajectories), 'euclidean'),
+        'chord': sparse_pdist(minmax_scale_rows(chord_trajectories), 'euclidean')
+    }
+    if 'tonnetz' in columns:
+        distances['tonnetz'] = pdist(stack_array_column(dataset, 'tonnetz').astype(np.float64), 'euclidean')
+    embeddings = {
+        f'{name} mds': MDS(n_components=2, dissimilarity='precomputed', normalized_stress=False, random_state=0)
+        .fit_transform(squareform(condensed))
+        for name, condensed in distances.items()
+    }
+    if scalars.shape[1] >= 2:
+        embeddings['scalar pca'] = PCA(n_components=2).fit_transform(StandardScaler().fit_transform(scalars))
+    return embeddings | {f'{name} distances': condensed for name, condensed in distances.items()}
+
+
+# Largest error of any value of the columns relative to the largest value of its column, and that column
+def get_column_error(reference: pd.DataFrame, compact: pd.DataFrame, columns: list[str]) -> tuple[float, str]:
+    errors = {}
+    for column in columns:
+        expected = stack_array_column(reference, column).astype(np.float64)
+        actual = stack_array_column(compact, column).astype(np.float64)
+        errors[column] = np.max(np.abs(actual - expected)) / (np.max(np.abs(expected)) or 1.0)
+    worst = max(errors, key=errors.get)
+    return errors[worst], worst
+
+
+def report_features(extracted_directory: str):
+    dataset = PandasAudioRepository.load_all_feature_datasets(extracted_directory)
+    print(f'Songs: {len(dataset)}')
+    # Only columns still stored in float64 are a reference for the errors of the policies
+    columns = get_float64_columns(dataset)
+    skipped = [c for c in dataset.columns if c not in METADATA_COLUMNS and c not in TRAJECTORY_FEATURES
+               and c not in columns]
+    print(f'Errors are over the {len(columns)} columns stored in float64')
+    if skipped:
+        print(f'Left out {len(skipped)} columns already stored in lower precision: {", ".join(skipped)}')
+    if not columns:
+        print('Pass --raw to compare against songs extracted again in float64')
+        return
+    reference = embed(dataset, columns)
+
+    for policy_name, policy in PRECISION_POLICIES.items():
+        compact = policy.apply_dataset(dataset)
+        with tempfile.TemporaryDirectory() as directory:
+            reference_size = get_directory_size(ColumnarFeatureStore.write(directory, 'full', dataset).path)
+            compact_size = get_directory_size(ColumnarFeatureStore.write(directory, policy_name, compact).path)
+
+        print(f'\n{policy_name}: features {reference_size / 2 ** 10:.0f} KiB -> {compact_size / 2 ** 10:.0f} KiB')
+        error, column = get_column_error(dataset, compact, columns)
+        print(f'  {"columns":<18} max relative error {error:.2e} ({column})')
+        for name, result in embed(compact, columns).items():
+            # Distances are compared directly, embeddings after aligning them as MDS and PCA are only
+            # unique up to rotation and reflection
+            if name.endswith('distances'):
+                error = np.max(np.abs(result - reference[name])) / np.max(reference[name])
+                print(f'  {name:<18} max relative error {error:.2e}')
+            else:
+                _, _, disparity = procrustes(reference[name], result)
+                print(f'  {name:<18} procrustes disparity {disparity:.2e}')
+
+
+# Songs extracted again in float64 are a reference for every column, whatever precision the datasets are in
+def report_extracted(raw_directory: str, limit: int):
+    audio_files = AudioDataProcessor(raw_directory).audio_files[:limit]
+    results = [FeatureVectorProcessor(AudioDataProcessor.load_one(audio_file), save_repr=True).process()
+               for audio_file in audio_files]
+    vectors = [vector for vector, _ in results]
+    dataset = pd.DataFrame([vector.as_dict() for vector in vectors])
+    columns = get_float64_columns(dataset)
+    print(f'\nFeatures of {len(vectors)} songs extracted in float64, over all {len(columns)} float columns')
+    for policy_name, policy in PRECISION_POLICIES.items():
+        compact = pd.DataFrame([policy.apply_vector(vector).as_dict() for vector in vectors])
+        error, column = get_column_error(dataset, compact, columns)
+        print(f'  {policy_name:<10} max relative error {error:.2e} ({column})')
+
+    report_representations(audio_files, [feature_repr for _, feature_repr in results])
+
+
+def report_representations(audio_files: list[str], representations: list):
+    metadata = pd.DataFrame([{'song_name': Path(f).stem, 'artist': '', 'playlist': ''} for f in audio_files])
+    print(f'\nRepresentations of {len(representations)} songs')
+
+    reference_memory = sum(get_nbytes(v) for r in representations for v in vars(r).values())
+    for policy_name, policy in PRECISION_POLICIES.items():
+        compact = [policy.apply_representation(r) for r in representations]
+        memory = sum(get_nbytes(v) for r in compact for v in vars(r).values())
+        with tempfile.TemporaryDirectory() as directory:
+            disk = get_directory_size(RepresentationStore.write(directory, policy_name, metadata, compact).path)
+
+        spectrogram_error = max(
+            np.max(np.abs(decode(c.spectrogram).astype(np.float64) - r.spectrogram))
+            for c, r in zip(compact, representations)
+        )
+        print(f'  {policy_name:<10} memory {memory / 2 ** 20:7.1f} MiB ({reference_memory / memory:4.1f}x smaller), '
+              f'disk {disk / 2 ** 20:6.1f} MiB, spectrogram max error {spectrogram_error:.3f} dB')
+
+
+def main(extracted_directory: str, raw_directory: str = None, limit: int = 3):
+    report_features(extracted_directory)
+    if raw_directory is not None:
+        report_extracted(raw_directory, limit)
+
+
+if __name__ == '__main__':
+    main(*parse_args())
@@ -0,0 +1,79 @@
+import sys
+sys.path.append("..")
+
+import argparse
+import asyncio
+from pathlib import Path
+from time import perf_counter
+
+import pandas as pd
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+
+from src.helpers.query import AbstractNeighbourIndex, ExactIndex, IVFIndex, NearestNeighboursQuery
+from src.helpers.repositories import PandasAudioRepository
+from src.helpers.service import RecommendationService
+
+EXTRACTED_DIR = '../data/extracted'
+
+
+def parse_args() -> tuple[str, int, str, str, str, int, int, int, float]:
+    parser = argparse.ArgumentParser(description='Serve song recommendations from the extracted library over HTTP '
+                                                 'on localhost, with the index kept in memory.')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--components', type=int, default=10, help='PCA components, all scalar features if 0')
+    parser.add_argument('--index', choices=['exact', 'ivf'], default='exact')
+    parser.add_argument('--index-path', default=None,
+                        help='load the index from this .pkl.zst file, or build it and save it there')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--neighbours', type=int, default=6)
+    parser.add_argument('--max-batch', type=int, default=64, help='1 answers every request on its own')
+    parser.add_argument('--max-delay-ms', type=float, default=2.0,
+                        help='how long the first request of a batch waits for more')
+    args = parser.parse_args()
+    return (args.extracted_dir, args.components, args.index, args.index_path, args.host, args.port,
+            args.neighbours, args.max_batch, args.max_delay_ms)
+
+
+# Standardised scalar features reduced with PCA, the space the notebooks search in
+def load_coordinates(extracted_directory: str, n_components: int) -> tuple[pd.DataFrame, pd.DataFrame]:
+    features = PandasAudioRepository.load_feature_matrix(extracted_directory)
+    points = StandardScaler().fit_transform(features.scalars)
+    if n_components:
+        # Seeded, so the coordinates match the fingerprint of a saved index from one start to the next
+        points = PCA(n_components=n_components, random_state=0).fit_transform(points)
+    return pd.DataFrame(points), features.metadata.reset_index(drop=True)
+
+
+def load_index(index_type: str, index_path: str = None) -> AbstractNeighbourIndex:
+    if index_path and Path(index_path).exists():
+        return AbstractNeighbourIndex.load(index_path)
+    return IVFIndex() if index_type == 'ivf' else ExactIndex()
+
+
+def main(extracted_directory: str, n_components: int = 10, index_type: str = 'exact', index_path: str = None,
+         host: str = '127.0.0.1', port: int = 8080, neighbours: int = 6, max_batch_size: int = 64,
+         max_delay_ms: float = 2.0):
+    start = perf_counter()
+    coordinates, metadata = load_coordinates(extracted_directory, n_components)
+    index = load_index(index_type, index_path)
+    fingerprint = index.fingerprint
+    query = NearestNeighboursQuery(coordinates, metadata, neighbours, index)
+    # A new index, or a saved one that was rebuilt because the library changed
+    if index_path and index.fingerprint != fingerprint:
+        Path(index_path).parent.mkdir(parents=True, exist_ok=True)
+        index.save(index_path.removesuffix('.pkl.zst'))
+        print(f'Saved the index to {index_path}')
+    print(f'{len(metadata)} songs loaded with a {type(index).__name__} in {perf_counter() - start:.2f}s')
+
+    service = RecommendationService(query, max_batch_size, max_delay_ms / 1e3)
+    print(f'Serving on http://{host}:{port}, e.g. /recommend?q=<song name>&by=song_name, /stats')
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(*parse_args())
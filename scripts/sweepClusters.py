@@ -0,0 +1,83 @@
+import sys
+sys.path.append("..")
+
+import argparse
+from pathlib import Path
+from time import perf_counter
+
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+
+from src.helpers.clustering import COVARIANCE_TYPES, GMMSweep
+from src.helpers.repositories import PandasAudioRepository
+
+EXTRACTED_DIR = '../data/extracted'
+CACHE_DIR = '../data/cache/gmm'
+
+
+def parse_args() -> tuple[str, int, int, list[str], int, bool, int, int, str, str]:
+    parser = argparse.ArgumentParser(description='Fit Gaussian Mixture Models over a grid of component counts, '
+                                                 'covariance types and seeds, and report their AIC and BIC.')
+    parser.add_argument('extracted_dir', nargs='?', default=EXTRACTED_DIR)
+    parser.add_argument('--components', type=int, default=10, help='PCA components, n_pca_components in config.py')
+    parser.add_argument('--max-clusters', type=int, default=14)
+    parser.add_argument('--covariance-types', nargs='+', choices=COVARIANCE_TYPES, default=['full'])
+    parser.add_argument('--seeds', type=int, default=1, help='seeds 0 to n - 1')
+    parser.add_argument('--warm-start', action=argparse.BooleanOptionalAction, default=False,
+                        help='start each fit from the previous one, only covariance types and seeds run in parallel')
+    parser.add_argument('--patience', type=int, default=3, help='stop a chain this many fits past its BIC minimum, '
+                                                                'never if 0')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--figures', default=None, help='write aic.png and bic.png to this folder')
+    args = parser.parse_args()
+    return (args.extracted_dir, args.components, args.max_clusters, args.covariance_types, args.seeds,
+            args.warm_start, args.patience, args.workers, args.cache_dir, args.figures)
+
+
+# AIC and BIC curves like figures/3-clustering, one line per covariance type averaged over seeds
+def write_figures(summary, directory: str):
+    import plotly.express as px
+
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for criterion in ['aic', 'bic']:
+        curves = summary[['covariance_type', 'n_components']].assign(score=summary[(criterion, 'mean')])
+        fig = px.line(curves, x='n_components', y='score', color='covariance_type',
+                      title=f'{criterion.upper()} Score of GMM Clustering')
+        fig.write_image(str(Path(directory, f'{criterion}.png')), width=1000, scale=2)
+
+
+def main(extracted_directory: str, n_pca_components: int = 10, max_clusters: int = 14,
+         covariance_types: list[str] = ('full',), n_seeds: int = 1, warm_start: bool = False, patience: int = 3,
+         max_workers: int = None, cache_directory: str = CACHE_DIR, figures_directory: str = None):
+    features = PandasAudioRepository.load_feature_matrix(extracted_directory)
+    # Seeded, so the same library gives the same matrix and the sweep is read back from the cache
+    matrix = PCA(n_components=n_pca_components, random_state=0) \
+        .fit_transform(StandardScaler().fit_transform(features.scalars))
+
+    sweep = GMMSweep(
+        n_components=range(1, max_clusters + 1),
+        covariance_types=covariance_types,
+        seeds=range(n_seeds),
+        warm_start=warm_start,
+        patience=patience,
+        max_workers=max_workers,
+        cache_directory=cache_directory
+    )
+    cache_path = sweep.get_cache_path(matrix)
+    cached = cache_path is not None and cache_path.exists()
+    start = perf_counter()
+    results = sweep.run(matrix)
+    print(f'{len(results)} fits {"read from cache" if cached else "run"} in {perf_counter() - start:.2f}s')
+
+    summary = GMMSweep.summarise(results)
+    print(summary.to_string(index=False))
+    covariance_type, n_components = GMMSweep.best(results)
+    print(f'Lowest mean BIC: {n_components} components with {covariance_type} covariance')
+    if figures_directory:
+        write_figures(summary, figures_directory)
+        print(f'Saved aic.png and bic.png to {figures_directory}')
+
+
+if __name__ == '__main__':
+    main(*parse_args())
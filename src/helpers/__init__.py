@@ -1,5 +1,14 @@
+from .cache import *
+from .clustering import *
 from .constants import *
+from .distances import *
+from .embedding import *
+from .encodings import *
+from .manifest import *
+from .pipeline import *
+from .precision import *
 from .processors import *
 from .query import *
 from .repositories import *
+from .service import *
 from .visualisation import *
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Optional
+from uuid import uuid4
+
+import numpy as np
+
+from src.models import *
+
+# Bump whenever a change to extraction alters feature values, so stale cache entries are never reused
+# 2: streaming extraction holds back the trailing spectral flux frames of each block and merges short tail windows
+FEATURE_CACHE_VERSION = 2
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_params(params: dict) -> str:
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def hash_matrix(matrix: np.ndarray) -> str:
+    matrix = np.ascontiguousarray(matrix)
+    digest = hashlib.sha256(f'{matrix.shape}{matrix.dtype}'.encode())
+    digest.update(matrix.tobytes())
+    return digest.hexdigest()[:16]
+
+
+# Remembers file hashes by path, size and modification time so unchanged files are not read again
+class FileHashIndex:
+    path: Path
+    entries: dict
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.entries = json.loads(self.path.read_text()) if self.path.exists() else {}
+
+    def get_hash(self, audio_file: str) -> str:
+        stat = os.stat(audio_file)
+        key = str(Path(audio_file).resolve())
+        entry = self.entries.get(key)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['hash']
+
+        file_hash = hash_file(audio_file)
+        self.entries[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash}
+        return file_hash
+
+    # Entries saved by another index since this one was read are kept. Saves are not locked, so only one process
+    # should save at a time, e.g. the parent once it has hashed the files its workers will use.
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        entries = json.loads(self.path.read_text()) if self.path.exists() else {}
+        self.entries = entries | self.entries
+        temp_path = Path(self.path.parent, f'{self.path.name}.{os.getpid()}.{uuid4().hex}.tmp')
+        temp_path.write_text(json.dumps(self.entries))
+        os.replace(temp_path, self.path)
+
+
+# Content-addressed store of extracted FeatureVectors, keyed by audio file hash and extraction parameters
+class FeatureCache:
+    directory: Path
+    params_hash: str
+    hash_index: FileHashIndex
+
+    def __init__(self, directory: str, extraction_params: dict):
+        self.directory = Path(directory)
+        self.params_hash = hash_params(extraction_params | {'version': FEATURE_CACHE_VERSION})
+        self.hash_index = FileHashIndex(str(Path(directory, 'hashes.json')))
+
+    def get_path(self, audio_file: str) -> Path:
+        file_hash = self.hash_index.get_hash(audio_file)
+        return Path(self.directory, file_hash[:2], f'{file_hash}.{self.params_hash}.pkl')
+
+    def load(self, audio_file: str, playlist: str = None) -> Optional[FeatureVector]:
+        path = self.get_path(audio_file)
+        if not path.exists():
+            return None
+
+        with open(path, 'rb') as f:
+            vector: FeatureVector = pickle.load(f)
+
+        # The same audio may have been cached under another file name or playlist
+        vector.audio.name = Path(audio_file).stem
+        if playlist is not None:
+            vector.audio.playlist = playlist
+        return vector
+
+    def store(self, audio_file: str, vector: FeatureVector):
+        path = self.get_path(audio_file)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Written to a temporary file first so a crash never leaves a truncated entry behind
+        temp_path = path.with_suffix('.tmp')
+        with open(temp_path, 'wb') as f:
+            pickle.dump(vector, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def save(self):
+        self.hash_index.save()
+
+
+# Decoded and resampled waveforms, keyed by audio file hash and sample rate, so parameter sweeps only decode each
+# mp3 once. Entries are .npy files opened with mmap_mode='r', so every reader shares the page cache instead of
+# holding its own copy. Past max_bytes the least recently used entries are evicted, loads refresh an entry's
+# modification time to mark it as used.
+class AudioCache:
+    directory: Path
+    sample_rate: int
+    max_bytes: int
+    hash_index: FileHashIndex
+
+    def __init__(self, directory: str, sample_rate: int = 22050, max_bytes: int = 8 * 2 ** 30):
+        self.directory = Path(directory)
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.hash_index = FileHashIndex(str(Path(directory, 'hashes.json')))
+
+    def get_path(self, audio_file: str) -> Path:
+        file_hash = self.hash_index.get_hash(audio_file)
+        return Path(self.directory, file_hash[:2], f'{file_hash}.{self.sample_rate}.npy')
+
+    # Hashes the files and saves the index before the cache is sent to worker processes, so workers only read
+    # the hashes and never save the index themselves
+    def index(self, audio_files: list[str]):
+        for audio_file in audio_files:
+            self.hash_index.get_hash(audio_file)
+        self.hash_index.save()
+
+    def load(self, audio_file: str) -> Optional[np.ndarray]:
+        path = self.get_path(audio_file)
+        try:
+            waveform = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return waveform
+
+    # Waveforms larger than the whole cache are returned as they are instead of being stored
+    def store(self, audio_file: str, waveform: np.ndarray) -> np.ndarray:
+        if waveform.nbytes > self.max_bytes:
+            return waveform
+        path = self.get_path(audio_file)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        temp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(temp_path, 'wb') as f:
+            np.save(f, waveform)
+        os.replace(temp_path, path)
+
+        self.evict(keep=path)
+        # Another worker evicting at the same moment may still have removed it
+        try:
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            return waveform
+
+    # keep is never evicted, e.g. the entry that is being stored
+    def evict(self, keep: Path = None):
+        entries = []
+        for path in self.directory.glob('*/*.npy'):
+            if path == keep:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        if keep is not None and keep.exists():
+            total_bytes += keep.stat().st_size
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            # Another worker may have evicted it already, and open memory maps stay valid after unlinking
+            path.unlink(missing_ok=True)
+            total_bytes -= size
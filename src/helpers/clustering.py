@@ -0,0 +1,208 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import perf_counter
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from numpy import ndarray
+from sklearn.mixture import GaussianMixture
+
+from src.helpers.cache import hash_matrix, hash_params
+from src.helpers.repositories import ZstdIO
+
+COVARIANCE_TYPES = ('full', 'tied', 'diag', 'spherical')
+
+# Bump whenever a change to the sweep alters its results, so stale cache entries are never reused
+GMM_SWEEP_VERSION = 1
+
+
+# Parameters of a fitted GMM with one more component, for GaussianMixture's *_init arguments. The widest component
+# is split in two along the principal axis of its songs, so EM starts next to the previous solution instead of
+# from a new k-means initialisation. The axis is jittered by rng so chains of different seeds can still differ.
+def get_split_init(gmm: GaussianMixture, matrix: ndarray, rng: np.random.Generator) -> dict:
+    responsibilities = gmm.predict_proba(matrix)
+    totals = responsibilities.sum(axis=0) + 1e-12
+    offsets = [matrix - mean for mean in gmm.means_]
+    spreads = np.array([np.einsum('i,ij,ij->', responsibilities[:, k], offset, offset)
+                        for k, offset in enumerate(offsets)])
+    parent = int(np.argmax(spreads))
+
+    covariance = np.einsum('i,ij,ik->jk', responsibilities[:, parent], offsets[parent], offsets[parent]) \
+        / totals[parent]
+    _, eigenvectors = np.linalg.eigh(covariance)
+    axis = eigenvectors[:, -1] + rng.normal(scale=0.5 / np.sqrt(len(covariance)), size=len(covariance))
+    axis /= np.linalg.norm(axis)
+    step = np.sqrt(max(axis @ covariance @ axis, 0)) * axis / 2
+
+    means = np.vstack([gmm.means_, gmm.means_[parent] + step])
+    means[parent] -= step
+    weights = np.append(gmm.weights_, gmm.weights_[parent] / 2)
+    weights[parent] /= 2
+    if gmm.covariance_type == 'tied':
+        precisions = gmm.precisions_
+    else:
+        precisions = np.concatenate([gmm.precisions_, gmm.precisions_[[parent]]])
+    return {'weights_init': weights, 'means_init': means, 'precisions_init': precisions}
+
+
+# Fits one covariance type and seed over increasing component counts, each fit warm-started from the previous one.
+# A GMM with one component is the same for every seed, so warm starts only follow fits with two or more components.
+# Stops once patience fits in a row have a BIC more than min_delta above the lowest so far, a BIC difference over
+# 10 is very strong evidence against the larger model. Runs in the worker processes of GMMSweep.
+def fit_chain(matrix: ndarray, n_components: list[int], covariance_type: str, seed: int, max_iter: int,
+              warm_start: bool, patience: int, min_delta: float) -> list[dict]:
+    results = []
+    previous = None
+    rng = np.random.default_rng(seed)
+    for n in n_components:
+        start = perf_counter()
+        warm = warm_start and previous is not None and previous.n_components > 1 and n == previous.n_components + 1
+        gmm = GaussianMixture(n_components=n, covariance_type=covariance_type, max_iter=max_iter,
+                              random_state=seed, **(get_split_init(previous, matrix, rng) if warm else {}))
+        gmm.fit(matrix)
+        bic = gmm.bic(matrix)
+        results.append({
+            'covariance_type': covariance_type,
+            'seed': seed,
+            'n_components': n,
+            'aic': gmm.aic(matrix),
+            'bic': bic,
+            'log_likelihood': gmm.score(matrix) * len(matrix),
+            'converged': gmm.converged_,
+            'n_iter': gmm.n_iter_,
+            'warm_started': warm,
+            'seconds': perf_counter() - start
+        })
+        previous = gmm
+        if is_stopped(results, patience, min_delta):
+            break
+    return results
+
+
+# Whether a chain stops after its last fit, once patience fits in a row are more than min_delta above the lowest BIC
+def is_stopped(results: list[dict], patience: int, min_delta: float) -> bool:
+    if not patience:
+        return False
+    best_bic, worse = np.inf, 0
+    for result in results:
+        if result['bic'] < best_bic:
+            best_bic, worse = result['bic'], 0
+        elif result['bic'] > best_bic + min_delta:
+            worse += 1
+    return worse >= patience
+
+
+# Fits of a chain that fit_chain would have made before stopping, for fits made independently of each other
+def truncate_chain(results: list[dict], patience: int, min_delta: float) -> list[dict]:
+    for end in range(1, len(results) + 1):
+        if is_stopped(results[:end], patience, min_delta):
+            return results[:end]
+    return results
+
+
+# AIC/BIC model selection of Gaussian Mixture Models over n_components x covariance_types x seeds.
+# By default every (covariance type, seed, component count) is its own task on a process pool, and early stopping
+# is applied to the results after. With warm starts every (covariance type, seed) pair is one serial chain instead,
+# so only separate chains run in parallel.
+# Results are cached on disk keyed by a hash of the matrix and the grid, so running the sweep again on the same
+# data reads the cache. With early stopping, component counts past the BIC minimum are missing from the results.
+class GMMSweep:
+    n_components: list[int]
+    covariance_types: list[str]
+    seeds: list[int]
+    max_iter: int
+    warm_start: bool
+    patience: int
+    min_delta: float
+    max_workers: Optional[int]
+    cache_directory: Optional[Path]
+
+    def __init__(
+            self,
+            n_components=range(1, 15),
+            covariance_types=('full',),
+            seeds=(0,),
+            max_iter: int = 100,
+            warm_start: bool = False,
+            patience: int = 3,
+            min_delta: float = 10.0,
+            max_workers: int = None,
+            cache_directory: str = None
+    ):
+        unknown = set(covariance_types) - set(COVARIANCE_TYPES)
+        if unknown:
+            raise ValueError(f'Unknown covariance types: {sorted(unknown)}, use any of {COVARIANCE_TYPES}')
+        self.n_components = sorted(n_components)
+        self.covariance_types = list(covariance_types)
+        self.seeds = list(seeds)
+        self.max_iter = max_iter
+        self.warm_start = warm_start
+        self.patience = patience
+        self.min_delta = min_delta
+        self.max_workers = max_workers
+        self.cache_directory = Path(cache_directory) if cache_directory is not None else None
+
+    def get_params(self) -> dict:
+        return {
+            'n_components': self.n_components,
+            'covariance_types': self.covariance_types,
+            'seeds': self.seeds,
+            'max_iter': self.max_iter,
+            'warm_start': self.warm_start,
+            'patience': self.patience,
+            'min_delta': self.min_delta,
+            'version': GMM_SWEEP_VERSION
+        }
+
+    def get_cache_path(self, matrix: ndarray) -> Optional[Path]:
+        if self.cache_directory is None:
+            return None
+        key = hash_params(self.get_params() | {'matrix': hash_matrix(matrix)})
+        return Path(self.cache_directory, f'{key}.gmm' + ZstdIO.file_ext())
+
+    def run(self, matrix: ndarray) -> pd.DataFrame:
+        matrix = np.asarray(matrix, dtype=np.float64)
+        cache_path = self.get_cache_path(matrix)
+        if cache_path is not None and cache_path.exists():
+            return ZstdIO.load(str(cache_path))
+
+        chains = [(covariance_type, seed) for covariance_type in self.covariance_types for seed in self.seeds]
+        if self.warm_start:
+            args = [(matrix, self.n_components, covariance_type, seed, self.max_iter, True, self.patience,
+                     self.min_delta) for covariance_type, seed in chains]
+        else:
+            args = [(matrix, [n], covariance_type, seed, self.max_iter, False, 0, self.min_delta)
+                    for covariance_type, seed in chains for n in self.n_components]
+        if self.max_workers == 1:
+            task_results = [fit_chain(*a) for a in args]
+        else:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as ec:
+                task_results = list(ec.map(fit_chain, *zip(*args)))
+
+        if self.warm_start:
+            chain_results = task_results
+        else:
+            n_fits = len(self.n_components)
+            chain_results = [truncate_chain([r for task in task_results[i:i + n_fits] for r in task],
+                                            self.patience, self.min_delta)
+                             for i in range(0, len(task_results), n_fits)]
+        results = pd.DataFrame([result for chain in chain_results for result in chain])
+
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            ZstdIO().save(str(cache_path)[:-len(ZstdIO.file_ext())], results)
+        return results
+
+    # Mean and spread of AIC and BIC over seeds, one row per covariance type and component count, for the curves
+    @staticmethod
+    def summarise(results: pd.DataFrame) -> pd.DataFrame:
+        return results.groupby(['covariance_type', 'n_components'])[['aic', 'bic']] \
+            .agg(['mean', 'std', 'count']).reset_index()
+
+    # Covariance type and component count with the lowest mean BIC over seeds
+    @staticmethod
+    def best(results: pd.DataFrame) -> tuple[str, int]:
+        mean_bic = results.groupby(['covariance_type', 'n_components'])['bic'].mean()
+        covariance_type, n_components = mean_bic.idxmin()
+        return covariance_type, int(n_components)
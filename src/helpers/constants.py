@@ -29,3 +29,8 @@ CHORD_MAP = {
 MIDI_MAX_NOTE = 128
 
 TONNETZ_LENGTH = 2048
+
+# Transition counts stored as sparse 1 x n rows
+TRAJECTORY_FEATURES = ['chord_trajectory', 'note_trajectory']
+
+METADATA_COLUMNS = ['song_name', 'artist', 'playlist']
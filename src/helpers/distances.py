@@ -0,0 +1,187 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable
+
+import numpy as np
+from numpy import ndarray
+from scipy import sparse
+from scipy.spatial.distance import squareform
+
+
+def to_sparse_trajectory(trajectory) -> sparse.csr_matrix:
+    # Datasets extracted before trajectories were sparse store them as dense float arrays of counts
+    if sparse.issparse(trajectory):
+        return sparse.csr_matrix(trajectory).reshape(1, -1)
+    return sparse.csr_matrix(np.asarray(trajectory).reshape(1, -1).astype(np.int32))
+
+
+def stack_trajectories(trajectories: Iterable) -> sparse.csr_matrix:
+    return sparse.vstack([to_sparse_trajectory(t) for t in trajectories], format='csr')
+
+
+def minmax_scale_rows(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    # Sparse equivalent of MinMaxScaler().fit_transform(matrix.T).T, scaling each song to [0, 1].
+    # Counts are non-negative, so the minimum is 0 whenever a row has implicit zeros and they stay zero.
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+
+    row_max = matrix.max(axis=1).toarray().ravel()
+    row_min = matrix.min(axis=1).toarray().ravel()
+    row_range = row_max - row_min
+    row_range[row_range == 0] = 1
+
+    row_of_entry = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    matrix.data = (matrix.data - row_min[row_of_entry]) / row_range[row_of_entry]
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def squared_row_norms(matrix) -> ndarray:
+    if sparse.issparse(matrix):
+        return np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+    return np.einsum('ij,ij->i', matrix, matrix)
+
+
+def sparse_pdist(matrix: sparse.csr_matrix, metric: str = 'euclidean') -> ndarray:
+    # Condensed distances like scipy's pdist, computed from the Gram matrix without densifying the rows
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+    distances = sparse_cdist(matrix, matrix, metric)
+    np.fill_diagonal(distances, 0)
+    return squareform(distances, checks=False)
+
+
+# Distances between every row of a and every row of b like scipy's cdist, for sparse or dense rows
+def sparse_cdist(a, b, metric: str = 'euclidean') -> ndarray:
+    a = sparse.csr_matrix(a, dtype=np.float64) if sparse.issparse(a) else np.asarray(a, dtype=np.float64)
+    b = sparse.csr_matrix(b, dtype=np.float64) if sparse.issparse(b) else np.asarray(b, dtype=np.float64)
+    gram = a @ b.T
+    gram = gram.toarray() if sparse.issparse(gram) else np.asarray(gram)
+    a_norms, b_norms = squared_row_norms(a), squared_row_norms(b)
+
+    if metric == 'euclidean':
+        squared_distances = a_norms[:, np.newaxis] + b_norms[np.newaxis, :] - 2 * gram
+        return np.sqrt(np.maximum(squared_distances, 0))
+    elif metric == 'cosine':
+        a_norms, b_norms = np.sqrt(a_norms), np.sqrt(b_norms)
+        a_norms[a_norms == 0], b_norms[b_norms == 0] = 1, 1
+        return np.maximum(1 - gram / np.outer(a_norms, b_norms), 0)
+    else:
+        raise ValueError(f'Unsupported metric: {metric}')
+
+
+# Index of the distance between songs i and i + 1 in a condensed distance array of n songs
+def get_condensed_offset(i, n_songs: int):
+    i = np.asarray(i, dtype=np.int64)
+    return i * n_songs - i * (i + 1) // 2
+
+
+def get_condensed_size(condensed) -> int:
+    return int(round((1 + np.sqrt(1 + 8 * len(condensed))) / 2))
+
+
+# Number of songs of a condensed or square distance array
+def get_distance_count(distances) -> int:
+    return distances.shape[0] if np.ndim(distances) == 2 else get_condensed_size(distances)
+
+
+# Distances from one song to every song, read from a condensed array without expanding it, or from a square one
+def get_distance_row(condensed, i: int, n_songs: int = None) -> ndarray:
+    if np.ndim(condensed) == 2:
+        return np.array(condensed[i])
+    n_songs = n_songs if n_songs is not None else get_condensed_size(condensed)
+    before = np.arange(i)
+    row = np.zeros(n_songs, dtype=condensed.dtype)
+    row[:i] = condensed[get_condensed_offset(before, n_songs) + i - before - 1]
+    row[i + 1:] = condensed[get_condensed_offset(i, n_songs):get_condensed_offset(i + 1, n_songs)]
+    return row
+
+
+# Reads distances written by blocked_pdist as a read-only memory map, so only the rows used are read from disk
+def load_distances(path: str) -> ndarray:
+    return np.load(path, mmap_mode='r')
+
+
+def save_rows(directory: str, matrix, dtype) -> None:
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix, dtype=dtype)
+        np.save(os.path.join(directory, 'data.npy'), matrix.data)
+        np.save(os.path.join(directory, 'indices.npy'), matrix.indices)
+        np.save(os.path.join(directory, 'indptr.npy'), matrix.indptr)
+        np.save(os.path.join(directory, 'shape.npy'), np.array(matrix.shape))
+    else:
+        matrix = np.asarray(matrix, dtype=dtype)
+        np.save(os.path.join(directory, 'rows.npy'), matrix)
+    np.save(os.path.join(directory, 'norms.npy'), squared_row_norms(matrix))
+
+
+def load_rows(directory: str):
+    if os.path.exists(os.path.join(directory, 'rows.npy')):
+        return np.load(os.path.join(directory, 'rows.npy'), mmap_mode='r')
+    data, indices, indptr = (np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                             for name in ('data', 'indices', 'indptr'))
+    shape = tuple(np.load(os.path.join(directory, 'shape.npy')))
+    return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+# One block of rows against every later row (condensed) or every row (square), run in a worker process.
+# The inputs and the output are memory maps, so a worker only holds its block of distances in memory.
+def compute_distance_block(input_directory: str, output_path: str, start: int, stop: int, metric: str,
+                           square: bool):
+    matrix = load_rows(input_directory)
+    norms = np.load(os.path.join(input_directory, 'norms.npy'), mmap_mode='r')
+    first_column = 0 if square else start
+    n_songs = matrix.shape[0]
+
+    gram = matrix[start:stop] @ matrix[first_column:].T
+    gram = gram.toarray() if sparse.issparse(gram) else np.asarray(gram)
+    block_norms, column_norms = np.asarray(norms[start:stop]), np.asarray(norms[first_column:])
+    if metric == 'euclidean':
+        distances = block_norms[:, np.newaxis] + column_norms[np.newaxis, :] - 2 * gram
+        np.sqrt(np.maximum(distances, 0, out=distances), out=distances)
+    else:
+        block_norms, column_norms = np.sqrt(block_norms), np.sqrt(column_norms)
+        block_norms[block_norms == 0], column_norms[column_norms == 0] = 1, 1
+        distances = np.maximum(1 - gram / np.outer(block_norms, column_norms), 0)
+
+    output = np.load(output_path, mmap_mode='r+')
+    if square:
+        distances[np.arange(stop - start), np.arange(start, stop)] = 0
+        output[start:stop] = distances
+    else:
+        # The rows of a block are consecutive in the condensed array
+        offsets = get_condensed_offset(np.arange(start, stop + 1), n_songs)
+        output[offsets[0]:offsets[-1]] = np.concatenate([
+            distances[i - start, i + 1 - first_column:] for i in range(start, stop)
+        ])
+    output.flush()
+
+
+# Pairwise distances like sparse_pdist, for libraries whose distances do not fit in memory: blocks of rows
+# are computed on a process pool and written straight into a condensed (or square=True) .npy file.
+# Distances are computed in float32 from the Gram matrix. Like sparse_pdist, distances between near-identical
+# songs lose the most precision, up to about 1e-2 for [0, 1]-scaled note trajectories.
+# Memory per worker is bounded by block_size x songs.
+def blocked_pdist(matrix, path: str, metric: str = 'euclidean', square: bool = False, block_size: int = 256,
+                  max_workers: int = None, dtype=np.float32) -> ndarray:
+    if metric not in ('euclidean', 'cosine'):
+        raise ValueError(f'Unsupported metric: {metric}')
+    n_songs = matrix.shape[0]
+    shape = (n_songs, n_songs) if square else (n_songs * (n_songs - 1) // 2,)
+    np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape).flush()
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as input_directory:
+        save_rows(input_directory, matrix, dtype)
+        blocks = [(start, min(start + block_size, n_songs)) for start in range(0, n_songs, block_size)]
+        arguments = [(input_directory, path, start, stop, metric, square) for start, stop in blocks]
+
+        max_workers = max_workers or os.cpu_count() or 1
+        if max_workers == 1:
+            for args in arguments:
+                compute_distance_block(*args)
+        else:
+            # Blocks further down have fewer later rows, small blocks keep the workers evenly loaded
+            with ProcessPoolExecutor(max_workers=max_workers) as ec:
+                for future in [ec.submit(compute_distance_block, *args) for args in arguments]:
+                    future.result()
+
+    return load_distances(path)
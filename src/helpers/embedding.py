@@ -0,0 +1,221 @@
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from numpy import ndarray
+from scipy import sparse
+from sklearn.manifold import MDS
+
+from src.helpers.distances import get_distance_count, get_distance_row, minmax_scale_rows, sparse_cdist, \
+    squared_row_norms
+from src.helpers.repositories import ZstdIO
+
+LANDMARK_SELECTIONS = ('maxmin', 'random')
+LANDMARK_METHODS = ('smacof', 'classical')
+
+# Embedded spaces of 2-mds-embedding.ipynb: the array column and whether each song is scaled to [0, 1] first
+EMBEDDING_SPACES = {
+    'note': ('note_trajectory', True),
+    'chord': ('chord_trajectory', True),
+    'tonnetz': ('tonnetz', False)
+}
+
+
+# Landmark MDS: the landmark songs are embedded first and every other song is then placed by its distances
+# to the landmarks alone. Fitting and placing n songs costs O(n x landmarks) time and memory instead of the
+# O(n^2) distance matrix of a full MDS, and new songs are placed with transform() without refitting.
+# - smacof embeds the landmarks with sklearn's MDS like the notebooks, and places each song by minimising its
+#   stress against the fixed landmarks with a few Guttman transform iterations.
+# - classical is the landmark MDS of de Silva and Tenenbaum (2004), a linear map from squared distances to
+#   coordinates. With as many landmarks as songs it is the same as classical MDS.
+# Rows are sparse trajectories or dense arrays such as tonnetz, with scale_rows=True each song is first
+# scaled to [0, 1] like minmax_scale_rows in the notebooks.
+# With precomputed=True, fit() takes the pairwise distances of the library instead, condensed or square, e.g. a
+# memory map from load_distances(). Only the rows of the landmarks are read from it. transform() then takes the
+# distances of songs to the landmarks, which get_landmark_distances() reads from the same file for the library.
+class LandmarkMDS:
+    n_components: int
+    n_landmarks: int
+    method: str
+    selection: str
+    scale_rows: bool
+    precomputed: bool
+    seed: int
+    n_iter: int
+    batch_size: int
+
+    # Fitted
+    landmark_indices: ndarray
+    # None with precomputed distances
+    landmarks: Optional[Union[ndarray, sparse.csr_matrix]]
+    landmark_coordinates: ndarray
+    # Classical only: (n_components x landmarks), maps squared distances to the landmarks onto coordinates
+    pseudo_inverse: ndarray
+    mean_squared_distances: ndarray
+
+    def __init__(
+            self,
+            n_components: int = 2,
+            n_landmarks: int = 200,
+            method: str = 'smacof',
+            selection: str = 'maxmin',
+            scale_rows: bool = False,
+            precomputed: bool = False,
+            seed: int = 0,
+            n_iter: int = 30,
+            batch_size: int = 4096
+    ):
+        if method not in LANDMARK_METHODS:
+            raise ValueError(f'Unknown landmark MDS method: {method}, use one of {LANDMARK_METHODS}')
+        if selection not in LANDMARK_SELECTIONS:
+            raise ValueError(f'Unknown landmark selection: {selection}, use one of {LANDMARK_SELECTIONS}')
+        self.n_components = n_components
+        self.n_landmarks = n_landmarks
+        self.method = method
+        self.selection = selection
+        self.scale_rows = scale_rows
+        self.precomputed = precomputed
+        self.seed = seed
+        self.n_iter = n_iter
+        self.batch_size = batch_size
+
+    def fit(self, matrix) -> 'LandmarkMDS':
+        if self.precomputed:
+            self.landmark_indices, landmark_rows = self.__select_landmark_rows(matrix)
+            self.landmarks = None
+            distances = landmark_rows[:, self.landmark_indices]
+        else:
+            matrix = self.__prepare(matrix)
+            self.landmark_indices = self.__select_landmarks(matrix)
+            self.landmarks = matrix[self.landmark_indices]
+            distances = sparse_cdist(self.landmarks, self.landmarks)
+        np.fill_diagonal(distances, 0)
+
+        if self.method == 'smacof':
+            mds = MDS(n_components=self.n_components, dissimilarity='precomputed', normalized_stress=False,
+                      random_state=self.seed)
+            self.landmark_coordinates = mds.fit_transform(distances)
+        else:
+            self.__fit_classical(distances ** 2)
+        return self
+
+    def __fit_classical(self, squared_distances: ndarray):
+        # Classical MDS on the landmarks: eigenvectors of the double centred squared distances
+        self.mean_squared_distances = squared_distances.mean(axis=0)
+        centred = -0.5 * (squared_distances - self.mean_squared_distances[np.newaxis, :]
+                          - squared_distances.mean(axis=1)[:, np.newaxis] + squared_distances.mean())
+        eigenvalues, eigenvectors = np.linalg.eigh(centred)
+        order = np.argsort(eigenvalues)[::-1][:self.n_components]
+        eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:, order]
+        if len(eigenvalues) < self.n_components or np.any(eigenvalues <= 0):
+            raise ValueError(f'The landmarks only span {np.sum(eigenvalues > 0)} dimensions, '
+                             f'use more landmarks or fewer components')
+
+        # Eigenvectors are only unique up to sign, fixing it keeps refits on the same data identical
+        eigenvectors = eigenvectors * np.sign(
+            eigenvectors[np.argmax(np.abs(eigenvectors), axis=0), np.arange(self.n_components)])
+        self.landmark_coordinates = eigenvectors * np.sqrt(eigenvalues)
+        self.pseudo_inverse = eigenvectors.T / np.sqrt(eigenvalues)[:, np.newaxis]
+
+    # Places songs in the fitted embedding from their distances to the landmarks, in batches of rows. With
+    # precomputed distances, matrix holds the distances of each song to the landmarks, in the order of
+    # landmark_indices.
+    def transform(self, matrix) -> ndarray:
+        matrix = np.atleast_2d(matrix) if self.precomputed else self.__prepare(matrix)
+        coordinates = np.empty((matrix.shape[0], self.n_components))
+        for start in range(0, matrix.shape[0], self.batch_size):
+            if self.precomputed:
+                distances = np.asarray(matrix[start:start + self.batch_size], dtype=np.float64)
+            else:
+                distances = sparse_cdist(matrix[start:start + self.batch_size], self.landmarks)
+            if self.method == 'smacof':
+                coordinates[start:start + self.batch_size] = self.__place(distances)
+            else:
+                coordinates[start:start + self.batch_size] = \
+                    -0.5 * (distances ** 2 - self.mean_squared_distances) @ self.pseudo_inverse.T
+        return coordinates
+
+    # Guttman transform with the landmarks held fixed: every iteration moves each song to the mean of where
+    # each landmark says it should be, which never increases its stress. Songs start at their nearest landmark.
+    def __place(self, distances: ndarray) -> ndarray:
+        landmarks = self.landmark_coordinates[np.newaxis, :, :]
+        coordinates = self.landmark_coordinates[np.argmin(distances, axis=1)]
+        for _ in range(self.n_iter):
+            offsets = coordinates[:, np.newaxis, :] - landmarks
+            lengths = np.maximum(np.linalg.norm(offsets, axis=2, keepdims=True), 1e-12)
+            coordinates = (landmarks + distances[:, :, np.newaxis] * offsets / lengths).mean(axis=1)
+        return coordinates
+
+    def fit_transform(self, matrix) -> ndarray:
+        self.fit(matrix)
+        return self.transform(self.get_landmark_distances(matrix) if self.precomputed else matrix)
+
+    # (songs x landmarks) distances of every song of the library to the landmarks, from its pairwise distances
+    def get_landmark_distances(self, distances) -> ndarray:
+        n_songs = get_distance_count(distances)
+        return np.stack([get_distance_row(distances, i, n_songs) for i in self.landmark_indices], axis=1)
+
+    def __prepare(self, matrix):
+        if sparse.issparse(matrix):
+            matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+        else:
+            matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float64))
+        return minmax_scale_rows(sparse.csr_matrix(matrix)) if self.scale_rows else matrix
+
+    # MaxMin picks each landmark as the song furthest from all landmarks so far, which spreads them over the
+    # whole space with one pass over the songs per landmark. Fewer landmarks are kept when songs repeat.
+    def __select_landmarks(self, matrix) -> ndarray:
+        n_songs = matrix.shape[0]
+        n_landmarks = min(self.n_landmarks, n_songs)
+        rng = np.random.default_rng(self.seed)
+        if self.selection == 'random':
+            return np.sort(rng.choice(n_songs, size=n_landmarks, replace=False))
+
+        norms = squared_row_norms(matrix)
+        indices = [int(rng.integers(n_songs))]
+        nearest = np.full(n_songs, np.inf)
+        while True:
+            landmark = matrix[indices[-1]]
+            products = matrix @ landmark.T
+            products = products.toarray().ravel() if sparse.issparse(products) else np.ravel(products)
+            nearest = np.minimum(nearest, norms + norms[indices[-1]] - 2 * products)
+            furthest = int(np.argmax(nearest))
+            if len(indices) == n_landmarks or nearest[furthest] <= 1e-12:
+                return np.array(indices)
+            indices.append(furthest)
+
+    # Like __select_landmarks, from pairwise distances: only the rows of the landmarks are read, and returned as a
+    # (landmarks x songs) matrix
+    def __select_landmark_rows(self, distances) -> tuple[ndarray, ndarray]:
+        n_songs = get_distance_count(distances)
+        n_landmarks = min(self.n_landmarks, n_songs)
+        rng = np.random.default_rng(self.seed)
+        if self.selection == 'random':
+            indices = np.sort(rng.choice(n_songs, size=n_landmarks, replace=False))
+            rows = [get_distance_row(distances, i, n_songs) for i in indices]
+            return indices, np.array(rows, dtype=np.float64)
+
+        indices = [int(rng.integers(n_songs))]
+        rows = []
+        nearest = np.full(n_songs, np.inf)
+        while True:
+            rows.append(get_distance_row(distances, indices[-1], n_songs).astype(np.float64))
+            nearest = np.minimum(nearest, rows[-1])
+            furthest = int(np.argmax(nearest))
+            if len(indices) == n_landmarks or nearest[furthest] <= 1e-6:
+                return np.array(indices), np.array(rows)
+            indices.append(furthest)
+
+    # Stored next to the playlist folders of the extracted library, e.g. note.mds.pkl.zst
+    @staticmethod
+    def get_path(extracted_directory: str, name: str) -> Path:
+        return Path(extracted_directory, name + '.mds' + ZstdIO.file_ext())
+
+    def save(self, extracted_directory: str, name: str) -> Path:
+        path = LandmarkMDS.get_path(extracted_directory, name)
+        ZstdIO().save(str(path)[:-len(ZstdIO.file_ext())], self)
+        return path
+
+    @staticmethod
+    def load(extracted_directory: str, name: str) -> 'LandmarkMDS':
+        return ZstdIO.load(str(LandmarkMDS.get_path(extracted_directory, name)))
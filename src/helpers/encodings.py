@@ -0,0 +1,185 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from numpy import ndarray
+from scipy import sparse
+
+from src.helpers.constants import CHORD_MAP, MIDI_MAX_NOTE
+from src.helpers.distances import to_sparse_trajectory
+
+# Compact encodings of a trajectory, each stored as a <trajectory>_<encoding> column
+ENCODING_NAMES = ('pitch_classes', 'intervals', 'projection')
+PITCH_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+CHORD_QUALITIES = ['maj', 'min']
+
+
+# Flat indices and counts of the transitions that occur, for dense matrices and sparse rows alike
+def get_transitions(trajectory) -> tuple[ndarray, ndarray]:
+    if sparse.issparse(trajectory):
+        row = to_sparse_trajectory(trajectory)
+        return row.indices, row.data
+    values = np.ravel(trajectory)
+    indices = np.flatnonzero(values)
+    return indices, values[indices]
+
+
+# Sums the counts of every transition into its bin, transitions in bin -1 are dropped
+def fold_transitions(trajectory, bins: ndarray, n_bins: int) -> ndarray:
+    indices, counts = get_transitions(trajectory)
+    transition_bins = bins[indices]
+    keep = transition_bins >= 0
+    folded = np.bincount(transition_bins[keep], weights=counts[keep], minlength=n_bins)
+    return np.rint(folded).astype(np.int32)
+
+
+# Trajectories are indexed [to, from], so bins are laid out the same way
+@lru_cache(maxsize=None)
+def get_pitch_class_bins() -> ndarray:
+    to_note, from_note = np.divmod(np.arange(MIDI_MAX_NOTE * MIDI_MAX_NOTE), MIDI_MAX_NOTE)
+    return (to_note % 12) * 12 + from_note % 12
+
+
+@lru_cache(maxsize=None)
+def get_note_interval_bins() -> ndarray:
+    to_note, from_note = np.divmod(np.arange(MIDI_MAX_NOTE * MIDI_MAX_NOTE), MIDI_MAX_NOTE)
+    return to_note - from_note + MIDI_MAX_NOTE - 1
+
+
+@lru_cache(maxsize=None)
+def get_chord_interval_bins(chord_names: tuple[str, ...]) -> ndarray:
+    # Chord names are <root>:<quality> as in CHORD_MAP, anything else such as 'N' has no bin
+    roots, qualities = [], []
+    for name in chord_names:
+        root, _, quality = name.partition(':')
+        known = root in PITCH_NAMES and quality in CHORD_QUALITIES
+        roots.append(PITCH_NAMES.index(root) if known else -1)
+        qualities.append(CHORD_QUALITIES.index(quality) if known else -1)
+    roots, qualities = np.array(roots), np.array(qualities)
+
+    chord_count = len(chord_names)
+    to_chord, from_chord = np.divmod(np.arange(chord_count * chord_count), chord_count)
+    interval = (roots[to_chord] - roots[from_chord]) % 12
+    bins = (qualities[from_chord] * len(CHORD_QUALITIES) + qualities[to_chord]) * 12 + interval
+    return np.where((roots[to_chord] < 0) | (roots[from_chord] < 0), -1, bins)
+
+
+# 128 x 128 note transitions -> 12 x 12 pitch class transitions, the same melody in any octave is the same vector
+def fold_pitch_classes(note_trajectory) -> ndarray:
+    return fold_transitions(note_trajectory, get_pitch_class_bins(), 12 * 12)
+
+
+# Counts of every melodic step from -127 to +127 semitones, the same melody in any key is the same vector
+def note_interval_histogram(note_trajectory) -> ndarray:
+    return fold_transitions(note_trajectory, get_note_interval_bins(), 2 * MIDI_MAX_NOTE - 1)
+
+
+# Counts of root movements from 0 to 11 semitones for each pair of chord qualities, e.g. maj -> min,
+# so a progression played in any key is the same vector. Transitions into or out of non-chords are dropped.
+def chord_interval_histogram(chord_trajectory, chord_map: dict = CHORD_MAP) -> ndarray:
+    chord_names = tuple(sorted(chord_map, key=chord_map.get))
+    n_bins = len(CHORD_QUALITIES) ** 2 * 12
+    return fold_transitions(chord_trajectory, get_chord_interval_bins(chord_names), n_bins)
+
+
+# Sparse random projection of Achlioptas (2003): entries are +-sqrt(3 / n_components) with probability 1/6
+# each and 0 otherwise. The matrix only depends on its shape and the seed, so every process and every run
+# projects onto the same components.
+@lru_cache(maxsize=4)
+def get_projection_matrix(n_features: int, n_components: int, seed: int = 0) -> sparse.csr_matrix:
+    rng = np.random.default_rng(seed)
+    draws = rng.integers(0, 6, size=(n_features, n_components), dtype=np.int8)
+    rows, columns = np.nonzero(draws < 2)
+    signs = np.where(draws[rows, columns] == 0, -1.0, 1.0)
+    return sparse.csr_matrix((signs * np.sqrt(3 / n_components), (rows, columns)),
+                             shape=(n_features, n_components))
+
+
+# Each song is scaled to [0, 1] before projecting, like minmax_scale_rows in the notebooks, so distances
+# between projections approximate the distances the notebooks compute on the full trajectories
+def project_trajectory(trajectory, n_components: int, seed: int = 0) -> ndarray:
+    indices, counts = get_transitions(trajectory)
+    n_features = to_sparse_trajectory(trajectory).shape[1] if sparse.issparse(trajectory) else np.size(trajectory)
+    if not counts.size or counts.max() == 0:
+        return np.zeros(n_components)
+    matrix = get_projection_matrix(n_features, n_components, seed)
+    return matrix[indices].T @ (counts / counts.max())
+
+
+# Johnson-Lindenstrauss bound for the projection (Achlioptas 2003): with
+#   n_components >= (4 + 2 * beta) * ln(n_samples) / (eps^2 / 2 - eps^3 / 3)
+# every squared distance between n_samples songs is kept within a factor of 1 +- eps, with probability at
+# least 1 - n_samples^-beta
+def get_min_components(n_samples: int, eps: float, beta: float = 1.0) -> int:
+    return int(np.ceil((4 + 2 * beta) * np.log(n_samples) / (eps ** 2 / 2 - eps ** 3 / 3)))
+
+
+# Smallest eps that the bound guarantees, inf when n_components is too small for any eps below 1
+def get_distortion_bound(n_components: int, n_samples: int, beta: float = 1.0) -> float:
+    required = (4 + 2 * beta) * np.log(max(n_samples, 2)) / n_components
+    if required >= 1 / 6:
+        return np.inf
+    low, high = 0.0, 1.0
+    for _ in range(60):
+        eps = (low + high) / 2
+        low, high = (eps, high) if eps ** 2 / 2 - eps ** 3 / 3 < required else (low, eps)
+    return high
+
+
+# Which compact encodings are computed at extraction time, and whether the flattened trajectories are kept
+# next to them. Pitch classes and the projection are only computed for note trajectories, as chord
+# trajectories are 25 x 25 to begin with.
+@dataclass(frozen=True)
+class TrajectoryEncoding:
+    encodings: tuple[str, ...] = ()
+    n_components: int = 512
+    seed: int = 0
+    keep_raw: bool = True
+
+    def __post_init__(self):
+        unknown = set(self.encodings) - set(ENCODING_NAMES)
+        if unknown:
+            raise ValueError(f'Unknown trajectory encodings: {sorted(unknown)}')
+
+    def encode_note_trajectory(self, note_trajectory) -> dict[str, ndarray]:
+        encoders = {
+            'pitch_classes': fold_pitch_classes,
+            'intervals': note_interval_histogram,
+            'projection': lambda t: project_trajectory(t, self.n_components, self.seed)
+        }
+        return {f'note_trajectory_{name}': encoders[name](note_trajectory) for name in self.encodings}
+
+    def encode_chord_trajectory(self, chord_trajectory, chord_map: dict = CHORD_MAP) -> dict[str, ndarray]:
+        if 'intervals' not in self.encodings:
+            return {}
+        return {'chord_trajectory_intervals': chord_interval_histogram(chord_trajectory, chord_map)}
+
+    # Encodes the trajectories of a dataset extracted before, e.g. to add encodings to a stored library
+    def apply_dataset(self, dataset: pd.DataFrame, chord_map: dict = CHORD_MAP) -> pd.DataFrame:
+        dataset = dataset.copy()
+        encoders = {'note_trajectory': self.encode_note_trajectory,
+                    'chord_trajectory': lambda t: self.encode_chord_trajectory(t, chord_map)}
+        for column, encode in encoders.items():
+            if column not in dataset.columns:
+                continue
+            encoded = pd.DataFrame([encode(trajectory) for trajectory in dataset[column]], index=dataset.index)
+            for encoded_column in encoded.columns:
+                dataset[encoded_column] = encoded[encoded_column]
+            if not self.keep_raw:
+                dataset = dataset.drop(columns=column)
+        return dataset
+
+    def get_distortion_bound(self, n_samples: int, beta: float = 1.0) -> float:
+        return get_distortion_bound(self.n_components, n_samples, beta)
+
+
+RAW_TRAJECTORIES = TrajectoryEncoding()
+ENCODED_TRAJECTORIES = TrajectoryEncoding(encodings=ENCODING_NAMES)
+COMPACT_TRAJECTORIES = TrajectoryEncoding(encodings=ENCODING_NAMES, keep_raw=False)
+
+TRAJECTORY_ENCODINGS = {
+    'raw': RAW_TRAJECTORIES,
+    'encoded': ENCODED_TRAJECTORIES,
+    'compact': COMPACT_TRAJECTORIES
+}
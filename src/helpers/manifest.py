@@ -0,0 +1,133 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+from src.helpers.cache import hash_params
+from src.models import *
+
+MANIFEST_NAME = 'manifest.sqlite'
+SEARCH_COLUMNS = ('song_name', 'artist', 'playlist')
+
+
+# SQLite index of the extracted library with one row per track, kept next to the playlist folders.
+# Every searchable column has a B-tree index, so finding a song, an artist or a playlist is a lookup
+# instead of a scan, and the stored row number lets the feature store read just that track.
+# Feature store paths are relative to the manifest, so the library can be moved as a whole.
+class TrackManifest:
+    path: Path
+    connection: sqlite3.Connection
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS extraction_params (
+                    params_hash TEXT PRIMARY KEY,
+                    params TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS tracks (
+                    playlist TEXT NOT NULL,
+                    store_row INTEGER NOT NULL,
+                    artist TEXT NOT NULL,
+                    song_name TEXT NOT NULL,
+                    file_name TEXT,
+                    file_hash TEXT,
+                    params_hash TEXT REFERENCES extraction_params (params_hash),
+                    store_path TEXT NOT NULL,
+                    PRIMARY KEY (playlist, store_row)
+                );
+                CREATE INDEX IF NOT EXISTS tracks_song_name ON tracks (song_name);
+                CREATE INDEX IF NOT EXISTS tracks_artist ON tracks (artist);
+                CREATE INDEX IF NOT EXISTS tracks_file_hash ON tracks (file_hash);
+            ''')
+
+    @staticmethod
+    def get_path(extracted_directory: str) -> Path:
+        return Path(extracted_directory, MANIFEST_NAME)
+
+    def close(self):
+        self.connection.close()
+
+    # Replaces every entry of the playlist, names are AudioData names in the order of the feature store rows
+    def register_playlist(
+            self,
+            playlist: str,
+            store_path: str,
+            names: list[str],
+            file_hashes: list[Optional[str]] = None,
+            extraction_params: dict = None
+    ):
+        file_hashes = file_hashes if file_hashes is not None else [None] * len(names)
+        params_hash = hash_params(extraction_params) if extraction_params is not None else None
+        relative_store_path = str(Path(store_path).resolve().relative_to(self.path.parent.resolve()))
+
+        rows = []
+        for store_row, (name, file_hash) in enumerate(zip(names, file_hashes)):
+            audio = AudioData(name=name, playlist=playlist)
+            rows.append((playlist, store_row, audio.get_artists()[0], audio.get_song_name(), name, file_hash,
+                         params_hash, relative_store_path))
+
+        with self.connection:
+            if params_hash is not None:
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO extraction_params VALUES (?, ?)',
+                    (params_hash, json.dumps(extraction_params, sort_keys=True, default=str))
+                )
+            self.connection.execute('DELETE FROM tracks WHERE playlist = ?', (playlist,))
+            self.connection.executemany('INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    # For playlists that were partly re-extracted with other parameters
+    def update_extraction_params(self, playlist: str, extraction_params: dict):
+        params_hash = hash_params(extraction_params)
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO extraction_params VALUES (?, ?)',
+                (params_hash, json.dumps(extraction_params, sort_keys=True, default=str))
+            )
+            self.connection.execute('UPDATE tracks SET params_hash = ? WHERE playlist = ?', (params_hash, playlist))
+
+    def get_playlist_params(self, playlist: str) -> Optional[dict]:
+        row = self.connection.execute(
+            'SELECT params_hash FROM tracks WHERE playlist = ? LIMIT 1',
+            (playlist,)
+        ).fetchone()
+        return self.get_extraction_params(row['params_hash']) if row is not None and row['params_hash'] else None
+
+    # Indexes playlists extracted before the manifest existed, from the metadata kept by each feature store
+    def register_store(self, playlist: str, store_path: str, metadata: dict[str, list[str]]):
+        names = [f'{artist} - {song_name}' for artist, song_name in zip(metadata['artist'], metadata['song_name'])]
+        self.register_playlist(playlist, store_path, names)
+
+    def find(self, column: str, value: str) -> list[dict]:
+        if column not in SEARCH_COLUMNS:
+            raise ValueError(f'Cannot search by {column}, use one of {SEARCH_COLUMNS}')
+        cursor = self.connection.execute(
+            f'SELECT * FROM tracks WHERE {column} = ? ORDER BY playlist, store_row',
+            (value,)
+        )
+        return [dict(row) for row in cursor]
+
+    def get_playlists(self) -> list[str]:
+        return [row['playlist'] for row in self.connection.execute('SELECT DISTINCT playlist FROM tracks')]
+
+    def get_store_paths(self, playlists: list[str] = None) -> dict[str, Path]:
+        query = 'SELECT DISTINCT playlist, store_path FROM tracks'
+        rows = self.connection.execute(query).fetchall() if playlists is None else [
+            row for playlist in playlists
+            for row in self.connection.execute(query + ' WHERE playlist = ?', (playlist,))
+        ]
+        return {row['playlist']: Path(self.path.parent, row['store_path']) for row in rows}
+
+    def get_extraction_params(self, params_hash: str) -> Optional[dict]:
+        row = self.connection.execute(
+            'SELECT params FROM extraction_params WHERE params_hash = ?',
+            (params_hash,)
+        ).fetchone()
+        return json.loads(row['params']) if row is not None else None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
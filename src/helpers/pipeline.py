@@ -0,0 +1,188 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from numpy import ndarray
+from sklearn.decomposition import PCA
+from sklearn.mixture import GaussianMixture
+from sklearn.preprocessing import StandardScaler
+
+from src.helpers.embedding import EMBEDDING_SPACES, LandmarkMDS
+from src.helpers.manifest import TrackManifest
+from src.helpers.processors import AudioDataProcessor, FeatureVectorProcessor
+from src.helpers.query import AbstractNeighbourIndex, ExactIndex
+from src.helpers.repositories import ZstdIO, build_feature_dataset
+from src.models import FeatureDataset, FeatureVector
+
+
+@dataclass
+class SongPlacement:
+    name: str
+    # Position in the PCA space that the clusters and the neighbours are found in
+    coordinates: ndarray
+    cluster: int
+    # Probability of every GMM cluster
+    probabilities: ndarray
+    # Metadata, cluster and distance of the nearest library songs
+    neighbours: pd.DataFrame
+
+    # The placed song followed by its neighbours, as saved to user_cluster_dataset in src/notebooks/config.py
+    def to_dataframe(self) -> pd.DataFrame:
+        song = pd.DataFrame([{'distance': 0.0, 'song_name': self.name, 'playlist': 'user', 'cluster': self.cluster}])
+        return pd.concat([song, self.neighbours], ignore_index=True)
+
+
+# Every transform the notebooks fit on the library, fitted once and saved as one artifact:
+# landmark MDS of the note, chord and tonnetz spaces -> StandardScaler over the scalar features and the MDS
+# coordinates -> PCA -> GMM clusters, plus a nearest neighbour index and the metadata of the library songs.
+# A loaded pipeline places new songs with place() without reading the library.
+class PlacementPipeline:
+    n_pca_components: int
+    n_clusters: int
+    covariance_type: str
+    n_landmarks: int
+    spaces: dict[str, tuple[str, bool]]
+    neighbours: int
+    seed: int
+    # Every extraction parameter of FeatureVectorProcessor, including precision and encoding, as the library was
+    # extracted with. Songs placed with another set would land in the wrong place.
+    extraction_params: dict
+
+    # Fitted
+    scalar_columns: list[str]
+    embeddings: dict[str, LandmarkMDS]
+    scaler: StandardScaler
+    pca: PCA
+    gmm: GaussianMixture
+    index: AbstractNeighbourIndex
+    # Metadata and cluster of every library song, in the same order as the index
+    metadata: pd.DataFrame
+
+    def __init__(
+            self,
+            n_pca_components: int = 10,
+            n_clusters: int = 8,
+            covariance_type: str = 'full',
+            n_landmarks: int = 200,
+            spaces: dict[str, tuple[str, bool]] = None,
+            neighbours: int = 6,
+            index: AbstractNeighbourIndex = None,
+            seed: int = 0,
+            extraction_params: dict = None
+    ):
+        self.n_pca_components = n_pca_components
+        self.n_clusters = n_clusters
+        self.covariance_type = covariance_type
+        self.n_landmarks = n_landmarks
+        self.spaces = spaces if spaces is not None else EMBEDDING_SPACES
+        self.neighbours = neighbours
+        self.index = index if index is not None else ExactIndex()
+        self.seed = seed
+        unknown = set(extraction_params or {}) - set(FeatureVectorProcessor.extraction_param_names)
+        if unknown:
+            raise ValueError(f'Unknown extraction parameters: {sorted(unknown)}')
+        self.extraction_params = FeatureVectorProcessor.get_extraction_params(**(extraction_params or {}))
+
+    def fit(self, features: FeatureDataset) -> 'PlacementPipeline':
+        self.scalar_columns = list(features.scalar_columns)
+        self.embeddings = {
+            name: LandmarkMDS(n_landmarks=self.n_landmarks, scale_rows=scale_rows, seed=self.seed)
+            .fit(features.arrays[column])
+            for name, (column, scale_rows) in self.spaces.items()
+        }
+        combined = self.__combine(features)
+        self.scaler = StandardScaler().fit(combined)
+        self.pca = PCA(n_components=self.n_pca_components, random_state=self.seed)
+        coordinates = self.pca.fit_transform(self.scaler.transform(combined))
+        self.gmm = GaussianMixture(n_components=self.n_clusters, covariance_type=self.covariance_type,
+                                   random_state=self.seed).fit(coordinates)
+        self.index.build(coordinates)
+        self.metadata = features.metadata.reset_index(drop=True).assign(cluster=self.gmm.predict(coordinates))
+        return self
+
+    # PCA coordinates of songs, with their features in the same columns the pipeline was fitted on
+    def transform(self, features: FeatureDataset) -> ndarray:
+        return self.pca.transform(self.scaler.transform(self.__combine(features)))
+
+    # Scalar features followed by the 2-D MDS coordinates of every space, e.g. note_x and note_y
+    def __combine(self, features: FeatureDataset) -> ndarray:
+        missing = [column for column in self.scalar_columns if column not in features.scalar_columns]
+        if missing:
+            raise ValueError(f'Features are missing scalar columns the pipeline was fitted on: {missing}')
+        scalars = features.scalars[:, [features.scalar_columns.index(c) for c in self.scalar_columns]]
+        embedded = [self.embeddings[name].transform(features.arrays[column])
+                    for name, (column, _) in self.spaces.items()]
+        return np.hstack([scalars.astype(np.float64)] + embedded)
+
+    # Extracts the features of one song and places it among the clusters and songs of the library
+    def place(self, song_path: str) -> SongPlacement:
+        audio = AudioDataProcessor.load_one(song_path, playlist='user')
+        vector, _ = FeatureVectorProcessor(audio, **self.extraction_params).process_concurrently()
+        return self.place_vector(vector)
+
+    def place_vector(self, vector: FeatureVector) -> SongPlacement:
+        coordinates = self.transform(build_feature_dataset(pd.DataFrame([vector.as_dict()])))
+        distances, positions = self.index.query(coordinates, self.neighbours)
+        neighbours = self.metadata.iloc[positions[0]]
+        neighbours.insert(0, 'distance', distances[0])
+        probabilities = self.gmm.predict_proba(coordinates)[0]
+        return SongPlacement(
+            name=vector.audio.name,
+            coordinates=coordinates[0],
+            cluster=int(np.argmax(probabilities)),
+            probabilities=probabilities,
+            neighbours=neighbours.reset_index(drop=True)
+        )
+
+    # Stored in /data/models, e.g. placement.pipeline.pkl.zst
+    @staticmethod
+    def get_path(directory: str, name: str) -> Path:
+        return Path(directory, name + '.pipeline' + ZstdIO.file_ext())
+
+    def save(self, directory: str, name: str) -> Path:
+        path = PlacementPipeline.get_path(directory, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        ZstdIO().save(str(path)[:-len(ZstdIO.file_ext())], self)
+        return path
+
+    # Pass extraction_params, e.g. from get_library_params(), to check the library is still extracted the same way
+    @staticmethod
+    def load(directory: str, name: str, extraction_params: dict = None) -> 'PlacementPipeline':
+        pipeline = ZstdIO.load(str(PlacementPipeline.get_path(directory, name)))
+        missing = [p for p in FeatureVectorProcessor.extraction_param_names if p not in pipeline.extraction_params]
+        if missing:
+            raise ValueError(f'Pipeline {name} does not record the extraction parameters {missing}, '
+                             f'fit it again with fitPipeline.py')
+        if extraction_params is not None:
+            expected = FeatureVectorProcessor.get_extraction_params(**extraction_params)
+            different = [p for p in expected if expected[p] != pipeline.extraction_params[p]]
+            if different:
+                raise ValueError(f'Pipeline {name} was fitted on features extracted with other {different}, '
+                                 f'fit it again with fitPipeline.py')
+        return pipeline
+
+    # Extraction parameters the playlists of the library were extracted with according to its manifest, or None if
+    # it does not record any. Playlists extracted with different parameters cannot share one pipeline.
+    @staticmethod
+    def get_library_params(extracted_directory: str) -> Optional[dict]:
+        manifest_path = TrackManifest.get_path(extracted_directory)
+        if not manifest_path.exists():
+            return None
+        manifest = TrackManifest(str(manifest_path))
+        playlist_params = {}
+        for playlist in manifest.get_playlists():
+            stored_params = manifest.get_playlist_params(playlist)
+            if stored_params is not None:
+                playlist_params[playlist] = FeatureVectorProcessor.get_extraction_params(
+                    **FeatureVectorProcessor.decode_extraction_params(stored_params))
+        manifest.close()
+        if not playlist_params:
+            return None
+
+        params = list(playlist_params.values())
+        different = [p for p in params[0] if any(other[p] != params[0][p] for other in params[1:])]
+        if different:
+            raise ValueError(f'Playlists were extracted with different {different}: {sorted(playlist_params)}')
+        return params[0]
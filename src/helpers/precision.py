@@ -0,0 +1,173 @@
+from dataclasses import dataclass, replace
+from math import prod
+
+import numpy as np
+import pandas as pd
+from numpy import ndarray
+from scipy import sparse
+
+from src.helpers.constants import METADATA_COLUMNS, TRAJECTORY_FEATURES
+from src.helpers.distances import to_sparse_trajectory
+from src.models import *
+
+# Representation fields by how they are compacted, everything else is a float array
+SPECTROGRAM_FIELDS = ['spectrogram', 'mel_spectrogram']
+COUNT_FIELDS = ['chord_trajectory', 'note_trajectory']
+BOOLEAN_FIELDS = ['zero_crossings']
+
+
+# Stored in place of a dB spectrogram: 8-bit codes that map back to dB through the recorded scale and offset,
+# so every value is within scale / 2 of the original
+@dataclass(frozen=True)
+class QuantizedArray:
+    codes: ndarray
+    scale: float
+    offset: float
+
+    def dequantize(self, dtype=np.float32) -> ndarray:
+        return (self.codes * self.scale + self.offset).astype(dtype)
+
+    def max_error(self) -> float:
+        return self.scale / 2
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+
+# Stored in place of a boolean array, 8 values per byte
+@dataclass(frozen=True)
+class PackedBits:
+    bits: ndarray
+    shape: tuple
+
+    def unpack(self) -> ndarray:
+        return np.unpackbits(self.bits, count=prod(self.shape)).astype(bool).reshape(self.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+
+def quantize(array: ndarray) -> QuantizedArray:
+    low, high = float(np.min(array)), float(np.max(array))
+    scale = (high - low) / 255 if high > low else 1.0
+    codes = np.rint((array - low) / scale).astype(np.uint8)
+    return QuantizedArray(codes=codes, scale=scale, offset=low)
+
+
+def pack_bits(array: ndarray) -> PackedBits:
+    return PackedBits(bits=np.packbits(np.asarray(array, dtype=bool), axis=None), shape=np.shape(array))
+
+
+def to_count_dtype(counts):
+    # Smallest unsigned integer type that holds the largest count, e.g. uint8 for most songs
+    values = counts.data if sparse.issparse(counts) else counts
+    largest = int(values.max()) if values.size else 0
+    return counts.astype(np.min_scalar_type(largest))
+
+
+# Turns compacted representation fields back into plain arrays, other values are returned unchanged
+def decode(value):
+    if isinstance(value, QuantizedArray):
+        return value.dequantize()
+    if isinstance(value, PackedBits):
+        return value.unpack()
+    return value
+
+
+def decode_representation(feature_repr: FeatureRepresentation) -> FeatureRepresentation:
+    return FeatureRepresentation(**{field: decode(value) for field, value in vars(feature_repr).items()})
+
+
+# How extracted values are stored. Extraction itself always runs in float64, the policy is applied to the
+# finished FeatureVector and FeatureRepresentation, and to datasets when they are written.
+# spectrogram_dtype is a float dtype, or 'uint8' for 8-bit quantized dB.
+@dataclass(frozen=True)
+class PrecisionPolicy:
+    scalar_dtype: str = 'float64'
+    array_dtype: str = 'float64'
+    spectrogram_dtype: str = 'float64'
+    compact_counts: bool = False
+    pack_bits: bool = False
+
+    def apply_scalar(self, value):
+        # Some scalars, such as bpm, come out of librosa as 1-element arrays
+        if isinstance(value, ndarray):
+            return value.astype(self.scalar_dtype, copy=False)
+        return np.dtype(self.scalar_dtype).type(value)
+
+    def apply_array(self, array):
+        return None if array is None else np.asarray(array).astype(self.array_dtype, copy=False)
+
+    def apply_counts(self, counts):
+        return to_count_dtype(counts) if counts is not None and self.compact_counts else counts
+
+    # Histograms of trajectory encodings are counts, projections are floats
+    def apply_encoding(self, encoding: ndarray):
+        return self.apply_counts(encoding) if np.issubdtype(encoding.dtype, np.integer) else self.apply_array(encoding)
+
+    def apply_vector(self, vector: FeatureVector) -> FeatureVector:
+        return replace(
+            vector,
+            temporal=replace(vector.temporal, **{
+                k: self.apply_scalar(v) for k, v in vars(vector.temporal).items() if v is not None
+            }),
+            spectral=replace(vector.spectral, **{
+                k: self.apply_scalar(v) for k, v in vars(vector.spectral).items() if v is not None
+            }),
+            harmonic=replace(
+                vector.harmonic,
+                chord_trajectory=self.apply_counts(vector.harmonic.chord_trajectory),
+                note_trajectory=self.apply_counts(vector.harmonic.note_trajectory),
+                tonnetz=self.apply_array(vector.harmonic.tonnetz),
+                encodings={k: self.apply_encoding(v) for k, v in vector.harmonic.encodings.items()}
+            )
+        )
+
+    def apply_representation(self, feature_repr: FeatureRepresentation) -> FeatureRepresentation:
+        values = {}
+        for field, value in vars(feature_repr).items():
+            value = decode(value)
+            if value is None:
+                values[field] = None
+            elif field in SPECTROGRAM_FIELDS:
+                values[field] = quantize(value) if self.spectrogram_dtype == 'uint8' \
+                    else value.astype(self.spectrogram_dtype, copy=False)
+            elif field in COUNT_FIELDS:
+                values[field] = self.apply_counts(value)
+            elif field in BOOLEAN_FIELDS:
+                values[field] = pack_bits(value) if self.pack_bits else value
+            else:
+                values[field] = self.apply_array(value)
+        return FeatureRepresentation(**values)
+
+    def apply_dataset(self, dataset: pd.DataFrame) -> pd.DataFrame:
+        dataset = dataset.copy()
+        for column in dataset.columns:
+            if column in METADATA_COLUMNS:
+                continue
+            elif column in TRAJECTORY_FEATURES:
+                dataset[column] = dataset[column].apply(lambda t: self.apply_counts(to_sparse_trajectory(t)))
+            elif dataset[column].dtype != object:
+                dataset[column] = dataset[column].astype(self.scalar_dtype)
+            elif all(isinstance(v, ndarray) and np.size(v) > 1 for v in dataset[column]):
+                dataset[column] = dataset[column].apply(self.apply_encoding)
+            elif all(np.size(v) == 1 for v in dataset[column]):
+                dataset[column] = dataset[column].apply(self.apply_scalar)
+            else:
+                dataset[column] = dataset[column].apply(self.apply_array)
+        return dataset
+
+
+FULL_PRECISION = PrecisionPolicy()
+COMPACT_PRECISION = PrecisionPolicy(scalar_dtype='float32', array_dtype='float32', spectrogram_dtype='float16',
+                                    compact_counts=True, pack_bits=True)
+QUANTIZED_PRECISION = PrecisionPolicy(scalar_dtype='float32', array_dtype='float32', spectrogram_dtype='uint8',
+                                      compact_counts=True, pack_bits=True)
+
+PRECISION_POLICIES = {
+    'full': FULL_PRECISION,
+    'compact': COMPACT_PRECISION,
+    'quantized': QUANTIZED_PRECISION
+}
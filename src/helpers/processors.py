@@ -1,6 +1,12 @@
-from concurrent.futures import ProcessPoolExecutor
+import ast
+import inspect
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from glob import glob
+from itertools import repeat
 from pathlib import Path
+from time import perf_counter
+from typing import Callable, Iterable
 
 import librosa
 import librosa.display
@@ -8,10 +14,15 @@ import librosa.feature
 import librosa.onset
 import numpy as np
 import pandas as pd
+import soxr
 from madmom.features import notes, key, chords
 from scipy.ndimage import zoom
+from scipy.sparse import csr_matrix
 
+from src.helpers.cache import AudioCache
 from src.helpers.constants import CHORD_MAP, MIDI_MAX_NOTE, TONNETZ_LENGTH
+from src.helpers.encodings import RAW_TRAJECTORIES, TrajectoryEncoding
+from src.helpers.precision import FULL_PRECISION, PrecisionPolicy
 from src.models.features import *
 
 
@@ -21,10 +32,12 @@ class AudioDataProcessor:
     data: list[AudioData]
     path_to_directory: str
     limit: int
+    audio_cache: Optional[AudioCache]
 
-    def __init__(self, path_to_directory: str, limit: int = 0):
+    def __init__(self, path_to_directory: str, limit: int = 0, audio_cache: AudioCache = None):
         self.path_to_directory = path_to_directory
         self.limit = limit
+        self.audio_cache = audio_cache
         self.__read_filenames()
 
     def __read_filenames(self):
@@ -35,13 +48,27 @@ class AudioDataProcessor:
             self.audio_files = audio_files
 
     def load(self):
+        if self.audio_cache is not None:
+            self.audio_cache.index(self.audio_files)
         with ProcessPoolExecutor() as ec:
-            self.data = list(ec.map(AudioDataProcessor.load_one, self.audio_files))
+            self.data = list(ec.map(
+                AudioDataProcessor.load_one,
+                self.audio_files,
+                repeat(None),
+                repeat(self.audio_cache)
+            ))
         return self.data
 
+    # With an AudioCache, the waveform is a read-only memory map of the cached decode
     @staticmethod
-    def load_one(audio_file: str, playlist: str = None):
-        waveform, sample_rate = librosa.load(audio_file)
+    def load_one(audio_file: str, playlist: str = None, audio_cache: AudioCache = None):
+        if audio_cache is None:
+            waveform, sample_rate = librosa.load(audio_file)
+        else:
+            sample_rate = audio_cache.sample_rate
+            waveform = audio_cache.load(audio_file)
+            if waveform is None:
+                waveform = audio_cache.store(audio_file, librosa.load(audio_file, sr=sample_rate)[0])
         name = Path(audio_file).stem
         audio_data = AudioData(name=name, waveform=waveform, sample_rate=sample_rate)
         if playlist is not None:
@@ -53,6 +80,54 @@ class AudioDataProcessor:
         pass
 
 
+# Loads each madmom network once per process and reuses it for every track that process handles.
+# Pass ModelRegistry.warm_up as a ProcessPoolExecutor initializer to load them before the first track.
+class ModelRegistry:
+    key_processor = None
+    piano_note_processor = None
+    note_peak_processors: dict = {}
+    chord_processors: dict = {}
+
+    @staticmethod
+    def get_key_processor():
+        if ModelRegistry.key_processor is None:
+            ModelRegistry.key_processor = key.CNNKeyRecognitionProcessor()
+        return ModelRegistry.key_processor
+
+    @staticmethod
+    def get_piano_note_processor():
+        if ModelRegistry.piano_note_processor is None:
+            ModelRegistry.piano_note_processor = notes.RNNPianoNoteProcessor()
+        return ModelRegistry.piano_note_processor
+
+    @staticmethod
+    def get_note_peak_processor(fps: float):
+        if fps not in ModelRegistry.note_peak_processors:
+            ModelRegistry.note_peak_processors[fps] = notes.NoteOnsetPeakPickingProcessor(fps=fps, pitch_offset=21)
+        return ModelRegistry.note_peak_processors[fps]
+
+    @staticmethod
+    def get_chord_processor(fps: float):
+        if fps not in ModelRegistry.chord_processors:
+            ModelRegistry.chord_processors[fps] = chords.DeepChromaChordRecognitionProcessor(fps=fps)
+        return ModelRegistry.chord_processors[fps]
+
+    @staticmethod
+    def warm_up(sample_rate: float = 22050, hop_length: int = 512):
+        fps = sample_rate / hop_length
+        ModelRegistry.get_key_processor()
+        ModelRegistry.get_piano_note_processor()
+        ModelRegistry.get_note_peak_processor(fps)
+        ModelRegistry.get_chord_processor(fps)
+
+
+# One step of FeatureVectorProcessor, along with the steps whose results it reads
+@dataclass(frozen=True)
+class FeatureStep:
+    method: Callable
+    requires: tuple[str, ...] = ()
+
+
 class FeatureVectorProcessor:
     # Processing Parameters
     n_mels: int
@@ -62,15 +137,25 @@ class FeatureVectorProcessor:
     tonnetz_length: int
     chord_map: dict
     ignore_non_chords: bool
+    encoding: TrajectoryEncoding
+
+    # Parameters that change the extracted values, e.g. for keying cached features
+    extraction_param_names = ('n_mels', 'n_mfcc', 'hop_length', 'frame_size', 'tonnetz_length', 'chord_map',
+                              'ignore_non_chords', 'precision', 'encoding')
 
     # Storage Variables
     audio: AudioData
     feature_vector: FeatureVector
-    feature_repr = FeatureRepresentation()
+    feature_repr: FeatureRepresentation
+    # Wall-clock seconds spent in each step of the last process() call
+    step_timings: dict[str, float]
 
     # Intermediate Variables
     beat_frames: ndarray
     beat_times: ndarray
+    magnitude_spectrogram: ndarray
+    power_spectrogram: ndarray
+    log_mel_spectrogram: ndarray
 
     def __init__(self,
                  audio: AudioData,
@@ -81,13 +166,17 @@ class FeatureVectorProcessor:
                  frame_size=2048,
                  tonnetz_length=TONNETZ_LENGTH,
                  chord_map=CHORD_MAP,
-                 ignore_non_chords=True):
+                 ignore_non_chords=True,
+                 precision: PrecisionPolicy = FULL_PRECISION,
+                 encoding: TrajectoryEncoding = RAW_TRAJECTORIES):
         self.feature_vector = FeatureVector(
             audio=audio,
             spectral=SpectralFeatures(),
             temporal=TemporalFeatures(),
             harmonic=HarmonicFeatures()
         )
+        self.feature_repr = FeatureRepresentation()
+        self.step_timings = {}
         self.audio = audio
         self.save_repr = save_repr
         self.n_mels = n_mels
@@ -97,48 +186,140 @@ class FeatureVectorProcessor:
         self.frame_size = frame_size
         self.chord_map = chord_map
         self.ignore_non_chords = ignore_non_chords
+        self.precision = precision
+        self.encoding = encoding
 
-    def process(self):
+    @staticmethod
+    def get_extraction_params(**params) -> dict:
+        # Defaults are taken from __init__, so they stay in sync with what process() actually uses
+        signature = inspect.signature(FeatureVectorProcessor.__init__)
+        defaults = {name: signature.parameters[name].default for name in FeatureVectorProcessor.extraction_param_names}
+        return defaults | params
 
-        # Can be executed in parallel
-        # -- Spectral
-        self.__to_spectrogram()
-        self.__to_mel_spectrogram()
-        self.__to_spectral_centroid()
-        self.__to_spectral_rolloff()
-        self.__to_spectral_flux()
-        self.__to_spectral_flatness()
-        self.__to_mfcc()
-        # -- Temporal
-        self.__to_zero_crossings()
-        # -- Harmonic
-        self.__to_key_signature()
-        self.__to_note_trajectory()
+    @staticmethod
+    def decode_extraction_params(stored_params: dict) -> dict:
+        # Params stored as JSON, e.g. in the manifest, keep precision and encoding as their dataclass reprs such as
+        # "PrecisionPolicy(scalar_dtype='float32', ...)", which are turned back into the dataclasses here.
+        # Other stored values that are not arguments of __init__, such as stream, are left out.
+        params = {}
+        for name, value in stored_params.items():
+            if name not in FeatureVectorProcessor.extraction_param_names:
+                continue
+            if name in ('precision', 'encoding') and isinstance(value, str):
+                call = ast.parse(value, mode='eval').body
+                dataclass_type = {'PrecisionPolicy': PrecisionPolicy, 'TrajectoryEncoding': TrajectoryEncoding}
+                value = dataclass_type[call.func.id](**{k.arg: ast.literal_eval(k.value) for k in call.keywords})
+            params[name] = value
+        return params
+
+    @staticmethod
+    def resolve_steps(features: list[str] = None) -> list[str]:
+        # Requested features plus everything they depend on, in registry order, e.g. ['mfcc'] -> ['stft', 'mfcc']
+        if features is None:
+            return list(FeatureVectorProcessor.steps)
+
+        unknown = set(features) - set(FeatureVectorProcessor.steps)
+        if unknown:
+            raise ValueError(f'Unknown features: {sorted(unknown)}')
+
+        required = set()
+        pending = list(features)
+        while pending:
+            name = pending.pop()
+            if name not in required:
+                required.add(name)
+                pending.extend(FeatureVectorProcessor.steps[name].requires)
+        return [name for name in FeatureVectorProcessor.steps if name in required]
 
-        # Must be executed in order
-        self.__to_bpm()  # 1
-        self.__to_chroma_cqt(self.beat_frames)  # 2
-        self.__to_tonnetz(self.feature_repr.chroma_cqt_sync)  # 3.1
-        self.__to_chord_trajectory(self.feature_repr.chroma_cqt)  # 3.2
+    @staticmethod
+    def get_column_step(column: str) -> str:
+        # Dataset columns are named after the step that computes them, e.g. mfcc_var_3 -> mfcc
+        matches = [name for name in FeatureVectorProcessor.steps if column == name or column.startswith(name + '_')]
+        if not matches:
+            raise ValueError(f'No extraction step computes column: {column}')
+        return max(matches, key=len)
 
+    @staticmethod
+    def get_step_columns(step: str) -> list[str]:
+        vector = FeatureVector(
+            audio=AudioData(name=''),
+            spectral=SpectralFeatures(),
+            temporal=TemporalFeatures(),
+            harmonic=HarmonicFeatures()
+        )
+        columns = [c for c in vector.as_dict() if c not in vector.audio.as_dict()]
+        return [c for c in columns if FeatureVectorProcessor.get_column_step(c) == step]
+
+    def process(self, features: list[str] = None):
+        # Only the requested features and the steps they depend on are computed, every feature by default
+        for name in FeatureVectorProcessor.resolve_steps(features):
+            self.__run_step(name)
+
+        return self.__apply_precision()
+
+    def process_concurrently(self, features: list[str] = None, max_workers: int = None):
+        # Same as process(), but for low latency on a single track: every step starts on a thread pool as soon as
+        # the steps it requires are done. The heavy lifting happens in numpy, librosa and madmom code that
+        # releases the GIL, so independent branches overlap.
+        names = FeatureVectorProcessor.resolve_steps(features)
+        waiting_on = {name: set(FeatureVectorProcessor.steps[name].requires) for name in names}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers or len(names)) as ec:
+            while waiting_on or running:
+                for name in [name for name, requires in waiting_on.items() if not requires]:
+                    del waiting_on[name]
+                    running[ec.submit(self.__run_step, name)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    future.result()
+                    for requires in waiting_on.values():
+                        requires.discard(name)
+
+        return self.__apply_precision()
+
+    # Steps read each other's float64 intermediates, so values are only compacted once all of them are done
+    def __apply_precision(self):
+        self.feature_vector = self.precision.apply_vector(self.feature_vector)
+        if self.save_repr:
+            self.feature_repr = self.precision.apply_representation(self.feature_repr)
         return self.feature_vector, self.feature_repr
 
-    def __to_spectrogram(self):
-        stft_data = librosa.stft(self.audio.waveform)
-        spectrogram = librosa.amplitude_to_db(np.abs(stft_data), ref=np.max)
+    def __run_step(self, name: str):
+        start = perf_counter()
+        FeatureVectorProcessor.steps[name].method(self)
+        self.step_timings[name] = perf_counter() - start
+
+    def process_spectral(self):
+        self.process(FeatureVectorProcessor.spectral_features)
+        return self.feature_vector.spectral
+
+    def __to_stft(self):
+        # Computed once per track instead of once per librosa.feature call
+        stft_data = librosa.stft(self.audio.waveform, n_fft=self.frame_size, hop_length=self.hop_length)
+        self.magnitude_spectrogram = np.abs(stft_data)
+        self.power_spectrogram = self.magnitude_spectrogram ** 2
 
+        # librosa's default 128-band log-power mel spectrogram, as used internally by mfcc and onset_strength
+        mel_data = librosa.feature.melspectrogram(S=self.power_spectrogram, sr=self.audio.sample_rate)
+        self.log_mel_spectrogram = librosa.power_to_db(mel_data)
+
+    def __to_spectrogram(self):
         if self.save_repr:
+            spectrogram = librosa.amplitude_to_db(self.magnitude_spectrogram, ref=np.max)
             self.feature_repr.spectrogram = spectrogram
 
     def __to_mel_spectrogram(self):
-        mel_data = librosa.feature.melspectrogram(y=self.audio.waveform, sr=self.audio.sample_rate, n_mels=self.n_mels)
-        mel_spectrogram = librosa.amplitude_to_db(np.abs(mel_data), ref=np.max)
-
         if self.save_repr:
+            mel_data = librosa.feature.melspectrogram(S=self.power_spectrogram, sr=self.audio.sample_rate,
+                                                      n_mels=self.n_mels)
+            mel_spectrogram = librosa.amplitude_to_db(mel_data, ref=np.max)
             self.feature_repr.mel_spectrogram = mel_spectrogram
 
     def __to_spectral_centroid(self):
-        spectral_centroid = librosa.feature.spectral_centroid(y=self.audio.waveform, sr=self.audio.sample_rate)
+        spectral_centroid = librosa.feature.spectral_centroid(S=self.magnitude_spectrogram, sr=self.audio.sample_rate)
 
         self.feature_vector.spectral.spectral_centroid_mean = spectral_centroid.mean()
         self.feature_vector.spectral.spectral_centroid_var = spectral_centroid.var()
@@ -147,7 +328,7 @@ class FeatureVectorProcessor:
             self.feature_repr.spectral_centroid = spectral_centroid[0]
 
     def __to_spectral_rolloff(self):
-        spectral_rolloff = librosa.feature.spectral_rolloff(y=self.audio.waveform, sr=self.audio.sample_rate)
+        spectral_rolloff = librosa.feature.spectral_rolloff(S=self.magnitude_spectrogram, sr=self.audio.sample_rate)
 
         self.feature_vector.spectral.spectral_rolloff_mean = spectral_rolloff.mean()
         self.feature_vector.spectral.spectral_rolloff_var = spectral_rolloff.var()
@@ -158,7 +339,7 @@ class FeatureVectorProcessor:
     def __to_spectral_flux(self):
         # Spectral flux
         # squared distance between normalised magnitudes of successive spectral distributions
-        spectral_flux = librosa.onset.onset_strength(y=self.audio.waveform, sr=self.audio.sample_rate)
+        spectral_flux = librosa.onset.onset_strength(S=self.log_mel_spectrogram, sr=self.audio.sample_rate)
 
         self.feature_vector.spectral.spectral_flux_mean = spectral_flux.mean()
         self.feature_vector.spectral.spectral_flux_var = spectral_flux.var()
@@ -169,7 +350,7 @@ class FeatureVectorProcessor:
     def __to_spectral_flatness(self):
         # Spectral flatness
         # high flatness = white noise, low flatness = musical
-        spectral_flatness = librosa.feature.spectral_flatness(y=self.audio.waveform)
+        spectral_flatness = librosa.feature.spectral_flatness(S=self.magnitude_spectrogram)
 
         self.feature_vector.spectral.spectral_flatness_mean = spectral_flatness.mean()
         self.feature_vector.spectral.spectral_flatness_var = spectral_flatness.var()
@@ -181,7 +362,7 @@ class FeatureVectorProcessor:
         max_mfcc = 10
 
         # 13 MFCC coefficients, and using only the first 5 excluding DC component
-        cepstral_coefficients = librosa.feature.mfcc(y=self.audio.waveform, sr=self.audio.sample_rate,
+        cepstral_coefficients = librosa.feature.mfcc(S=self.log_mel_spectrogram, sr=self.audio.sample_rate,
                                                      n_mfcc=self.n_mfcc)
 
         for i in range(1, max_mfcc+1):
@@ -201,13 +382,16 @@ class FeatureVectorProcessor:
             self.feature_repr.zero_crossings = zero_crossings
 
     def __to_key_signature(self):
-        key_proc = key.CNNKeyRecognitionProcessor()
+        key_proc = ModelRegistry.get_key_processor()
         global_key_prob = key_proc(self.audio.waveform)
         self.feature_vector.harmonic.key_signature = global_key_prob.argmax()
 
     # Todo: must be synchronous, but ignore first
     def __to_bpm(self):
-        bpm, beat_frames = librosa.beat.beat_track(y=self.audio.waveform, sr=self.audio.sample_rate)
+        # Same onset envelope beat_track would compute from the waveform, derived from the shared mel spectrogram
+        onset_envelope = librosa.onset.onset_strength(S=self.log_mel_spectrogram, sr=self.audio.sample_rate,
+                                                      aggregate=np.median)
+        bpm, beat_frames = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=self.audio.sample_rate)
 
         self.beat_frames = beat_frames
         self.beat_times = librosa.frames_to_time(beat_frames)
@@ -215,7 +399,7 @@ class FeatureVectorProcessor:
         self.feature_vector.temporal.bpm = bpm
 
     # Todo: must be synchronous, but ignore first
-    def __to_chroma_cqt(self, beat_frames):
+    def __to_chroma_cqt(self):
         # Order of calling: bpm, chroma_cqt, chroma_sync, tonnetz
 
         # CQT used for harmonic content over STFT for rhythmic content
@@ -223,13 +407,13 @@ class FeatureVectorProcessor:
         self.feature_repr.chroma_cqt = chroma_cqt
 
         # np.max to get most prominent notes (beat_frames must be populated)
-        chroma_cqt_sync = librosa.util.sync(chroma_cqt, beat_frames, aggregate=np.max)
+        chroma_cqt_sync = librosa.util.sync(chroma_cqt, self.beat_frames, aggregate=np.max)
         self.feature_repr.chroma_cqt_sync = chroma_cqt_sync
 
     # Todo: must be synchronous, but ignore first
     # should be chroma_cqt_sync, but chroma_cqt works too
-    def __to_tonnetz(self, chroma_cqt):
-        tonnetz = librosa.feature.tonnetz(sr=self.audio.sample_rate, chroma=chroma_cqt)
+    def __to_tonnetz(self):
+        tonnetz = librosa.feature.tonnetz(sr=self.audio.sample_rate, chroma=self.feature_repr.chroma_cqt_sync)
 
         self.feature_vector.harmonic.tonnetz = standardize_tonnetz(tonnetz, self.tonnetz_length)
 
@@ -238,101 +422,483 @@ class FeatureVectorProcessor:
 
     # Todo: must be synchronous, but ignore first
     # should be chroma_cqt
-    def __to_chord_trajectory(self, chroma_cqt):
+    def __to_chord_trajectory(self):
         # Get a list of chords and the start/end time of their occurrences
-        decode = chords.DeepChromaChordRecognitionProcessor(fps=self.audio.sample_rate / self.hop_length)
-        chord_time_matrix = decode(chroma_cqt.T)
+        decode = ModelRegistry.get_chord_processor(self.audio.sample_rate / self.hop_length)
+        chord_time_matrix = decode(self.feature_repr.chroma_cqt.T)
 
         # Group the chords by beat instead of based on arbitrary start/end time
-        chord_beat_df = self.__construct_chord_beat_df(chord_time_matrix)
+        chord_beat_df = construct_chord_beat_df(self.beat_times, chord_time_matrix, self.chord_map)
 
         # Accumulate occurrences into a chord trajectory matrix
-        chord_trajectory = self.__construct_chord_trajectory(chord_beat_df)
+        chord_trajectory = construct_chord_trajectory(chord_beat_df, self.chord_map, self.ignore_non_chords)
         if self.save_repr:
             self.feature_repr.chord_trajectory = chord_trajectory
 
         # Process the matrix into the feature vector
-        chord_vector = self.__process_chord_trajectory_as_feature(chord_trajectory)
-        self.feature_vector.harmonic.chord_trajectory = chord_vector
-
-    def __construct_chord_beat_df(self, chord_time_matrix: ndarray):
-        start_idx, end_idx, current_idx = 0, 0, 0
-        chord_beat_matrix: list = self.beat_times.tolist()
-
-        for start_time, end_time, chord_label in chord_time_matrix:
-
-            for enum, beat_time in enumerate(self.beat_times[start_idx:]):
-                # get current index and set as end index, exclusive
-                current_idx = enum + start_idx
-                if beat_time < end_time:
-                    chord_beat_matrix[current_idx] = beat_time, self.chord_map[chord_label]
-                else:
-                    break
-
-            start_idx = current_idx
-
-        return pd.DataFrame(chord_beat_matrix, columns=['beat_time', 'chord'])
-
-    def __construct_chord_trajectory(self, chord_beat_matrix: pd.DataFrame):
-        chord_count = len(self.chord_map)
-        max_chord = chord_count - 1
-        chord_trajectory = np.zeros(shape=(chord_count, chord_count))
-
-        for x in range(0, chord_beat_matrix.shape[0] - 1):
-            chord_x = chord_beat_matrix['chord'].iloc[x]
-            chord_y = chord_beat_matrix['chord'].iloc[x + 1]
-
-            if self.ignore_non_chords:
-                if chord_x == max_chord and chord_y == max_chord:
-                    continue
-                elif chord_x == max_chord and chord_y != max_chord:
-                    chord_trajectory[chord_y, chord_y] += 1
-                elif chord_x != max_chord and chord_y == max_chord:
-                    chord_trajectory[chord_x, chord_x] += 1
-                else:
-                    chord_trajectory[chord_y, chord_x] += 1
-            else:
-                chord_trajectory[chord_y, chord_x] += 1
-
-        return chord_trajectory
-
-    # Todo: implement (dimensionality reduction)
-    def __process_chord_trajectory_as_feature(self, chord_trajectory: ndarray):
-        return chord_trajectory.flatten()
+        harmonic = self.feature_vector.harmonic
+        harmonic.encodings.update(self.encoding.encode_chord_trajectory(chord_trajectory, self.chord_map))
+        if self.encoding.keep_raw:
+            harmonic.chord_trajectory = process_trajectory_as_feature(chord_trajectory)
 
     def __to_note_trajectory(self):
-        note_peak_proc = notes.NoteOnsetPeakPickingProcessor(
-            fps=self.audio.sample_rate / self.hop_length, pitch_offset=21)
-        piano_note_proc = notes.RNNPianoNoteProcessor()(self.audio.waveform)
+        note_peak_proc = ModelRegistry.get_note_peak_processor(self.audio.sample_rate / self.hop_length)
+        piano_note_proc = ModelRegistry.get_piano_note_processor()(self.audio.waveform)
         note_time_matrix = note_peak_proc(piano_note_proc)
 
-        note_trajectory = self.__construct_note_trajectory(note_time_matrix)
+        note_trajectory = construct_note_trajectory(note_time_matrix)
         if self.save_repr:
             self.feature_repr.note_trajectory = note_trajectory
 
-        note_vector = self.__process_note_trajectory_as_feature(note_trajectory)
-        self.feature_vector.harmonic.note_trajectory = note_vector
+        harmonic = self.feature_vector.harmonic
+        harmonic.encodings.update(self.encoding.encode_note_trajectory(note_trajectory))
+        if self.encoding.keep_raw:
+            harmonic.note_trajectory = process_trajectory_as_feature(note_trajectory)
 
-    def __construct_note_trajectory(self, note_time_matrix: ndarray):
-        note_trajectory = np.zeros(shape=(MIDI_MAX_NOTE, MIDI_MAX_NOTE))
+    # Every step and its inputs. Steps without a dependency between them can be executed in parallel,
+    # and the order here is the order they run in.
+    steps = {
+        # -- Shared spectral front-end
+        'stft': FeatureStep(__to_stft),
+        # -- Spectral
+        'spectrogram': FeatureStep(__to_spectrogram, requires=('stft',)),
+        'mel_spectrogram': FeatureStep(__to_mel_spectrogram, requires=('stft',)),
+        'spectral_centroid': FeatureStep(__to_spectral_centroid, requires=('stft',)),
+        'spectral_rolloff': FeatureStep(__to_spectral_rolloff, requires=('stft',)),
+        'spectral_flux': FeatureStep(__to_spectral_flux, requires=('stft',)),
+        'spectral_flatness': FeatureStep(__to_spectral_flatness, requires=('stft',)),
+        'mfcc': FeatureStep(__to_mfcc, requires=('stft',)),
+        # -- Temporal
+        'zero_crossings': FeatureStep(__to_zero_crossings),
+        # -- Harmonic
+        'key_signature': FeatureStep(__to_key_signature),
+        'note_trajectory': FeatureStep(__to_note_trajectory),
+        # -- Must be executed in order: bpm, chroma, then tonnetz and chords
+        'bpm': FeatureStep(__to_bpm, requires=('stft',)),
+        'chroma_cqt': FeatureStep(__to_chroma_cqt, requires=('bpm',)),
+        'tonnetz': FeatureStep(__to_tonnetz, requires=('chroma_cqt',)),
+        'chord_trajectory': FeatureStep(__to_chord_trajectory, requires=('bpm', 'chroma_cqt')),
+    }
+
+    spectral_features = ['spectrogram', 'mel_spectrogram', 'spectral_centroid', 'spectral_rolloff',
+                         'spectral_flux', 'spectral_flatness', 'mfcc']
+
+
+class RunningStatistics:
+    # Running mean and population variance along the last axis, merged one block at a time
+    count: int
+    mean: ndarray
+    m2: ndarray
+
+    def __init__(self):
+        self.count = 0
+        self.mean = np.float64(0)
+        self.m2 = np.float64(0)
+
+    def update(self, values: ndarray):
+        n = values.shape[-1]
+        if n == 0:
+            return
+
+        values = values.astype(np.float64)
+        block_mean = values.mean(axis=-1)
+        block_m2 = ((values - block_mean[..., np.newaxis]) ** 2).sum(axis=-1)
+
+        # Chan et al. pairwise update, numerically stable for hour-long tracks
+        total = self.count + n
+        delta = block_mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + block_m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    def var(self):
+        return self.m2 / self.count
+
+
+# Constant-memory alternative to AudioDataProcessor.load_one + FeatureVectorProcessor.process for long tracks.
+# Audio is read in blocks with librosa.stream and resampled on the fly, spectral and temporal features are kept
+# as running accumulators, and harmonic features are computed on fixed-length windows and merged.
+# Values closely match the in-memory processor but are not bit-identical (per-block top_db clipping,
+# per-window beat tracking), and representations are not available in this mode.
+class StreamingFeatureVectorProcessor:
+    # Processing Parameters
+    n_mfcc: int
+    hop_length: int
+    frame_size: int
+    tonnetz_length: int
+    chord_map: dict
+    ignore_non_chords: bool
+    sample_rate: int
+    block_length: int
+    window_length: int
 
-        for x in range(note_time_matrix.shape[0] - 1):
-            note_x = int(note_time_matrix[x][1])
-            note_y = int(note_time_matrix[x + 1][1])
-            note_trajectory[note_y, note_x] += 1
+    # Storage Variables
+    audio_file: str
+    audio: AudioData
+    feature_vector: FeatureVector
 
-        return note_trajectory
+    # Buffers, bounded by frame_size and 2 x window_length samples respectively
+    frame_buffer: ndarray
+    window_buffer: list[ndarray]
+    window_buffer_length: int
+
+    # Accumulators
+    zero_crossings: RunningStatistics
+    spectral_centroid: RunningStatistics
+    spectral_rolloff: RunningStatistics
+    spectral_flux: RunningStatistics
+    spectral_flatness: RunningStatistics
+    mfccs: RunningStatistics
+    note_trajectory: ndarray
+    chord_trajectory: ndarray
+    tonnetz: list[ndarray]
+    key_probabilities: ndarray
+    weighted_bpm: float
+    duration: float
+
+    # Carried across block and window boundaries
+    last_sample: Optional[ndarray] = None
+    last_log_mel_frame: Optional[ndarray] = None
+    pending_flux: ndarray
+    last_note: Optional[ndarray] = None
+    last_chord: Optional[pd.DataFrame] = None
 
-    # Todo: implement (dimensionality reduction)
-    def __process_note_trajectory_as_feature(self, note_trajectory: ndarray):
-        return note_trajectory.flatten()
+    def __init__(self,
+                 audio_file: str,
+                 playlist: str = None,
+                 n_mfcc=13,
+                 hop_length=512,
+                 frame_size=2048,
+                 tonnetz_length=TONNETZ_LENGTH,
+                 chord_map=CHORD_MAP,
+                 ignore_non_chords=True,
+                 sample_rate=22050,
+                 block_length=256,
+                 window_duration=60.0,
+                 precision: PrecisionPolicy = FULL_PRECISION,
+                 encoding: TrajectoryEncoding = RAW_TRAJECTORIES):
+        self.audio_file = audio_file
+        self.audio = AudioData(name=Path(audio_file).stem, sample_rate=sample_rate)
+        if playlist is not None:
+            self.audio.playlist = playlist
+        self.feature_vector = FeatureVector(
+            audio=self.audio,
+            spectral=SpectralFeatures(),
+            temporal=TemporalFeatures(),
+            harmonic=HarmonicFeatures()
+        )
+        self.n_mfcc = n_mfcc
+        self.hop_length = hop_length
+        self.frame_size = frame_size
+        self.tonnetz_length = tonnetz_length
+        self.chord_map = chord_map
+        self.ignore_non_chords = ignore_non_chords
+        self.sample_rate = sample_rate
+        self.block_length = block_length
+        self.window_length = int(window_duration * sample_rate)
+        self.precision = precision
+        self.encoding = encoding
+
+        # Same constant padding as librosa.stft(center=True)
+        self.frame_buffer = np.zeros(frame_size // 2, dtype=np.float32)
+        self.window_buffer = []
+        self.window_buffer_length = 0
+
+        self.zero_crossings = RunningStatistics()
+        self.spectral_centroid = RunningStatistics()
+        self.spectral_rolloff = RunningStatistics()
+        self.spectral_flux = RunningStatistics()
+        self.spectral_flatness = RunningStatistics()
+        self.mfccs = RunningStatistics()
+        self.note_trajectory = np.zeros(shape=(MIDI_MAX_NOTE, MIDI_MAX_NOTE), dtype=np.int32)
+        self.chord_trajectory = np.zeros(shape=(len(chord_map), len(chord_map)), dtype=np.int32)
+        self.tonnetz = []
+        self.key_probabilities = np.float64(0)
+        self.weighted_bpm = 0.0
+        self.duration = 0.0
+
+        # onset_strength pads lag + n_fft // (2 * hop_length) leading zeros and trims as many trailing values less
+        # the lag of 1, so that many values are always held back and dropped once the track ends
+        self.flux_held_back = frame_size // (2 * hop_length)
+        self.pending_flux = np.zeros(1 + self.flux_held_back)
+
+        self.key_processor = ModelRegistry.get_key_processor()
+        self.piano_note_processor = ModelRegistry.get_piano_note_processor()
+        self.note_peak_processor = ModelRegistry.get_note_peak_processor(sample_rate / hop_length)
+        self.chord_processor = ModelRegistry.get_chord_processor(sample_rate / hop_length)
+
+    def process(self):
+        for block in self.__read_blocks():
+            # -- Temporal
+            self.__to_zero_crossings(block)
+            # -- Spectral
+            self.__to_frames(block)
+            # -- Harmonic
+            self.__to_window(block)
+
+        self.__to_frames(np.zeros(self.frame_size // 2, dtype=np.float32))
+        self.__to_window(np.zeros(0, dtype=np.float32), last=True)
+        self.__to_features()
+
+        self.feature_vector = self.precision.apply_vector(self.feature_vector)
+        return self.feature_vector
+
+    def __read_blocks(self):
+        native_sample_rate = librosa.get_samplerate(self.audio_file)
+
+        # frame_length == hop_length yields contiguous, non-overlapping blocks of raw audio
+        stream = librosa.stream(self.audio_file, block_length=self.block_length,
+                                frame_length=self.frame_size, hop_length=self.frame_size)
+
+        if native_sample_rate == self.sample_rate:
+            yield from stream
+            return
+
+        # Same soxr_hq resampler used by librosa.load, kept stateful across blocks
+        resampler = soxr.ResampleStream(native_sample_rate, self.sample_rate, 1, dtype='float32')
+        for block in stream:
+            yield resampler.resample_chunk(block)
+        yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+    def __to_zero_crossings(self, block: ndarray):
+        if len(block) == 0:
+            return
+
+        if self.last_sample is None:
+            zero_crossings = librosa.zero_crossings(block)
+        else:
+            zero_crossings = librosa.zero_crossings(np.concatenate([self.last_sample, block]), pad=False)[1:]
+
+        self.last_sample = block[-1:]
+        self.zero_crossings.update(zero_crossings)
+
+    def __to_frames(self, block: ndarray):
+        self.frame_buffer = np.concatenate([self.frame_buffer, block])
+        if len(self.frame_buffer) < self.frame_size:
+            return
+
+        # Only whole frames are transformed, the overlap is kept for the next block
+        n_frames = 1 + (len(self.frame_buffer) - self.frame_size) // self.hop_length
+        used_length = self.frame_size + (n_frames - 1) * self.hop_length
+        stft_data = librosa.stft(self.frame_buffer[:used_length], n_fft=self.frame_size,
+                                 hop_length=self.hop_length, center=False)
+        self.frame_buffer = self.frame_buffer[n_frames * self.hop_length:]
+
+        self.__to_spectral(np.abs(stft_data))
+
+    def __to_spectral(self, magnitude_spectrogram: ndarray):
+        self.spectral_centroid.update(
+            librosa.feature.spectral_centroid(S=magnitude_spectrogram, sr=self.sample_rate)[0])
+        self.spectral_rolloff.update(
+            librosa.feature.spectral_rolloff(S=magnitude_spectrogram, sr=self.sample_rate)[0])
+        self.spectral_flatness.update(
+            librosa.feature.spectral_flatness(S=magnitude_spectrogram)[0])
+
+        mel_data = librosa.feature.melspectrogram(S=magnitude_spectrogram ** 2, sr=self.sample_rate)
+        log_mel_spectrogram = librosa.power_to_db(mel_data)
+        self.mfccs.update(librosa.feature.mfcc(S=log_mel_spectrogram, n_mfcc=self.n_mfcc))
+        self.__to_spectral_flux(log_mel_spectrogram)
+
+    def __to_spectral_flux(self, log_mel_spectrogram: ndarray):
+        # Same as onset_strength with lag=1, using the last frame of the previous block as reference
+        if self.last_log_mel_frame is not None:
+            log_mel_spectrogram = np.concatenate([self.last_log_mel_frame, log_mel_spectrogram], axis=1)
+        self.last_log_mel_frame = log_mel_spectrogram[:, -1:]
+
+        spectral_flux = np.maximum(0.0, np.diff(log_mel_spectrogram, axis=1)).mean(axis=0)
+
+        pending_flux = np.concatenate([self.pending_flux, spectral_flux])
+        n_ready = max(len(pending_flux) - self.flux_held_back, 0)
+        self.spectral_flux.update(pending_flux[:n_ready])
+        self.pending_flux = pending_flux[n_ready:]
+
+    # A window is only processed once the next one is full as well, so the tail of the track is never a window of
+    # its own: anything shorter than window_length is merged into the last window
+    def __to_window(self, block: ndarray, last=False):
+        self.window_buffer.append(block)
+        self.window_buffer_length += len(block)
+
+        if self.window_buffer_length >= 2 * self.window_length:
+            buffer = np.concatenate(self.window_buffer)
+            while len(buffer) >= 2 * self.window_length:
+                self.__to_harmonic(buffer[:self.window_length])
+                buffer = buffer[self.window_length:]
+            self.window_buffer = [buffer]
+            self.window_buffer_length = len(buffer)
+
+        if last and self.window_buffer_length > 0:
+            window = np.concatenate(self.window_buffer)
+            self.window_buffer = []
+            self.window_buffer_length = 0
+            self.__to_harmonic(window)
+
+    def __to_harmonic(self, window: ndarray):
+        window_duration = len(window) / self.sample_rate
+        self.duration += window_duration
+
+        # -- Key, weighted by window duration
+        self.key_probabilities = self.key_probabilities + self.key_processor(window) * window_duration
+
+        # -- Notes
+        note_time_matrix = self.note_peak_processor(self.piano_note_processor(window))
+        self.__to_note_trajectory(note_time_matrix)
+
+        # -- Must be executed in order
+        bpm, beat_frames = librosa.beat.beat_track(y=window, sr=self.sample_rate)
+        self.weighted_bpm += float(np.mean(bpm)) * window_duration
+        beat_times = librosa.frames_to_time(beat_frames, sr=self.sample_rate)
+
+        chroma_cqt = librosa.feature.chroma_cqt(y=window, sr=self.sample_rate)
+        chroma_cqt_sync = librosa.util.sync(chroma_cqt, beat_frames, aggregate=np.max)
+        self.tonnetz.append(librosa.feature.tonnetz(sr=self.sample_rate, chroma=chroma_cqt_sync))
+
+        chord_time_matrix = self.chord_processor(chroma_cqt.T)
+        self.__to_chord_trajectory(beat_times, chord_time_matrix)
+
+    def __to_note_trajectory(self, note_time_matrix: ndarray):
+        if len(note_time_matrix) == 0:
+            return
+
+        # Include the transition from the last note of the previous window
+        if self.last_note is not None:
+            note_time_matrix = np.concatenate([self.last_note, note_time_matrix])
+        self.last_note = note_time_matrix[-1:]
+
+        self.note_trajectory += construct_note_trajectory(note_time_matrix)
+
+    def __to_chord_trajectory(self, beat_times: ndarray, chord_time_matrix: ndarray):
+        chord_beat_df = construct_chord_beat_df(beat_times, chord_time_matrix, self.chord_map)
+        if len(chord_beat_df) == 0:
+            return
+
+        # Include the transition from the last chord of the previous window
+        if self.last_chord is not None:
+            chord_beat_df = pd.concat([self.last_chord, chord_beat_df], ignore_index=True)
+        self.last_chord = chord_beat_df.iloc[-1:]
+
+        self.chord_trajectory += construct_chord_trajectory(chord_beat_df, self.chord_map, self.ignore_non_chords)
+
+    def __to_features(self):
+        max_mfcc = 10
+        temporal = self.feature_vector.temporal
+        spectral = self.feature_vector.spectral
+        harmonic = self.feature_vector.harmonic
+
+        temporal.zero_crossings_mean = self.zero_crossings.mean
+        temporal.zero_crossings_var = self.zero_crossings.var()
+        # No window for empty audio, 0 like beat_track gives for silence
+        temporal.bpm = self.weighted_bpm / self.duration if self.duration > 0 else 0.0
+
+        spectral.spectral_centroid_mean = self.spectral_centroid.mean
+        spectral.spectral_centroid_var = self.spectral_centroid.var()
+        spectral.spectral_rolloff_mean = self.spectral_rolloff.mean
+        spectral.spectral_rolloff_var = self.spectral_rolloff.var()
+        spectral.spectral_flux_mean = self.spectral_flux.mean
+        spectral.spectral_flux_var = self.spectral_flux.var()
+        spectral.spectral_flatness_mean = self.spectral_flatness.mean
+        spectral.spectral_flatness_var = self.spectral_flatness.var()
+
+        mfcc_var = self.mfccs.var()
+        for i in range(1, max_mfcc+1):
+            setattr(spectral, f'mfcc_mean_{i}', self.mfccs.mean[i])
+            setattr(spectral, f'mfcc_var_{i}', mfcc_var[i])
+
+        harmonic.key_signature = self.key_probabilities.argmax()
+        tonnetz = np.concatenate(self.tonnetz, axis=1) if self.tonnetz else np.zeros((6, 0))
+        harmonic.tonnetz = standardize_tonnetz(tonnetz, self.tonnetz_length)
+        harmonic.encodings = self.encoding.encode_note_trajectory(self.note_trajectory) \
+            | self.encoding.encode_chord_trajectory(self.chord_trajectory, self.chord_map)
+        if self.encoding.keep_raw:
+            harmonic.chord_trajectory = process_trajectory_as_feature(self.chord_trajectory)
+            harmonic.note_trajectory = process_trajectory_as_feature(self.note_trajectory)
 
 
 def standardize_tonnetz(tonnetz: ndarray, tonnetz_length: int = TONNETZ_LENGTH):
     flattened_tonnetz = tonnetz.flatten()
+    # Silent or empty audio has no beats to sync the tonnetz to
+    if len(flattened_tonnetz) == 0:
+        return np.zeros(tonnetz_length, dtype=flattened_tonnetz.dtype)
     if len(flattened_tonnetz) != tonnetz_length:
         zoom_factor = tonnetz_length / len(flattened_tonnetz)
         standardized_tonnetz = zoom(flattened_tonnetz, zoom_factor)
         return standardized_tonnetz
     else:
         return flattened_tonnetz
+
+
+# Batch version of standardize_tonnetz returning one (songs x tonnetz_length) matrix. Arrays of the same length
+# are zoomed together as one block, which matches zooming each row on its own up to floating point rounding.
+def standardize_tonnetz_batch(tonnetz_arrays: Iterable[ndarray], tonnetz_length: int = TONNETZ_LENGTH) -> ndarray:
+    flattened = [np.ravel(tonnetz) for tonnetz in tonnetz_arrays]
+    dtype = np.result_type(*flattened) if flattened else np.float64
+    standardized = np.empty((len(flattened), tonnetz_length), dtype=dtype)
+
+    rows_by_length = {}
+    for row, tonnetz in enumerate(flattened):
+        rows_by_length.setdefault(len(tonnetz), []).append(row)
+    for length, rows in rows_by_length.items():
+        block = np.stack([flattened[row] for row in rows])
+        if length == 0:
+            standardized[rows] = 0
+        else:
+            standardized[rows] = block if length == tonnetz_length else zoom(block, (1, tonnetz_length / length))
+    return standardized
+
+
+def construct_chord_beat_df(beat_times: ndarray, chord_time_matrix: ndarray, chord_map: dict = CHORD_MAP):
+    if len(chord_time_matrix) == 0 or len(beat_times) == 0:
+        return pd.DataFrame(columns=['beat_time', 'chord'])
+
+    _, end_times, chord_labels = zip(*chord_time_matrix)
+    end_times = np.asarray(end_times, dtype=float)
+    chord_indices = np.array([chord_map[chord_label] for chord_label in chord_labels])
+
+    # Each beat belongs to the first chord segment that ends after it,
+    # beats after the last segment have no chord and are left out
+    segment_idx = np.searchsorted(end_times, beat_times, side='right')
+    has_chord = segment_idx < len(end_times)
+    beat_chords = chord_indices[segment_idx[has_chord]]
+
+    # Once segments run past the last beat, each later segment relabels it, leaving the final segment's chord
+    if has_chord[-1]:
+        beat_chords[-1] = chord_indices[-1]
+
+    return pd.DataFrame({'beat_time': beat_times[has_chord], 'chord': beat_chords})
+
+
+def construct_chord_trajectory(chord_beat_matrix: pd.DataFrame, chord_map: dict = CHORD_MAP,
+                               ignore_non_chords: bool = True):
+    chord_count = len(chord_map)
+    max_chord = chord_count - 1
+
+    beat_chords = chord_beat_matrix['chord'].to_numpy(dtype=int)
+    chord_x, chord_y = beat_chords[:-1], beat_chords[1:]
+
+    if ignore_non_chords:
+        # Non-chord to non-chord is skipped, and moving into or out of a non-chord counts as staying on the chord
+        x_is_non_chord, y_is_non_chord = chord_x == max_chord, chord_y == max_chord
+        keep = ~(x_is_non_chord & y_is_non_chord)
+        rows = np.where(y_is_non_chord, chord_x, chord_y)[keep]
+        columns = np.where(x_is_non_chord, chord_y, chord_x)[keep]
+    else:
+        rows, columns = chord_y, chord_x
+
+    transitions = np.bincount(rows * chord_count + columns, minlength=chord_count * chord_count)
+    return transitions.reshape(chord_count, chord_count).astype(np.int32)
+
+
+def construct_note_trajectory(note_time_matrix: ndarray):
+    if len(note_time_matrix) < 2:
+        return np.zeros(shape=(MIDI_MAX_NOTE, MIDI_MAX_NOTE), dtype=np.int32)
+
+    note_sequence = note_time_matrix[:, 1].astype(int)
+    note_x, note_y = note_sequence[:-1], note_sequence[1:]
+
+    transitions = np.bincount(note_y * MIDI_MAX_NOTE + note_x, minlength=MIDI_MAX_NOTE * MIDI_MAX_NOTE)
+    return transitions.reshape(MIDI_MAX_NOTE, MIDI_MAX_NOTE).astype(np.int32)
+
+
+# Trajectories are almost entirely zeros, so they are kept as sparse 1 x n rows of counts.
+# Smaller fixed-length encodings can be stored next to or instead of them, see TrajectoryEncoding.
+def process_trajectory_as_feature(trajectory: ndarray):
+    return csr_matrix(trajectory.reshape(1, -1))
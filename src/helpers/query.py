@@ -1,42 +1,211 @@
+from typing import Optional
+
+import numpy as np
 import pandas as pd
+from numpy import ndarray
+from sklearn.cluster import KMeans
 from sklearn.neighbors import NearestNeighbors
 
+from src.helpers.cache import hash_matrix
+from src.helpers.repositories import ZstdIO, get_io
+
+
+# Index backends return the distances and positions of the k nearest points for many query points at once.
+# Building an index records a fingerprint of its points, so a saved index is only reused for the same points.
+class AbstractNeighbourIndex:
+    fingerprint: Optional[str] = None
+
+    def build(self, points: ndarray) -> 'AbstractNeighbourIndex':
+        pass
+
+    def query(self, points: ndarray, k: int) -> tuple[ndarray, ndarray]:
+        pass
+
+    def __len__(self) -> int:
+        pass
+
+    # Built indexes are saved so a new process can load them instead of building them again
+    def save(self, path: str) -> str:
+        ZstdIO().save(path, self)
+        return path + ZstdIO.file_ext()
+
+    @staticmethod
+    def load(path: str) -> 'AbstractNeighbourIndex':
+        return get_io(path).load(path)
+
+
+class ExactIndex(AbstractNeighbourIndex):
+    nn: NearestNeighbors
+
+    def __init__(self):
+        self.nn = NearestNeighbors()
+
+    def build(self, points: ndarray) -> 'ExactIndex':
+        points = np.asarray(points, dtype=np.float64)
+        self.nn.fit(points)
+        self.fingerprint = hash_matrix(points)
+        return self
+
+    def query(self, points: ndarray, k: int) -> tuple[ndarray, ndarray]:
+        return self.nn.kneighbors(points, k)
+
+    def __len__(self) -> int:
+        return getattr(self.nn, 'n_samples_fit_', 0)
+
+
+# Inverted file index: points are partitioned by k-means, and a query only compares against the points of the
+# n_probe partitions with the closest centroids. n_probe trades recall for latency, with n_probe = n_lists
+# every point is compared and the results are exact. Queries that would see fewer than k points fall back to
+# an exact search.
+class IVFIndex(AbstractNeighbourIndex):
+    n_lists: int
+    n_probe: int
+    seed: int
+    batch_size: int
+
+    # Built, points are sorted by partition so each partition is one contiguous slice
+    centroids: ndarray
+    points: ndarray
+    squared_norms: ndarray
+    positions: ndarray
+    offsets: ndarray
+
+    def __init__(self, n_lists: int = None, n_probe: int = 8, seed: int = 0, batch_size: int = 1024):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+        self.batch_size = batch_size
+        self.points = np.empty((0, 0))
+
+    def build(self, points: ndarray) -> 'IVFIndex':
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        # About sqrt(n) partitions keeps both the centroid and the partition scans short
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(len(points)))), len(points))
+        kmeans = KMeans(n_clusters=n_lists, n_init=1, max_iter=20, random_state=self.seed).fit(points)
+
+        self.centroids = kmeans.cluster_centers_
+        self.positions = np.argsort(kmeans.labels_, kind='stable')
+        self.points = points[self.positions]
+        self.squared_norms = np.einsum('ij,ij->i', self.points, self.points)
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(kmeans.labels_, minlength=n_lists))])
+        self.fingerprint = hash_matrix(points)
+        return self
+
+    def query(self, points: ndarray, k: int, n_probe: int = None) -> tuple[ndarray, ndarray]:
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        distances, positions = np.empty((len(points), k)), np.empty((len(points), k), dtype=np.int64)
+        for start in range(0, len(points), self.batch_size):
+            stop = start + self.batch_size
+            distances[start:stop], positions[start:stop] = self.__query_batch(points[start:stop], k,
+                                                                              n_probe or self.n_probe)
+        return distances, positions
+
+    def __query_batch(self, points: ndarray, k: int, n_probe: int) -> tuple[ndarray, ndarray]:
+        n_probe = min(n_probe, len(self.centroids))
+        centroid_distances = squared_distances(points, self.centroids)
+        probed = np.argpartition(centroid_distances, n_probe - 1, axis=1)[:, :n_probe]
+
+        # The probed partitions of each query laid out one after another in a row of candidates, padded to the
+        # longest row. Distances to a partition are computed for all queries that probe it in one product.
+        sizes = np.diff(self.offsets)[probed]
+        column_starts = np.cumsum(sizes, axis=1) - sizes
+        candidates = np.full((len(points), max(sizes.sum(axis=1).max(), k)), -1)
+        candidate_distances = np.full(candidates.shape, np.inf)
+        for partition in np.unique(probed):
+            queries, slots = np.nonzero(probed == partition)
+            start, stop = self.offsets[partition], self.offsets[partition + 1]
+            columns = column_starts[queries, slots][:, np.newaxis] + np.arange(stop - start)
+            candidates[queries[:, np.newaxis], columns] = np.arange(start, stop)
+            candidate_distances[queries[:, np.newaxis], columns] = \
+                squared_distances(points[queries], self.points[start:stop], self.squared_norms[start:stop])
+        totals = sizes.sum(axis=1)
+
+        nearest = np.argpartition(candidate_distances, k - 1, axis=1)[:, :k]
+        nearest_distances = np.take_along_axis(candidate_distances, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1)
+        distances = np.take_along_axis(nearest_distances, order, axis=1)
+        positions = np.take_along_axis(candidates, np.take_along_axis(nearest, order, axis=1), axis=1)
+
+        short = totals < k
+        if short.any():
+            exact_distances = squared_distances(points[short], self.points, self.squared_norms)
+            positions[short] = np.argsort(exact_distances, axis=1)[:, :k]
+            distances[short] = np.take_along_axis(exact_distances, positions[short], axis=1)
+        return np.sqrt(np.maximum(distances, 0)), self.positions[positions]
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+
+def squared_distances(a: ndarray, b: ndarray, b_squared_norms: ndarray = None) -> ndarray:
+    b_squared_norms = b_squared_norms if b_squared_norms is not None else np.einsum('ij,ij->i', b, b)
+    return np.einsum('ij,ij->i', a, a)[:, np.newaxis] - 2 * a @ b.T + b_squared_norms[np.newaxis, :]
+
 
 class NearestNeighboursQuery:
 
     metadata: pd.DataFrame
     neighbours: int
-    nn: NearestNeighbors
+    index: AbstractNeighbourIndex
     coordinates: pd.DataFrame
+    # First index of every value, per searched column
+    search_indices: dict[str, dict]
 
     def __init__(
             self,
             coordinates: pd.DataFrame,
             metadata: pd.DataFrame,
             neighbours: int = 6,
+            index: AbstractNeighbourIndex = None
     ):
         self.metadata = metadata
         self.neighbours = neighbours
         self.coordinates = coordinates
+        self.index = index if index is not None else ExactIndex()
+        self.search_indices = {}
         self.__setup()
 
+    # An index loaded from disk is used as it is only if it was built on these exact coordinates, after a refit or
+    # a reordering of the songs it is built again
     def __setup(self):
-        self.nn = NearestNeighbors(n_neighbors=self.neighbours)
-        self.nn.fit(self.coordinates)
+        points = self.coordinates.to_numpy(dtype=np.float64)
+        if self.index.fingerprint != hash_matrix(points):
+            self.index.build(points)
 
     def search(self, search_term: str, column: str) -> pd.DataFrame:
         search_idx = self.get_search_index(search_term, column)
         return self.get_nearest_neighbours(search_idx)
 
+    # Every search term is looked up first, then all of them are answered by one index query
+    def search_many(self, search_terms: list[str], column: str) -> list[pd.DataFrame]:
+        search_indices = [self.get_search_index(search_term, column) for search_term in search_terms]
+        return self.get_nearest_neighbours_many(search_indices)
+
+    # Each column is indexed on its first search, after that lookups are constant time instead of a full scan
     def get_search_index(self, search_term: str, column: str) -> int:
-        return self.metadata[self.metadata[column] == search_term].index[0]
+        if column not in self.search_indices:
+            index = {}
+            for label, value in zip(self.metadata.index, self.metadata[column]):
+                index.setdefault(value, label)
+            self.search_indices[column] = index
+        return self.search_indices[column][search_term]
 
     def get_nearest_neighbours(
             self,
             search_idx: int,
     ) -> pd.DataFrame:
-        search_item = pd.DataFrame([self.coordinates.iloc[search_idx]])
-        distances, nn_indices = (a.T for a in self.nn.kneighbors(search_item, self.neighbours))
-        nearest_metadata = self.metadata.iloc[nn_indices.T[0]]
-        nearest_metadata.insert(0, 'distance', distances)
-        return nearest_metadata
+        return self.get_nearest_neighbours_many([search_idx])[0]
+
+    # Distances and positions of the nearest neighbours only, without building a Dataframe per search
+    def get_nearest_positions_many(self, search_indices: list[int]) -> tuple[ndarray, ndarray]:
+        search_items = self.coordinates.iloc[search_indices].to_numpy(dtype=np.float64)
+        return self.index.query(search_items, self.neighbours)
+
+    def get_nearest_neighbours_many(self, search_indices: list[int]) -> list[pd.DataFrame]:
+        distances, nn_indices = self.get_nearest_positions_many(search_indices)
+        results = []
+        for item_distances, item_indices in zip(distances, nn_indices):
+            nearest_metadata = self.metadata.iloc[item_indices]
+            nearest_metadata.insert(0, 'distance', item_distances)
+            results.append(nearest_metadata)
+        return results
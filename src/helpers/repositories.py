@@ -1,13 +1,26 @@
+import json
 import os
 import pickle
+import shutil
+import uuid
 
 import bz2file as bz2
-from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+import lz4.frame
+import zstandard as zstd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed
 from glob import glob
 from pathlib import Path
+from typing import Callable, Iterable, Optional
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
+from src.helpers.constants import METADATA_COLUMNS, TRAJECTORY_FEATURES
+from src.helpers.distances import stack_trajectories, to_sparse_trajectory
+from src.helpers.manifest import TrackManifest
+from src.helpers.precision import PrecisionPolicy, decode
+from src.helpers.processors import standardize_tonnetz_batch
 from src.models import *
 
 
@@ -57,30 +70,596 @@ class PickleIO(AbstractIO):
         return '.pkl'
 
 
+# Decompresses several times faster than bz2 for a similar file size, higher levels trade write time for size
+class ZstdIO(AbstractIO):
+    level: int
+
+    def __init__(self, level: int = 3):
+        self.level = level
+
+    def save(self, path: str, data):
+        with zstd.open(path + self.file_ext(), 'wb', cctx=zstd.ZstdCompressor(level=self.level)) as f:
+            pickle.dump(data, f, protocol=5)
+
+    @staticmethod
+    def load(path: str):
+        with zstd.open(path, 'rb') as data:
+            return pickle.load(data)
+
+    @staticmethod
+    def file_ext() -> str:
+        return '.pkl.zst'
+
+
+# Fastest to decompress of the compressed formats, at the cost of larger files
+class LZ4IO(AbstractIO):
+    level: int
+
+    def __init__(self, level: int = 0):
+        self.level = level
+
+    def save(self, path: str, data):
+        with lz4.frame.open(path + self.file_ext(), 'wb', compression_level=self.level) as f:
+            pickle.dump(data, f, protocol=5)
+
+    @staticmethod
+    def load(path: str):
+        with lz4.frame.open(path, 'rb') as data:
+            return pickle.load(data)
+
+    @staticmethod
+    def file_ext() -> str:
+        return '.pkl.lz4'
+
+
+# Pickle protocol 5 with ndarray buffers kept out of band. The pickle only describes the objects and the raw
+# array bytes are written after it uncompressed, so loading is one read into memory and the arrays are
+# rebuilt on top of it without being copied or decompressed.
+# Layout: [number of sections][section lengths][pickle][buffer]...[buffer], as little-endian uint64 headers
+class OutOfBandIO(AbstractIO):
+    @staticmethod
+    def save(path: str, data):
+        buffers: list[pickle.PickleBuffer] = []
+        header = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+        sections = [memoryview(header)] + [buffer.raw() for buffer in buffers]
+        with open(path + OutOfBandIO.file_ext(), 'wb') as f:
+            f.write(np.array([len(sections)] + [s.nbytes for s in sections], dtype='<u8').tobytes())
+            for section in sections:
+                f.write(section)
+
+    @staticmethod
+    def load(path: str):
+        contents = bytearray(os.path.getsize(path))
+        with open(path, 'rb') as f:
+            f.readinto(contents)
+        view = memoryview(contents)
+        n_sections = int(np.frombuffer(view[:8], dtype='<u8')[0])
+        lengths = np.frombuffer(view[8:8 * (n_sections + 1)], dtype='<u8').astype(np.int64)
+        offsets = 8 * (n_sections + 1) + np.concatenate([[0], np.cumsum(lengths)])
+        sections = [view[offsets[i]:offsets[i + 1]] for i in range(n_sections)]
+        return pickle.loads(sections[0], buffers=sections[1:])
+
+    @staticmethod
+    def file_ext() -> str:
+        return '.pkl.oob'
+
+
+IO_BACKENDS: list[AbstractIO] = [CompressIO(), PickleIO(), ZstdIO(), LZ4IO(), OutOfBandIO()]
+
+
+# Files can be read regardless of which backend wrote them, as each backend has its own extension
+def get_io(path: str) -> AbstractIO:
+    for io in IO_BACKENDS:
+        if path.endswith(io.file_ext()):
+            return io
+    raise ValueError(f'No IO backend for file: {path}')
+
+
+# Sorts the feature columns of a dataset into scalars, dense arrays and sparse trajectories
+def split_feature_columns(dataset: pd.DataFrame) -> tuple[list[str], list[str], list[str]]:
+    scalar_columns, array_columns, sparse_columns = [], [], []
+    for column in dataset.columns:
+        if column in METADATA_COLUMNS:
+            continue
+        first = dataset[column].iloc[0] if len(dataset) else None
+        if sparse.issparse(first) or column in TRAJECTORY_FEATURES:
+            sparse_columns.append(column)
+        elif isinstance(first, np.ndarray) and first.size > 1:
+            array_columns.append(column)
+        else:
+            scalar_columns.append(column)
+    return scalar_columns, array_columns, sparse_columns
+
+
+# (songs x columns) matrix. 1-element arrays such as bpm are unwrapped, and float32 scalars from a compact
+# precision policy stay float32.
+def stack_scalar_columns(dataset: pd.DataFrame, columns: list[str]) -> np.ndarray:
+    values = [dataset[c].to_numpy() for c in columns]
+    values = [np.array([np.nan if v is None else np.ravel(v)[0] for v in column]) if column.dtype == object
+              else column for column in values]
+    scalar_dtype = np.result_type(*values) if values else np.float64
+    scalars = np.empty((len(dataset), len(columns)), dtype=scalar_dtype)
+    for i, column in enumerate(values):
+        scalars[:, i] = column
+    return scalars
+
+
+def stack_array_column(dataset: pd.DataFrame, column: str) -> np.ndarray:
+    values = dataset[column].tolist()
+    # Older datasets kept tonnetz at its natural length
+    if column == 'tonnetz' and len({np.size(v) for v in values}) > 1:
+        return standardize_tonnetz_batch(values)
+    return np.stack(values)
+
+
+# Values of a one-row dataset by block of a ColumnarFeatureStore: 'scalars', then one entry per array and sparse column
+def get_row_blocks(frame: pd.DataFrame, scalar_columns: list[str], array_columns: list[str],
+                   sparse_columns: list[str]) -> dict:
+    return {'scalars': stack_scalar_columns(frame, scalar_columns)[0]} \
+        | {c: np.ravel(frame[c].iloc[0]) for c in array_columns} \
+        | {c: stack_trajectories(frame[c]) for c in sparse_columns}
+
+
+# .npy file opened as a writable memory map, empty blocks cannot be mapped and are written directly
+def create_block(path: Path, shape: tuple, dtype) -> np.ndarray:
+    # numpy integers would be written into the .npy header as their repr
+    shape = tuple(int(size) for size in shape)
+    if 0 in shape:
+        np.save(path, np.empty(shape, dtype=dtype))
+        return np.empty(shape, dtype=dtype)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+# FeatureDataset of a Dataframe of feature vectors, e.g. pd.DataFrame([vector.as_dict()]) for a single song
+def build_feature_dataset(dataframe: pd.DataFrame) -> FeatureDataset:
+    scalar_columns, array_columns, sparse_columns = split_feature_columns(dataframe)
+    arrays = {c: stack_array_column(dataframe, c) for c in array_columns} \
+        | {c: stack_trajectories(dataframe[c]) for c in sparse_columns}
+    return FeatureDataset(
+        metadata=dataframe[[c for c in METADATA_COLUMNS if c in dataframe]],
+        scalar_columns=scalar_columns,
+        scalars=stack_scalar_columns(dataframe, scalar_columns),
+        arrays=arrays
+    )
+
+
+# Column-oriented replacement for the bz2-pickled feature DataFrames, stored as a <name>.features folder.
+# Scalar features form one (column x song) block so each column is contiguous, fixed-width arrays such as
+# tonnetz are stored as one (song x value) block each, and sparse trajectories as their CSR arrays.
+# Every block is a plain .npy file opened with mmap_mode='r', so reading a few columns or rows only
+# touches those bytes instead of decompressing the whole playlist.
+class ColumnarFeatureStore:
+    path: Path
+    schema: dict
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.schema = json.loads(Path(path, 'schema.json').read_text())
+
+    @staticmethod
+    def get_path(directory: str, name: str) -> Path:
+        return Path(directory, name + '.features')
+
+    # Blocks keep the dtypes of the dataset, e.g. float32 scalars and uint8 counts, unless a precision policy
+    # is given to convert them first
+    @staticmethod
+    def write(
+            directory: str,
+            name: str,
+            dataset: pd.DataFrame,
+            precision: PrecisionPolicy = None
+    ) -> 'ColumnarFeatureStore':
+        if precision is not None:
+            dataset = precision.apply_dataset(dataset)
+        path = ColumnarFeatureStore.get_path(directory, name)
+        temp_path = path.with_name(path.name + '.tmp')
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
+        temp_path.mkdir(parents=True)
+
+        scalar_columns, array_columns, sparse_columns = split_feature_columns(dataset)
+        schema = {
+            'n_rows': len(dataset),
+            'column_order': list(dataset.columns),
+            'metadata': {c: dataset[c].astype(str).tolist() for c in METADATA_COLUMNS if c in dataset},
+            'scalar_columns': scalar_columns,
+            'array_columns': array_columns,
+            'sparse_columns': {}
+        }
+
+        for column in sparse_columns:
+            matrix = stack_trajectories(dataset[column])
+            for part in ('data', 'indices', 'indptr'):
+                np.save(Path(temp_path, f'{column}.{part}.npy'), getattr(matrix, part))
+            schema['sparse_columns'][column] = matrix.shape[1]
+        for column in array_columns:
+            np.save(Path(temp_path, f'{column}.npy'), stack_array_column(dataset, column))
+        # Transposed and copied so that each scalar column is contiguous on disk
+        np.save(Path(temp_path, 'scalars.npy'), np.ascontiguousarray(stack_scalar_columns(dataset, scalar_columns).T))
+        Path(temp_path, 'schema.json').write_text(json.dumps(schema))
+
+        # Swapped in only once complete, so readers never see a half-written store
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(temp_path, path)
+        return ColumnarFeatureStore(str(path))
+
+    # Like write(), for playlists too large to hold as one Dataframe. rows() is called twice and must yield the same
+    # (position, row) pairs both times, rows being dicts such as FeatureVector.as_dict() in any order. The first
+    # pass sizes the blocks and the second fills them through memory maps, so only one row is held at a time.
+    @staticmethod
+    def write_rows(
+            directory: str,
+            name: str,
+            n_rows: int,
+            rows: Callable[[], Iterable[tuple[int, dict]]],
+            precision: PrecisionPolicy = None
+    ) -> 'ColumnarFeatureStore':
+        if n_rows == 0:
+            return ColumnarFeatureStore.write(directory, name, pd.DataFrame(), precision)
+
+        def read_rows():
+            for position, row in rows():
+                frame = pd.DataFrame([row])
+                yield position, frame if precision is None else precision.apply_dataset(frame)
+
+        column_order, columns, metadata, dtypes, shapes, nnz = None, None, {}, {}, {}, {}
+        for position, frame in read_rows():
+            if column_order is None:
+                column_order = list(frame.columns)
+                columns = split_feature_columns(frame)
+                metadata = {c: [None] * n_rows for c in METADATA_COLUMNS if c in frame}
+                nnz = {c: np.zeros(n_rows, dtype=np.int64) for c in columns[2]}
+            for column in metadata:
+                metadata[column][position] = str(frame[column].iloc[0])
+            for block_name, block in get_row_blocks(frame, *columns).items():
+                if block_name in nnz:
+                    nnz[block_name][position] = block.nnz
+                    dtypes[block_name] = np.result_type(block.dtype, dtypes.get(block_name, block.dtype))
+                    shapes[block_name] = block.shape[1]
+                else:
+                    dtypes[block_name] = np.result_type(block.dtype, dtypes.get(block_name, block.dtype))
+                    shapes[block_name] = len(block)
+        scalar_columns, array_columns, sparse_columns = columns
+
+        path = ColumnarFeatureStore.get_path(directory, name)
+        temp_path = path.with_name(path.name + '.tmp')
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
+        temp_path.mkdir(parents=True)
+
+        blocks = {'scalars': create_block(Path(temp_path, 'scalars.npy'), (len(scalar_columns), n_rows),
+                                          dtypes['scalars'])}
+        for column in array_columns:
+            blocks[column] = create_block(Path(temp_path, f'{column}.npy'), (n_rows, shapes[column]), dtypes[column])
+        indptrs = {}
+        for column in sparse_columns:
+            indptr = np.concatenate([[0], np.cumsum(nnz[column])])
+            index_dtype = np.int32 if indptr[-1] < 2 ** 31 else np.int64
+            indptrs[column] = indptr.astype(index_dtype)
+            np.save(Path(temp_path, f'{column}.indptr.npy'), indptrs[column])
+            blocks[column] = (
+                create_block(Path(temp_path, f'{column}.data.npy'), (indptr[-1],), dtypes[column]),
+                create_block(Path(temp_path, f'{column}.indices.npy'), (indptr[-1],), index_dtype)
+            )
+
+        for position, frame in read_rows():
+            for block_name, block in get_row_blocks(frame, *columns).items():
+                if block_name == 'scalars':
+                    blocks['scalars'][:, position] = block
+                elif block_name in indptrs:
+                    start, stop = indptrs[block_name][position], indptrs[block_name][position + 1]
+                    data, indices = blocks[block_name]
+                    data[start:stop] = block.data
+                    indices[start:stop] = block.indices
+                else:
+                    blocks[block_name][position] = block
+        for block in blocks.values():
+            for array in block if isinstance(block, tuple) else (block,):
+                if isinstance(array, np.memmap):
+                    array.flush()
+        del blocks
+
+        schema = {
+            'n_rows': n_rows,
+            'column_order': column_order,
+            'metadata': metadata,
+            'scalar_columns': scalar_columns,
+            'array_columns': array_columns,
+            'sparse_columns': {column: shapes[column] for column in sparse_columns}
+        }
+        Path(temp_path, 'schema.json').write_text(json.dumps(schema))
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(temp_path, path)
+        return ColumnarFeatureStore(str(path))
+
+    def __len__(self):
+        return self.schema['n_rows']
+
+    @property
+    def columns(self) -> list[str]:
+        return self.schema['column_order']
+
+    def get_scalars(self) -> np.ndarray:
+        return np.load(Path(self.path, 'scalars.npy'), mmap_mode='r')
+
+    def get_scalar(self, column: str) -> np.ndarray:
+        return self.get_scalars()[self.schema['scalar_columns'].index(column)]
+
+    def get_array(self, column: str) -> np.ndarray:
+        return np.load(Path(self.path, f'{column}.npy'), mmap_mode='r')
+
+    def get_sparse(self, column: str) -> sparse.csr_matrix:
+        data, indices, indptr = (np.load(Path(self.path, f'{column}.{part}.npy'), mmap_mode='r')
+                                 for part in ('data', 'indices', 'indptr'))
+        shape = (len(self), self.schema['sparse_columns'][column])
+        return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+    def load(self, columns: list[str] = None, rows=None) -> pd.DataFrame:
+        # Metadata columns are always included, rows can be any numpy index into the playlist
+        columns = self.columns if columns is None else columns
+        rows = np.arange(len(self)) if rows is None else np.arange(len(self))[rows]
+
+        data = {c: np.asarray(self.schema['metadata'][c], dtype=object)[rows] for c in self.schema['metadata']}
+        for column in columns:
+            if column in data:
+                continue
+            elif column in self.schema['scalar_columns']:
+                data[column] = self.get_scalar(column)[rows]
+            elif column in self.schema['array_columns']:
+                block = self.get_array(column)[rows]
+                data[column] = list(block)
+            elif column in self.schema['sparse_columns']:
+                matrix = self.get_sparse(column)[rows]
+                data[column] = [matrix[i] for i in range(matrix.shape[0])]
+            else:
+                raise KeyError(f'Unknown column: {column}')
+
+        order = [c for c in self.columns if c in data]
+        return pd.DataFrame(data, columns=order)
+
+    # Memory-mapped blocks wrapped as a FeatureDataset, nothing is read until the matrices are used
+    def to_feature_dataset(self, columns: list[str] = None) -> FeatureDataset:
+        scalar_columns = [c for c in self.schema['scalar_columns'] if columns is None or c in columns]
+        array_columns = [c for c in self.schema['array_columns'] + list(self.schema['sparse_columns'])
+                         if columns is None or c in columns]
+        scalar_rows = [self.schema['scalar_columns'].index(c) for c in scalar_columns]
+        return FeatureDataset(
+            metadata=pd.DataFrame(self.schema['metadata']),
+            scalar_columns=scalar_columns,
+            scalars=self.get_scalars()[scalar_rows].T,
+            arrays={c: self.get_sparse(c) if c in self.schema['sparse_columns'] else self.get_array(c)
+                    for c in array_columns}
+        )
+
+
+# Representations are kept apart from the feature vectors in a <name>.representations folder, with one file per
+# field of each track: <track>/<field><ext>. Opening the store only reads the track index, and each field is
+# decompressed on its own when it is first asked for, so looking at one song's chroma never touches any
+# spectrograms. Fields are compressed with an IO backend as spectrograms are too large to keep raw.
+class RepresentationStore:
+    path: Path
+    io: AbstractIO
+    tracks: list[dict]
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        schema = json.loads(Path(path, 'tracks.json').read_text())
+        self.io = get_io(schema['file_ext'])
+        self.tracks = schema['tracks']
+
+    @staticmethod
+    def get_path(directory: str, name: str) -> Path:
+        return Path(directory, name + '.representations')
+
+    @staticmethod
+    def write(
+            directory: str,
+            name: str,
+            metadata: pd.DataFrame,
+            representations: list[FeatureRepresentation],
+            io: AbstractIO = None,
+            precision: PrecisionPolicy = None
+    ) -> 'RepresentationStore':
+        tracks = ((index, metadata_row, representation) for index, (metadata_row, representation)
+                  in enumerate(zip(metadata.to_dict('records'), representations)))
+        return RepresentationStore.write_tracks(directory, name, len(representations), tracks, io, precision)
+
+    # Like write(), with the tracks given one at a time as (position, metadata row, representation) in any order,
+    # so each representation can be written and dropped before the next one is read
+    @staticmethod
+    def write_tracks(
+            directory: str,
+            name: str,
+            n_tracks: int,
+            tracks: Iterable[tuple[int, dict, FeatureRepresentation]],
+            io: AbstractIO = None,
+            precision: PrecisionPolicy = None
+    ) -> 'RepresentationStore':
+        io = io if io is not None else ZstdIO()
+        path = RepresentationStore.get_path(directory, name)
+        temp_path = path.with_name(path.name + '.tmp')
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
+        temp_path.mkdir(parents=True)
+
+        entries = [None] * n_tracks
+        for index, metadata_row, representation in tracks:
+            key = f'{index:05d}'
+            Path(temp_path, key).mkdir()
+            if precision is not None:
+                representation = precision.apply_representation(representation)
+            fields = []
+            for field, value in vars(representation).items():
+                if value is None:
+                    continue
+                io.save(str(Path(temp_path, key, field)), value)
+                fields.append(field)
+            entries[index] = metadata_row | {'key': key, 'fields': fields}
+        Path(temp_path, 'tracks.json').write_text(json.dumps({'file_ext': io.file_ext(), 'tracks': entries}))
+
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(temp_path, path)
+        return RepresentationStore(str(path))
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def get_metadata(self) -> pd.DataFrame:
+        return pd.DataFrame([{c: t[c] for c in METADATA_COLUMNS if c in t} for t in self.tracks])
+
+    # Tracks are addressed by their position in the playlist or by song name
+    def get_index(self, track) -> int:
+        if isinstance(track, str):
+            return next(i for i, t in enumerate(self.tracks) if t['song_name'] == track)
+        return track
+
+    def get_fields(self, track) -> list[str]:
+        return self.tracks[self.get_index(track)]['fields']
+
+    # Fields stored quantized or bit-packed are decoded on load
+    def get_field(self, track, field: str):
+        if field not in FeatureRepresentation.__dataclass_fields__:
+            raise KeyError(f'Unknown representation field: {field}')
+        entry = self.tracks[self.get_index(track)]
+        if field not in entry['fields']:
+            return None
+        return decode(self.io.load(str(Path(self.path, entry['key'], field + self.io.file_ext()))))
+
+    def get(self, track) -> 'LazyFeatureRepresentation':
+        return LazyFeatureRepresentation(self, self.get_index(track))
+
+
+# Stands in for a FeatureRepresentation, loading each field from the store the first time it is accessed
+class LazyFeatureRepresentation:
+    store: RepresentationStore
+    index: int
+    loaded: dict
+
+    def __init__(self, store: RepresentationStore, index: int):
+        self.store = store
+        self.index = index
+        self.loaded = {}
+
+    def __getattr__(self, field: str):
+        if field not in FeatureRepresentation.__dataclass_fields__:
+            raise AttributeError(field)
+        if field not in self.loaded:
+            self.loaded[field] = self.store.get_field(self.index, field)
+        return self.loaded[field]
+
+    def load(self) -> FeatureRepresentation:
+        return FeatureRepresentation(**{f: getattr(self, f) for f in FeatureRepresentation.__dataclass_fields__})
+
+
 class PandasAudioRepository:
 
+    io: AbstractIO = ZstdIO()
+    # Applied on top of whatever precision the vectors and representations were extracted with
+    precision: Optional[PrecisionPolicy] = None
+
+    # Columnar stores are preferred, playlists only extracted as pickles are still read.
+    # Selected playlists are looked up in the track manifest when there is one, instead of globbing every folder.
+    @staticmethod
+    def get_feature_paths(extracted_directory: str, playlists: list[str] = None) -> list[str]:
+        manifest_path = TrackManifest.get_path(extracted_directory)
+        if playlists is not None and manifest_path.exists():
+            store_paths = TrackManifest(str(manifest_path)).get_store_paths(playlists)
+            if len(store_paths) == len(set(playlists)):
+                return [str(path) for path in store_paths.values()]
+
+        folders = glob(extracted_directory + '/*')
+        if playlists is not None:
+            folders = [folder for folder in folders if Path(folder).name in playlists]
+        results = []
+        for folder in folders:
+            columnar_path = ColumnarFeatureStore.get_path(folder, Path(folder).name)
+            if columnar_path.is_dir():
+                results.append(str(columnar_path))
+                continue
+            for item in glob(folder + '/*'):
+                if '.features.pkl' in item:
+                    results.append(item)
+        return results
+
+    @staticmethod
+    def load_pickled_dataset(path: str, columns: list[str] = None) -> pd.DataFrame:
+        dataframe = get_io(path).load(path)
+        if columns is not None:
+            dataframe = dataframe[[c for c in dataframe.columns if c in METADATA_COLUMNS or c in columns]]
+        # Older datasets store trajectories as dense arrays, convert them as each file is read
+        for column in TRAJECTORY_FEATURES:
+            if column in dataframe:
+                dataframe[column] = dataframe[column].apply(to_sparse_trajectory)
+        return dataframe
+
+    # Playlists are read on threads, np.load and the decompressors release the GIL while they read
     @staticmethod
     def load_all_feature_datasets(
-            extracted_directory: str
+            extracted_directory: str,
+            columns: list[str] = None,
+            max_workers: int = None,
+            playlists: list[str] = None
     ):
-        def get_feature_paths(extracted_directory: str):
-            folders = glob(extracted_directory + '/*')
-            results = []
-            for folder in folders:
-                for item in glob(folder + '/*'):
-                    if '.features' in item:
-                        results.append(item)
-            return results
+        def load_one(path: str):
+            if Path(path).is_dir():
+                return ColumnarFeatureStore(path).load(columns)
+            return PandasAudioRepository.load_pickled_dataset(path, columns)
 
         def load_features(extracted_directory: str):
-            feature_paths = get_feature_paths(extracted_directory)
-            dataframes = []
-            for path in feature_paths:
-                dataframes.append(pd.read_pickle(path, compression='bz2'))
+            feature_paths = PandasAudioRepository.get_feature_paths(extracted_directory, playlists)
+            with ThreadPoolExecutor(max_workers=max_workers) as ec:
+                dataframes = list(ec.map(load_one, feature_paths))
             return pd.concat(dataframes, axis=0, ignore_index=True)
 
         return load_features(extracted_directory)
 
+    # Like load_all_feature_datasets, but as a FeatureDataset of contiguous matrices instead of object columns.
+    # Columnar stores are copied straight from their memory maps into matrices allocated once for all playlists.
+    @staticmethod
+    def load_feature_matrix(
+            extracted_directory: str,
+            columns: list[str] = None,
+            playlists: list[str] = None
+    ) -> FeatureDataset:
+        def load_one(path: str) -> FeatureDataset:
+            if Path(path).is_dir():
+                return ColumnarFeatureStore(path).to_feature_dataset(columns)
+
+            return build_feature_dataset(PandasAudioRepository.load_pickled_dataset(path, columns))
+
+        feature_paths = PandasAudioRepository.get_feature_paths(extracted_directory, playlists)
+        return FeatureDataset.concat([load_one(path) for path in feature_paths])
+
+    # Finds tracks through the manifest and reads only their rows from each feature store
+    @staticmethod
+    def load_tracks(extracted_directory: str, column: str, value: str, columns: list[str] = None):
+        manifest = TrackManifest(str(TrackManifest.get_path(extracted_directory)))
+        rows_by_store = {}
+        for track in manifest.find(column, value):
+            rows_by_store.setdefault(track['store_path'], []).append(track['store_row'])
+
+        dataframes = [
+            ColumnarFeatureStore(str(Path(manifest.path.parent, store_path))).load(columns, rows)
+            for store_path, rows in rows_by_store.items()
+        ]
+        if not dataframes:
+            return pd.DataFrame(columns=METADATA_COLUMNS)
+        return pd.concat(dataframes, axis=0, ignore_index=True)
+
+    # Adds every playlist with a columnar store to the manifest, for libraries extracted before it existed
+    @staticmethod
+    def index_extracted(extracted_directory: str) -> TrackManifest:
+        manifest = TrackManifest(str(TrackManifest.get_path(extracted_directory)))
+        for folder in glob(extracted_directory + '/*'):
+            store_path = ColumnarFeatureStore.get_path(folder, Path(folder).name)
+            if store_path.is_dir():
+                store = ColumnarFeatureStore(str(store_path))
+                manifest.register_store(Path(folder).name, str(store_path), store.schema['metadata'])
+        return manifest
+
     @staticmethod
     def store_datasets(
             directory: str,
@@ -113,7 +692,7 @@ class PandasAudioRepository:
             vectors: list[FeatureVector]
     ):
         dataset = pd.DataFrame([v.as_dict() | {'playlist': name} for v in vectors])
-        dataset.to_pickle(str(Path(directory, name + '.features.pkl.pbz2')), compression='bz2')
+        ColumnarFeatureStore.write(directory, name, dataset, PandasAudioRepository.precision)
         return dataset
 
     @staticmethod
@@ -123,32 +702,183 @@ class PandasAudioRepository:
             metadata: pd.DataFrame,
             representations: list[FeatureRepresentation]
     ):
-        representations_dataset = pd.DataFrame([r.as_dict() for r in representations])
-        dataset = pd.concat([metadata, representations_dataset], axis=1)
-        dataset.to_pickle(str(Path(directory, name + '.representations.pkl.pbz2')), compression='bz2')
-        return dataset
+        return RepresentationStore.write(directory, name, metadata, representations, PandasAudioRepository.io,
+                                         PandasAudioRepository.precision)
+
+    @staticmethod
+    def load_repr_dataset(directory: str, name: str = None):
+        name = name if name is not None else Path(directory).name
+        return RepresentationStore(str(RepresentationStore.get_path(directory, name)))
+
+
+# Appends extraction results to on-disk shards while a playlist is being processed, so memory stays flat
+# and a crash only loses the current batch. Every finished track is recorded in a journal next to its shard,
+# which lets an interrupted run resume, and compact() turns the shards into the usual playlist dataset.
+# Tracks that could not be extracted are recorded in a second journal, so a resumed run skips them too.
+class ShardedDatasetWriter:
+    directory: Path
+    shard_directory: Path
+    journal_path: Path
+    failed_journal_path: Path
+    batch_size: int
+    batch: list[tuple[str, FeatureVector, Optional[FeatureRepresentation]]]
+    # audio file -> shard that holds its result
+    completed: dict[str, str]
+    # audio file -> error it failed with
+    failed: dict[str, str]
+
+    def __init__(self, directory: str, batch_size: int = 10, resume: bool = False):
+        self.directory = Path(directory)
+        self.shard_directory = Path(directory, '.shards')
+        self.journal_path = Path(self.shard_directory, 'completed.tsv')
+        self.failed_journal_path = Path(self.shard_directory, 'failed.tsv')
+        self.batch_size = batch_size
+        self.batch = []
+
+        if not resume and self.shard_directory.exists():
+            shutil.rmtree(self.shard_directory)
+        self.shard_directory.mkdir(parents=True, exist_ok=True)
+        self.completed = self.__read_journal()
+        self.failed = self.__read_failed_journal()
+
+    def __read_journal(self) -> dict[str, str]:
+        completed = {}
+        if not self.journal_path.exists():
+            return completed
+
+        with open(self.journal_path) as journal:
+            for line in journal:
+                # A crash can leave a partially written last line behind
+                shard_name, _, audio_file = line.rstrip('\n').partition('\t')
+                if audio_file and Path(self.shard_directory, shard_name).exists():
+                    completed[audio_file] = shard_name
+        return completed
+
+    def __read_failed_journal(self) -> dict[str, str]:
+        failed = {}
+        if not self.failed_journal_path.exists():
+            return failed
+
+        with open(self.failed_journal_path) as journal:
+            for line in journal:
+                if not line.endswith('\n'):
+                    continue
+                audio_file, _, error = line.rstrip('\n').partition('\t')
+                failed[audio_file] = error
+        return failed
+
+    def is_completed(self, audio_file: str) -> bool:
+        return audio_file in self.completed
+
+    def is_failed(self, audio_file: str) -> bool:
+        return audio_file in self.failed
+
+    def record_failure(self, audio_file: str, error: BaseException):
+        message = ' '.join(f'{type(error).__name__}: {error}'.split())
+        with open(self.failed_journal_path, 'a') as journal:
+            journal.write(f'{audio_file}\t{message}\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.failed[audio_file] = message
+
+    def append(self, audio_file: str, vector: FeatureVector, feature_repr: FeatureRepresentation = None):
+        self.batch.append((audio_file, vector, feature_repr))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        shard_name = f'shard-{uuid.uuid4().hex}.pkl'
+        shard_path = Path(self.shard_directory, shard_name)
+        temp_path = shard_path.with_suffix('.tmp')
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self.batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, shard_path)
+
+        # Tracks only count as done once their shard is safely on disk
+        with open(self.journal_path, 'a') as journal:
+            journal.writelines(f'{shard_name}\t{audio_file}\n' for audio_file, _, _ in self.batch)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        self.completed.update((audio_file, shard_name) for audio_file, _, _ in self.batch)
+        self.batch = []
+
+    # Returns the audio files in the order of the dataset rows
+    def compact(self, name: str, save_repr: bool = False) -> list[str]:
+        self.flush()
+        audio_files = sorted(self.completed)
+        positions = {audio_file: position for position, audio_file in enumerate(audio_files)}
+
+        # Shards are read one at a time and each track is written to its row, so only one shard is in memory
+        def read_shards():
+            for shard_name in sorted(set(self.completed.values())):
+                with open(Path(self.shard_directory, shard_name), 'rb') as f:
+                    batch = pickle.load(f)
+                for audio_file, vector, feature_repr in batch:
+                    # A track redone after a crash may appear in an older shard as well
+                    if self.completed.get(audio_file) == shard_name:
+                        yield positions[audio_file], vector, feature_repr
+
+        ColumnarFeatureStore.write_rows(
+            str(self.directory),
+            name,
+            len(audio_files),
+            lambda: ((position, vector.as_dict() | {'playlist': name}) for position, vector, _ in read_shards()),
+            PandasAudioRepository.precision
+        )
+        if save_repr and audio_files:
+            RepresentationStore.write_tracks(
+                str(self.directory),
+                name,
+                len(audio_files),
+                ((position, vector.audio.as_dict() | {'playlist': name}, feature_repr)
+                 for position, vector, feature_repr in read_shards()),
+                PandasAudioRepository.io,
+                PandasAudioRepository.precision
+            )
+        shutil.rmtree(self.shard_directory)
+        return audio_files
 
 
 class AudioRepository:
 
     io: AbstractIO = CompressIO()
 
-    # Todo: Store vectors and representations separately for better memory management
+    # Vectors and representations are stored in separate files, so vectors can be loaded on their own
     @staticmethod
     def store_one_processed_audio(directory: str, processed_audio: tuple[FeatureVector, FeatureRepresentation]):
-        vector, _ = processed_audio
+        vector, feature_repr = processed_audio
         directory = directory
         if not os.path.exists(directory):
             os.makedirs(directory)
-        AudioRepository.io.save(f'{directory}/{vector.audio.name}', processed_audio)
+        AudioRepository.io.save(f'{directory}/{vector.audio.name}', vector)
+        if feature_repr is not None:
+            AudioRepository.io.save(f'{directory}/{vector.audio.name}.representations', feature_repr)
 
+    # Files stored before vectors and representations were split hold a (vector, representation) tuple,
+    # otherwise the representation is left to load_one_representation
     @staticmethod
     def load_one_processed_audio(file: str):
-        loaded_object: tuple[FeatureVector, FeatureRepresentation] = AudioRepository.io.load(file)
+        loaded_object = get_io(file).load(file)
+        if isinstance(loaded_object, FeatureVector):
+            loaded_object = loaded_object, None
         name = Path(file).parent.name
         loaded_object[0].audio.playlist = name
         return loaded_object
 
+    @staticmethod
+    def load_one_representation(file: str) -> Optional[FeatureRepresentation]:
+        io = get_io(file)
+        representation_file = file.removesuffix(io.file_ext()) + '.representations' + io.file_ext()
+        if os.path.exists(representation_file):
+            return io.load(representation_file)
+        return io.load(file)[1]
+
     # dir_start: which index to start from in each directory
     # dir_limit: how many songs to extract per directory
     @staticmethod
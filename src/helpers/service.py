@@ -0,0 +1,247 @@
+import asyncio
+import json
+from collections import deque
+from time import perf_counter
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from src.helpers.query import NearestNeighboursQuery
+
+SEARCH_COLUMNS = ('song_name', 'artist')
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                500: 'Internal Server Error'}
+
+
+# Counters of a running service. Latencies are only kept for the most recent requests, so percentiles and the
+# recent throughput follow the current load instead of averaging over the whole uptime.
+class ServiceStats:
+    started: float
+    requests: int
+    errors: int
+    batches: int
+    batched_requests: int
+    # (completion time, latency) of the most recent requests
+    recent: deque
+
+    def __init__(self, window: int = 10000):
+        self.started = perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.recent = deque(maxlen=window)
+
+    def record_request(self, latency: float, ok: bool = True):
+        self.requests += 1
+        self.errors += not ok
+        self.recent.append((perf_counter(), latency))
+
+    def record_batch(self, size: int):
+        self.batches += 1
+        self.batched_requests += size
+
+    def as_dict(self) -> dict:
+        uptime = perf_counter() - self.started
+        stats = {
+            'uptime_s': uptime,
+            'requests': self.requests,
+            'errors': self.errors,
+            'throughput_rps': self.requests / uptime,
+            'batches': self.batches,
+            'mean_batch_size': self.batched_requests / self.batches if self.batches else 0.0
+        }
+        if self.recent:
+            times, latencies = np.array(self.recent).T
+            span = times[-1] - times[0]
+            stats['recent_throughput_rps'] = (len(times) - 1) / span if span > 0 else 0.0
+            for name, value in zip(['p50', 'p90', 'p99', 'max'], np.percentile(latencies, [50, 90, 99, 100])):
+                stats[f'latency_{name}_ms'] = value * 1e3
+        return stats
+
+
+# Requests queue up while a batch is being answered, and each batch is one index query run off the event loop
+# so it keeps accepting requests. Under concurrent load the first request of a batch also waits up to max_delay
+# for more to arrive, a lone client never waits.
+class MicroBatcher:
+    query: NearestNeighboursQuery
+    max_batch_size: int
+    max_delay: float
+    stats: ServiceStats
+    queue: asyncio.Queue
+
+    def __init__(self, query: NearestNeighboursQuery, max_batch_size: int = 64, max_delay: float = 0.002,
+                 stats: ServiceStats = None):
+        self.query = query
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.stats = stats if stats is not None else ServiceStats()
+        self.queue = asyncio.Queue()
+        self.__task = None
+        self.__last_batch_size = 0
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.get_running_loop().create_task(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+
+    # Distances and positions of the nearest neighbours of one song
+    async def submit(self, search_idx: int) -> tuple[np.ndarray, np.ndarray]:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((search_idx, future))
+        return await future
+
+    async def __run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.max_delay > 0 and self.__last_batch_size > 1 and self.queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            self.__last_batch_size = len(batch)
+            self.stats.record_batch(len(batch))
+            try:
+                distances, positions = await asyncio.to_thread(self.query.get_nearest_positions_many,
+                                                               [search_idx for search_idx, _ in batch])
+                results = list(zip(distances, positions))
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+# Long-running recommendation service over HTTP/1.1 with keep-alive, meant to be bound to localhost.
+# The query and its index stay in memory, and concurrent lookups are answered together by a MicroBatcher.
+# Responses are built from the metadata records directly, a Dataframe per response costs more than the search.
+# - GET /recommend?q=<term>&by=<song_name|artist>  nearest neighbours of the first song matching the term
+# - GET /terms?by=<song_name|artist>                every value that can be searched for
+# - GET /stats                                       request, batch and latency counters
+class RecommendationService:
+    query: NearestNeighboursQuery
+    stats: ServiceStats
+    batcher: MicroBatcher
+    records: list[dict]
+
+    def __init__(self, query: NearestNeighboursQuery, max_batch_size: int = 64, max_delay: float = 0.002):
+        self.query = query
+        self.records = query.metadata.to_dict('records')
+        self.stats = ServiceStats()
+        self.batcher = MicroBatcher(query, max_batch_size, max_delay, self.stats)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080) -> asyncio.Server:
+        self.batcher.start()
+        return await asyncio.start_server(self.__handle_connection, host, port)
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8080):
+        server = await self.start(host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+    async def recommend(self, term: str, column: str = 'song_name') -> list[dict]:
+        distances, positions = await self.batcher.submit(self.query.get_search_index(term, column))
+        return [{'distance': float(distance), **self.records[position]}
+                for distance, position in zip(distances, positions)]
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except ValueError as e:
+                    # Later requests cannot be told apart from the rest of a malformed one, so the connection is closed
+                    writer.write(format_response(400, {'error': str(e)}, keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, headers = request
+                start = perf_counter()
+                status, body = await self.__route(method, target)
+                writer.write(format_response(status, body, keep_alive=headers.get('connection') != 'close'))
+                await writer.drain()
+                if target.startswith('/recommend'):
+                    self.stats.record_request(perf_counter() - start, ok=status == 200)
+                if headers.get('connection') == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def __route(self, method: str, target: str) -> tuple[int, object]:
+        if method != 'GET':
+            return 405, {'error': f'Unsupported method: {method}'}
+        url = urlsplit(target)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        column = params.get('by', 'song_name')
+        if url.path in ('/recommend', '/terms') and column not in SEARCH_COLUMNS:
+            return 400, {'error': f'Cannot search by {column}, use one of {SEARCH_COLUMNS}'}
+
+        if url.path == '/recommend':
+            if 'q' not in params:
+                return 400, {'error': 'Missing search term q'}
+            try:
+                return 200, {'query': params['q'], 'by': column,
+                             'neighbours': await self.recommend(params['q'], column)}
+            except KeyError:
+                return 404, {'error': f'No song with {column} {params["q"]}'}
+            except Exception as e:
+                return 500, {'error': repr(e)}
+        if url.path == '/terms':
+            return 200, list(self.query.metadata[column].unique())
+        if url.path == '/stats':
+            return 200, self.stats.as_dict()
+        return 404, {'error': f'Unknown path: {url.path}'}
+
+
+# Request line and headers of the next request on a connection, None once the client has closed it. Raises
+# ValueError for a malformed request line or Content-Length.
+async def read_request(reader: asyncio.StreamReader):
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise ValueError(f'Malformed request line: {request_line.decode("latin-1").strip()!r}')
+    method, target, _ = parts
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip().lower()
+    content_length = headers.get('content-length', '0')
+    if not content_length.isdigit():
+        raise ValueError(f'Malformed Content-Length: {content_length!r}')
+    if int(content_length):
+        await reader.readexactly(int(content_length))
+    return method, target, headers
+
+
+def format_response(status: int, body, keep_alive: bool = True) -> bytes:
+    content = json.dumps(body, default=to_json).encode()
+    head = (f'HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(content)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    return head.encode('latin-1') + content
+
+
+# numpy scalars left in the metadata are not JSON serialisable themselves
+def to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
@@ -1,7 +1,11 @@
-from dataclasses import dataclass, asdict
-from typing import Optional
+from dataclasses import dataclass, asdict, field
+from typing import Optional, Union
 
+import numpy as np
+import pandas as pd
 from numpy import ndarray
+from scipy import sparse
+from scipy.sparse import spmatrix
 
 
 @dataclass(kw_only=True)
@@ -81,18 +85,23 @@ class SpectralFeatures(AbstractFeature):
 
 @dataclass(kw_only=True)
 class HarmonicFeatures(AbstractFeature):
-    # 2 arrays based on clustering paper
-    chord_trajectory: Optional[ndarray] = None
-    note_trajectory: Optional[ndarray] = None
+    # 2 arrays based on clustering paper, sparse 1 x n rows of transition counts
+    chord_trajectory: Optional[spmatrix] = None
+    note_trajectory: Optional[spmatrix] = None
     tonnetz: Optional[ndarray] = None
     key_signature: Optional[int] = None  # pitch class, Todo: not included for now
+    # Compact trajectory encodings by column name, e.g. note_trajectory_pitch_classes
+    encodings: dict[str, ndarray] = field(default_factory=dict)
 
     def as_dict(self):
-        return {
+        trajectories = {
             'chord_trajectory': self.chord_trajectory,
-            'note_trajectory': self.note_trajectory,
-            'tonnetz': self.tonnetz
+            'note_trajectory': self.note_trajectory
         }
+        # Encoded trajectories may be stored instead of the raw ones, which are then left out
+        if self.encodings:
+            trajectories = {k: v for k, v in trajectories.items() if v is not None}
+        return trajectories | {'tonnetz': self.tonnetz} | self.encodings
 
 
 @dataclass(kw_only=True)
@@ -126,3 +135,56 @@ class FeatureRepresentation(AbstractFeature):
     mfccs: Optional[ndarray] = None
     chord_trajectory: Optional[ndarray] = None
     note_trajectory: Optional[ndarray] = None
+
+
+@dataclass(kw_only=True)
+class FeatureDataset:
+    # Many songs at once: one row per song in every member, in the same order
+    metadata: pd.DataFrame
+    scalar_columns: list[str]
+    # (songs x scalar features)
+    scalars: ndarray
+    # One 2-D matrix per array feature, dense for tonnetz and sparse for the trajectories
+    arrays: dict[str, Union[ndarray, spmatrix]]
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def get_scalar(self, column: str) -> ndarray:
+        return self.scalars[:, self.scalar_columns.index(column)]
+
+    def to_dataframe(self, include_arrays: bool = True) -> pd.DataFrame:
+        dataframe = pd.concat(
+            [self.metadata.reset_index(drop=True), pd.DataFrame(self.scalars, columns=self.scalar_columns)],
+            axis=1
+        )
+        if include_arrays:
+            for name, matrix in self.arrays.items():
+                dataframe[name] = [matrix[i] for i in range(matrix.shape[0])]
+        return dataframe
+
+    # Each matrix is allocated once for all datasets and filled in place, scalar columns follow the first dataset
+    @staticmethod
+    def concat(datasets: list['FeatureDataset']) -> 'FeatureDataset':
+        n_rows = sum(len(d) for d in datasets)
+        scalar_columns = datasets[0].scalar_columns
+        scalars = np.empty((n_rows, len(scalar_columns)), dtype=np.result_type(*(d.scalars for d in datasets)))
+        arrays = {}
+        for name, matrix in datasets[0].arrays.items():
+            if sparse.issparse(matrix):
+                arrays[name] = sparse.vstack([d.arrays[name] for d in datasets], format='csr')
+            else:
+                dtype = np.result_type(*(d.arrays[name] for d in datasets))
+                arrays[name] = np.empty((n_rows, matrix.shape[1]), dtype=dtype)
+
+        start = 0
+        for d in datasets:
+            end = start + len(d)
+            scalars[start:end] = d.scalars[:, [d.scalar_columns.index(c) for c in scalar_columns]]
+            for name, matrix in arrays.items():
+                if not sparse.issparse(matrix):
+                    matrix[start:end] = d.arrays[name]
+            start = end
+
+        metadata = pd.concat([d.metadata for d in datasets], axis=0, ignore_index=True)
+        return FeatureDataset(metadata=metadata, scalar_columns=list(scalar_columns), scalars=scalars, arrays=arrays)
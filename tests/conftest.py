@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Same as the scripts, the repository root is importable so tests can use src.helpers
+sys.path.append(str(Path(__file__).parent.parent))
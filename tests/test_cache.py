@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip('madmom')
+
+from src.helpers import cache
+from src.helpers.cache import FeatureCache
+from src.models import AudioData, FeatureVector, HarmonicFeatures, SpectralFeatures, TemporalFeatures
+
+
+def make_vector(name: str) -> FeatureVector:
+    return FeatureVector(audio=AudioData(name=name), spectral=SpectralFeatures(), temporal=TemporalFeatures(),
+                         harmonic=HarmonicFeatures())
+
+
+def test_cache_hit_with_same_params(tmp_path):
+    audio_file = tmp_path / 'Artist - Song.mp3'
+    audio_file.write_bytes(b'audio')
+    FeatureCache(str(tmp_path / 'cache'), {'n_mfcc': 13}).store(str(audio_file), make_vector('Artist - Song'))
+
+    assert FeatureCache(str(tmp_path / 'cache'), {'n_mfcc': 13}).load(str(audio_file)) is not None
+    assert FeatureCache(str(tmp_path / 'cache'), {'n_mfcc': 20}).load(str(audio_file)) is None
+
+
+# Entries cached before extraction changed are never served once the version is bumped
+def test_version_change_misses_cache(tmp_path, monkeypatch):
+    audio_file = tmp_path / 'Artist - Song.mp3'
+    audio_file.write_bytes(b'audio')
+    FeatureCache(str(tmp_path / 'cache'), {'stream': True}).store(str(audio_file), make_vector('Artist - Song'))
+
+    monkeypatch.setattr(cache, 'FEATURE_CACHE_VERSION', cache.FEATURE_CACHE_VERSION + 1)
+    assert FeatureCache(str(tmp_path / 'cache'), {'stream': True}).load(str(audio_file)) is None
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import pdist, squareform
+
+pytest.importorskip('madmom')
+
+from src.helpers.distances import load_distances
+from src.helpers.embedding import LandmarkMDS
+
+
+# Fitting on a precomputed distance file places the library like fitting on the features
+@pytest.mark.parametrize('method', ['smacof', 'classical'])
+@pytest.mark.parametrize('square', [False, True])
+def test_precomputed_matches_features(tmp_path, method, square):
+    matrix = np.random.default_rng(0).normal(size=(60, 8))
+    distances = pdist(matrix)
+    np.save(tmp_path / 'distances.npy', squareform(distances) if square else distances)
+
+    expected = LandmarkMDS(n_components=2, n_landmarks=12, method=method).fit_transform(matrix)
+    model = LandmarkMDS(n_components=2, n_landmarks=12, method=method, precomputed=True)
+    actual = model.fit_transform(load_distances(tmp_path / 'distances.npy'))
+
+    assert model.landmarks is None
+    np.testing.assert_allclose(actual, expected, atol=1e-6)
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+pytest.importorskip('madmom')
+
+from src.helpers.precision import COMPACT_PRECISION
+from src.helpers.repositories import ColumnarFeatureStore
+
+
+def make_dataset(n_rows: int = 40, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n_rows):
+        # Some songs have no chords at all
+        counts = np.zeros(625, dtype=np.int32)
+        n_chords = rng.integers(0, 12)
+        counts[rng.choice(625, size=n_chords, replace=False)] = rng.integers(1, 300, size=n_chords)
+        rows.append({
+            'song_name': f'Song {i}',
+            'artist': f'Artist {i % 5}',
+            'playlist': 'test',
+            'zero_crossings_mean': rng.normal(),
+            'bpm': np.array([rng.uniform(60, 180)]),
+            'mfcc_mean_1': np.float32(rng.normal()),
+            'chord_trajectory': sparse.csr_matrix(counts),
+            'tonnetz': rng.normal(size=64)
+        })
+    return pd.DataFrame(rows)
+
+
+# Writing rows one at a time in any order gives the same blocks as writing the whole dataset at once
+@pytest.mark.parametrize('precision', [None, COMPACT_PRECISION])
+def test_write_rows_matches_write(tmp_path, precision):
+    dataset = make_dataset()
+    rows = dataset.to_dict('records')
+    order = np.random.default_rng(1).permutation(len(rows))
+
+    expected = ColumnarFeatureStore.write(str(tmp_path), 'expected', dataset, precision)
+    actual = ColumnarFeatureStore.write_rows(str(tmp_path), 'actual', len(rows),
+                                             lambda: ((int(i), rows[i]) for i in order), precision)
+
+    assert actual.schema == expected.schema
+    for block in expected.path.glob('*.npy'):
+        expected_block, actual_block = np.load(block), np.load(actual.path / block.name)
+        assert actual_block.dtype == expected_block.dtype
+        np.testing.assert_array_equal(actual_block, expected_block)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('madmom')
+soundfile = pytest.importorskip('soundfile')
+
+from src.helpers.constants import TONNETZ_LENGTH
+from src.helpers.processors import AudioDataProcessor, FeatureVectorProcessor, StreamingFeatureVectorProcessor
+
+SAMPLE_RATE = 22050
+
+# Spectral and temporal statistics are computed frame by frame, so streaming should match the in-memory path
+STREAMED_FEATURES = ['zero_crossings_mean', 'zero_crossings_var',
+                     'spectral_centroid_mean', 'spectral_centroid_var',
+                     'spectral_rolloff_mean', 'spectral_rolloff_var',
+                     'spectral_flux_mean', 'spectral_flux_var',
+                     'spectral_flatness_mean', 'spectral_flatness_var'] \
+    + [f'mfcc_{stat}_{i}' for stat in ['mean', 'var'] for i in range(1, 11)]
+
+
+# 12 seconds of a chirp with a pulsing envelope and a little noise, so onsets and spectra vary over time
+@pytest.fixture(scope='module')
+def song_path(tmp_path_factory):
+    t = np.arange(12 * SAMPLE_RATE) / SAMPLE_RATE
+    chirp = np.sin(2 * np.pi * (220 + 40 * t) * t)
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 2 * t) ** 2
+    noise = 0.02 * np.random.default_rng(0).normal(size=t.size)
+    path = tmp_path_factory.mktemp('audio') / 'song.wav'
+    soundfile.write(path, (0.3 * chirp * envelope + noise).astype(np.float32), SAMPLE_RATE)
+    return str(path)
+
+
+def test_streaming_matches_in_memory(song_path):
+    in_memory, _ = FeatureVectorProcessor(AudioDataProcessor.load_one(song_path)).process()
+    streamed = StreamingFeatureVectorProcessor(song_path, window_duration=5.0).process()
+
+    expected, actual = in_memory.as_dict(), streamed.as_dict()
+    for feature in STREAMED_FEATURES:
+        assert np.isclose(actual[feature], expected[feature], rtol=1e-3, atol=1e-6), feature
+
+
+def test_streaming_merges_short_tail_into_last_window(song_path, monkeypatch):
+    windows = []
+    processor = StreamingFeatureVectorProcessor(song_path, window_duration=5.0)
+    to_harmonic = processor._StreamingFeatureVectorProcessor__to_harmonic
+    monkeypatch.setattr(processor, '_StreamingFeatureVectorProcessor__to_harmonic',
+                        lambda window: windows.append(len(window)) or to_harmonic(window))
+    processor.process()
+
+    assert windows[:-1] == [5 * SAMPLE_RATE] * (len(windows) - 1)
+    assert 5 * SAMPLE_RATE <= windows[-1] < 10 * SAMPLE_RATE
+    assert sum(windows) == 12 * SAMPLE_RATE
+
+
+# Empty audio has no window at all, and a second of silence has no beats to sync the tonnetz to
+@pytest.mark.parametrize('n_samples', [0, SAMPLE_RATE])
+def test_streaming_silent_audio(tmp_path, n_samples):
+    path = tmp_path / 'silence.wav'
+    soundfile.write(path, np.zeros(n_samples, dtype=np.float32), SAMPLE_RATE)
+    feature_vector = StreamingFeatureVectorProcessor(str(path)).process()
+
+    assert feature_vector.temporal.bpm == 0
+    np.testing.assert_array_equal(feature_vector.harmonic.tonnetz, np.zeros(TONNETZ_LENGTH))
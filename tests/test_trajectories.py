@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('madmom')
+
+from src.helpers.constants import CHORD_MAP, MIDI_MAX_NOTE
+from src.helpers.processors import construct_chord_beat_df, construct_chord_trajectory, construct_note_trajectory
+
+CHORD_LABELS = list(CHORD_MAP)
+
+
+# -- Reference: the loop implementations the searchsorted and bincount versions replaced
+
+def loop_chord_beat_df(beat_times, chord_time_matrix, chord_map=CHORD_MAP):
+    start_idx, end_idx, current_idx = 0, 0, 0
+    chord_beat_matrix: list = beat_times.tolist()
+
+    for start_time, end_time, chord_label in chord_time_matrix:
+
+        for enum, beat_time in enumerate(beat_times[start_idx:]):
+            # get current index and set as end index, exclusive
+            current_idx = enum + start_idx
+            if beat_time < end_time:
+                chord_beat_matrix[current_idx] = beat_time, chord_map[chord_label]
+            else:
+                break
+
+        start_idx = current_idx
+
+    return pd.DataFrame(chord_beat_matrix, columns=['beat_time', 'chord'])
+
+
+def loop_chord_trajectory(chord_beat_matrix, chord_map=CHORD_MAP, ignore_non_chords=True):
+    chord_count = len(chord_map)
+    max_chord = chord_count - 1
+    chord_trajectory = np.zeros(shape=(chord_count, chord_count))
+
+    for x in range(0, chord_beat_matrix.shape[0] - 1):
+        chord_x = chord_beat_matrix['chord'].iloc[x]
+        chord_y = chord_beat_matrix['chord'].iloc[x + 1]
+
+        if ignore_non_chords:
+            if chord_x == max_chord and chord_y == max_chord:
+                continue
+            elif chord_x == max_chord and chord_y != max_chord:
+                chord_trajectory[chord_y, chord_y] += 1
+            elif chord_x != max_chord and chord_y == max_chord:
+                chord_trajectory[chord_x, chord_x] += 1
+            else:
+                chord_trajectory[chord_y, chord_x] += 1
+        else:
+            chord_trajectory[chord_y, chord_x] += 1
+
+    return chord_trajectory
+
+
+def loop_note_trajectory(note_time_matrix):
+    note_trajectory = np.zeros(shape=(MIDI_MAX_NOTE, MIDI_MAX_NOTE))
+
+    for x in range(note_time_matrix.shape[0] - 1):
+        note_x = int(note_time_matrix[x][1])
+        note_y = int(note_time_matrix[x + 1][1])
+        note_trajectory[note_y, note_x] += 1
+
+    return note_trajectory
+
+
+# -- Random layouts
+
+# Contiguous chord segments, with the non-chord label N common enough to exercise ignore_non_chords, and sorted
+# beats before the end of the last segment, as the loop version fails on beats after it
+def random_layout(rng: np.random.Generator):
+    n_segments = int(rng.integers(1, 30))
+    ends = np.cumsum(rng.uniform(0.1, 3.0, n_segments))
+    starts = np.concatenate([[0.0], ends[:-1]])
+    labels = rng.choice(CHORD_LABELS[-1:] * 8 + CHORD_LABELS, n_segments)
+    chord_time_matrix = np.array(list(zip(starts, ends, labels)),
+                                 dtype=[('start', float), ('end', float), ('label', object)])
+
+    n_beats = int(rng.integers(1, 60))
+    beat_times = np.sort(rng.uniform(0, ends[-1], n_beats))
+    # Beats exactly on a segment boundary
+    on_boundary = rng.random(n_beats) < 0.1
+    beat_times[on_boundary] = rng.choice(ends[:-1] if n_segments > 1 else [0.0], on_boundary.sum())
+    return np.sort(beat_times), chord_time_matrix
+
+
+@pytest.mark.parametrize('ignore_non_chords', [True, False])
+def test_chord_trajectory_matches_loops(ignore_non_chords):
+    rng = np.random.default_rng(0)
+    for _ in range(1500):
+        beat_times, chord_time_matrix = random_layout(rng)
+        expected_df = loop_chord_beat_df(beat_times, chord_time_matrix)
+        actual_df = construct_chord_beat_df(beat_times, chord_time_matrix)
+
+        np.testing.assert_array_equal(actual_df['beat_time'].to_numpy(), expected_df['beat_time'].to_numpy())
+        np.testing.assert_array_equal(actual_df['chord'].to_numpy(), expected_df['chord'].to_numpy())
+        np.testing.assert_array_equal(construct_chord_trajectory(actual_df, ignore_non_chords=ignore_non_chords),
+                                      loop_chord_trajectory(expected_df, ignore_non_chords=ignore_non_chords))
+
+
+def test_note_trajectory_matches_loops():
+    rng = np.random.default_rng(0)
+    for _ in range(1000):
+        n_notes = int(rng.integers(0, 200))
+        note_time_matrix = np.stack([np.sort(rng.uniform(0, 60, n_notes)),
+                                     rng.integers(21, 109, n_notes).astype(float)], axis=1)
+        np.testing.assert_array_equal(construct_note_trajectory(note_time_matrix),
+                                      loop_note_trajectory(note_time_matrix))